@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark del pipeline timbrar → firmar → sobre con datos sintéticos
+(datos_prueba: PFX autofirmado, CAF generado, documentos variados).
+
+Mide por etapa la latencia (media, p50, p95, máximo) y el throughput:
+construcción de los Documento (Envio), _dte, _dte_to_xml, set_barcode,
+firma del DTE, validar_xml del DTE (las boletas no tienen XSD propio: se
+validan en el sobre), armado y firma del sobre y validación del sobre
+EnvioBOLETA. Las etapas se ejecutan con los mismos métodos que DTE.timbrar y
+Envio.generate_xml_send, pero por separado para poder medirlas; la firma se
+mide sin la validación XSD, que es su propia etapa. No se envía nada.
+
+    python -m facturacion_electronica.benchmark
+
+Variables: BENCH_DOCS (documentos por tipo, 200), BENCH_TIPOS ('39'),
+BENCH_LINEAS ('1-20'), BENCH_REPETICIONES (3), BENCH_OUT (JSON de
+resultados, por defecto out/benchmark.json) y BENCH_BASE (resultados de una
+versión anterior; se reportan las etapas que empeoran más que
+BENCH_TOLERANCIA, 0.2 = 20 %, y el proceso termina con código 1).
+"""
+import collections
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+from datetime import datetime
+from facturacion_electronica import clase_util as util
+from facturacion_electronica import __version__
+from facturacion_electronica.datos_prueba import (
+    certificado_prueba,
+    payload_sintetico,
+)
+from facturacion_electronica.envio import Envio
+
+import logging
+_logger = logging.getLogger(__name__)
+
+
+ETAPAS = [
+    'documento',
+    '_dte',
+    '_dte_to_xml',
+    'set_barcode',
+    'firmar',
+    'validar_xml',
+    'sobre',
+    'validar_sobre',
+]
+
+
+class Cronometro(object):
+    """Acumula duraciones (y bytes producidos) por etapa."""
+
+    def __init__(self):
+        self.tiempos = collections.defaultdict(list)
+        self.bytes = collections.Counter()
+
+    def medir(self, etapa, funcion, *args):
+        inicio = time.perf_counter()
+        resultado = funcion(*args)
+        self.tiempos[etapa].append(time.perf_counter() - inicio)
+        return resultado
+
+    def agregar(self, etapa, segundos, cantidad=1):
+        """Registra una medición que cubre `cantidad` documentos."""
+        self.tiempos[etapa].extend([segundos / cantidad] * cantidad)
+
+    def resumen(self):
+        etapas = collections.OrderedDict()
+        for etapa in ETAPAS:
+            tiempos = sorted(self.tiempos.get(etapa, []))
+            if not tiempos:
+                continue
+            total = sum(tiempos)
+            etapas[etapa] = {
+                'n': len(tiempos),
+                'total_s': round(total, 6),
+                'media_ms': round(total / len(tiempos) * 1000, 4),
+                'p50_ms': round(statistics.median(tiempos) * 1000, 4),
+                'p95_ms': round(
+                    tiempos[int(0.95 * (len(tiempos) - 1))] * 1000, 4),
+                'max_ms': round(tiempos[-1] * 1000, 4),
+                'por_segundo': round(len(tiempos) / total, 1) if total else 0,
+                'bytes': self.bytes.get(etapa, 0),
+            }
+        return etapas
+
+
+def _timbrar(cronometro, dte):
+    """DTE.timbrar por etapas."""
+    tpo_dte = dte._tag_dte()
+    documento = collections.OrderedDict()
+    documento[tpo_dte] = cronometro.medir('_dte', dte._dte)
+    xml = cronometro.medir('_dte_to_xml', dte._dte_to_xml, documento, tpo_dte)
+    cronometro.medir('set_barcode', dte.set_barcode, xml)
+    xml.set('ID', dte.ID)
+    dte.sii_xml_request = cronometro.medir(
+        'firmar', dte._firmar_documento, xml)
+    cronometro.bytes['firmar'] += len(dte.sii_xml_request)
+    if not dte.es_boleta():
+        cronometro.medir('validar_xml', util.validar_xml, dte.sii_xml_request)
+
+
+def ejecutar(docs=200, tipos=(39,), lineas=(1, 20), repeticiones=3,
+             firma=None):
+    """Corre el benchmark y retorna los resultados (dict serializable)."""
+    firma = firma or certificado_prueba()
+    cronometro = Cronometro()
+    util.cargar_esquemas()
+    inicio = time.perf_counter()
+    cantidad = 0
+    for repeticion in range(repeticiones):
+        vals = payload_sintetico(
+            docs, tipos, lineas, semilla=repeticion, firma=firma)
+        t = time.perf_counter()
+        envio = Envio(vals)
+        cronometro.agregar(
+            'documento', time.perf_counter() - t, len(envio.Documento))
+        firma_electronica = envio.firma_electronica
+        # La validación XSD se mide como etapa propia.
+        firma_electronica.verify = False
+        for dte in envio.Documento:
+            dte.barcode_render = 'none'
+            _timbrar(cronometro, dte)
+        cantidad += len(envio.Documento)
+        # Boletas y otros DTE no van en el mismo sobre.
+        if len(tipos) == 1:
+            envio.workers = 0
+            envio.stream = False
+            cronometro.medir('sobre', envio.generate_xml_send)
+            cronometro.bytes['sobre'] += len(envio.sii_xml_request)
+            if envio.es_boleta:
+                cronometro.medir(
+                    'validar_sobre', util.validar_xml,
+                    envio.sii_xml_request, 'env_boleta')
+    segundos = time.perf_counter() - inicio
+    return {
+        'version': __version__,
+        'fecha': datetime.now().strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'plataforma': platform.platform(),
+        'parametros': {
+            'docs': docs,
+            'tipos': list(tipos),
+            'lineas': list(lineas),
+            'repeticiones': repeticiones,
+        },
+        'etapas': cronometro.resumen(),
+        'total': {
+            'documentos': cantidad,
+            'segundos': round(segundos, 3),
+            'por_segundo': round(cantidad / segundos, 1) if segundos else 0,
+        },
+    }
+
+
+def comparar(actual, base, tolerancia=0.2):
+    """Etapas cuya media empeoró más que `tolerancia` respecto de `base`:
+    lista de (etapa, media_base_ms, media_actual_ms)."""
+    regresiones = []
+    for etapa, valores in actual['etapas'].items():
+        anterior = base.get('etapas', {}).get(etapa)
+        if not anterior or not anterior['media_ms']:
+            continue
+        if valores['media_ms'] > anterior['media_ms'] * (1 + tolerancia):
+            regresiones.append(
+                (etapa, anterior['media_ms'], valores['media_ms']))
+    return regresiones
+
+
+def _rango(texto):
+    desde, _, hasta = texto.partition('-')
+    return int(desde), int(hasta or desde)
+
+
+def main():
+    logging.basicConfig(level=logging.ERROR)
+    resultados = ejecutar(
+        docs=int(os.environ.get('BENCH_DOCS') or 200),
+        tipos=[int(t) for t in (
+            os.environ.get('BENCH_TIPOS') or '39').split(',')],
+        lineas=_rango(os.environ.get('BENCH_LINEAS') or '1-20'),
+        repeticiones=int(os.environ.get('BENCH_REPETICIONES') or 3),
+    )
+    path = os.environ.get('BENCH_OUT') or os.path.join(
+        os.path.dirname(__file__), 'out', 'benchmark.json')
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(resultados, f, indent=2)
+    print("%-14s %8s %10s %10s %10s %10s" % (
+        'etapa', 'n', 'media ms', 'p95 ms', 'max ms', 'por seg'))
+    for etapa, v in resultados['etapas'].items():
+        print("%-14s %8s %10s %10s %10s %10s" % (
+            etapa, v['n'], v['media_ms'], v['p95_ms'], v['max_ms'],
+            v['por_segundo']))
+    total = resultados['total']
+    print("%s documentos en %ss (%s/s) -> %s" % (
+        total['documentos'], total['segundos'], total['por_segundo'], path))
+    base = os.environ.get('BENCH_BASE')
+    if base:
+        with open(base) as f:
+            regresiones = comparar(
+                resultados, json.load(f),
+                float(os.environ.get('BENCH_TOLERANCIA') or 0.2))
+        for etapa, anterior, actual in regresiones:
+            print("REGRESIÓN %s: %s ms -> %s ms" % (etapa, anterior, actual))
+        if regresiones:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,19 @@
 # -*- coding: utf-8 -*-
+import atexit
 import base64
-import json
-import os
+import bisect
+import logging
+import threading
+import weakref
 from lxml import etree
+from facturacion_electronica.firma import SigningKey
+from facturacion_electronica.folios import get_folio_allocator
+_logger = logging.getLogger(__name__)
+_cafs_con_reserva = weakref.WeakSet()
+# Llave RSASK cargada y nodo CAF serializado por identidad del CAF
+# (RE, TD, D, H), compartidos por todos los Caf del proceso.
+_llaves_caf = {}
+_llaves_caf_lock = threading.Lock()
 
 
 class UserError(Exception):
@@ -15,114 +26,269 @@ class Warning(Exception):
     pass
 
 
+class CafRango(object):
+    """CAF ya parseado: rango de folios, nodo CAF y llave RSASK."""
+
+    def __init__(self, post):
+        self.post = post
+        self.caf = post.find('CAF')
+        self.rut_emisor = (post.find('CAF/DA/RE').text or "").strip()
+        try:
+            self.TipoDTE = int(post.find('CAF/DA/TD').text)
+        except Exception:
+            self.TipoDTE = None
+        self.desde = int(post.find('CAF/DA/RNG/D').text)
+        self.hasta = int(post.find('CAF/DA/RNG/H').text)
+        self.rsask = post.find('RSASK').text.replace('\t', '')
+
+    def contiene(self, folio):
+        return self.desde <= folio <= self.hasta
+
+    @property
+    def identidad(self):
+        return (self.rut_emisor, self.TipoDTE, self.desde, self.hasta)
+
+    def _cargar(self):
+        """Entrada del cache para este CAF. Si otro CAF con la misma
+        identidad trae otra llave (CAF de prueba regenerados), se reemplaza."""
+        if hasattr(self, '_llave'):
+            return
+        with _llaves_caf_lock:
+            entrada = _llaves_caf.get(self.identidad)
+        if not entrada or entrada[0] != self.rsask:
+            entrada = (
+                self.rsask,
+                SigningKey(self.rsask.encode()),
+                etree.tostring(
+                    self.caf, encoding="ISO-8859-1", xml_declaration=False),
+            )
+            with _llaves_caf_lock:
+                _llaves_caf[self.identidad] = entrada
+        self._llave, self._caf_xml = entrada[1], entrada[2]
+
+    @property
+    def llave(self):
+        """SigningKey de RSASK, cargada una vez por identidad de CAF; firma
+        el FRMT del TED."""
+        self._cargar()
+        return self._llave
+
+    @property
+    def caf_xml(self):
+        """Nodo CAF serializado en ISO-8859-1 (con su tail), tal como se
+        inserta en el DD; los saltos de línea se quitan al firmar y en el
+        TED."""
+        self._cargar()
+        return self._caf_xml
+
+
 class Caf(object):
 
     def __init__(self, cafList):
         """Recibe lista de caf strings en base64,
-        decodifica y guarda."""
+        decodifica, parsea una sola vez e indexa los rangos por
+        (RUT emisor, TipoDTE) y por TipoDTE."""
         self.decodedCafs = []
+        self._reservados = {}
+        self._rangos_reserva = {}
+        self._rangos = []
+        self._por_tipo = {}
+        self._por_emisor = {}
         for caf in cafList:
             decodedCaf = base64.b64decode(caf).decode('ISO-8859-1')
             self.decodedCafs.append(decodedCaf)
+            rango = CafRango(etree.XML(decodedCaf))
+            self._rangos.append(rango)
+            self._indexar(self._por_tipo, rango.TipoDTE, rango)
+            self._indexar(
+                self._por_emisor, (rango.rut_emisor, rango.TipoDTE), rango)
 
-    def _state_path(self):
-        """
-        Archivo local para persistir el último folio usado por (RUTEmisor, TipoDTE).
-        Se puede sobreescribir con env var FOLIO_STATE_PATH.
-        """
-        env_path = os.environ.get("FOLIO_STATE_PATH")
-        if env_path:
-            return env_path
-        base_dir = os.path.dirname(__file__)
-        out_dir = os.path.join(base_dir, "out")
-        os.makedirs(out_dir, exist_ok=True)
-        return os.path.join(out_dir, "folio_state.json")
-
-    def _load_state(self, path):
-        try:
-            if not os.path.exists(path):
-                return {}
-            with open(path, "r", encoding="utf-8") as f:
-                return json.load(f) or {}
-        except Exception:
-            return {}
+    def __getstate__(self):
+        # Para pasar el Caf a otro proceso (timbrado en paralelo) basta con
+        # los CAF; las reservas y el allocator quedan en el proceso original.
+        return {'cafList': [base64.b64encode(c.encode('ISO-8859-1'))
+                            for c in self.decodedCafs]}
 
-    def _save_state(self, path, state):
-        tmp = path + ".tmp"
-        with open(tmp, "w", encoding="utf-8") as f:
-            json.dump(state, f, ensure_ascii=False, indent=2, sort_keys=True)
-        os.replace(tmp, path)
+    def __setstate__(self, state):
+        self.__init__(state['cafList'])
+
+    def _indexar(self, indice, key, rango):
+        """Mantiene cada lista ordenada por folio inicial, junto con la lista
+        de inicios usada por bisect."""
+        inicios, rangos = indice.setdefault(key, ([], []))
+        pos = bisect.bisect_right(inicios, rango.desde)
+        inicios.insert(pos, rango.desde)
+        rangos.insert(pos, rango)
+
+    def _buscar(self, indice, key, folio):
+        inicios, rangos = indice.get(key, ([], []))
+        pos = bisect.bisect_right(inicios, folio) - 1
+        if pos >= 0 and rangos[pos].contiene(folio):
+            return rangos[pos]
+        return None
+
+    @property
+    def folio_allocator(self):
+        """Allocator de folios; por defecto el configurado por
+        FOLIO_BACKEND / FOLIO_STATE_PATH (ver folios.py)."""
+        if not hasattr(self, '_folio_allocator'):
+            return False
+        return self._folio_allocator
+
+    @folio_allocator.setter
+    def folio_allocator(self, val):
+        self._folio_allocator = val
 
     def _caf_ranges(self, TipoDTE):
         """
         Retorna lista de rangos disponibles para el TipoDTE en los CAF cargados:
         [(rut_emisor, d, h, xml_tree), ...]
         """
-        ranges = []
-        for decodedCaf in self.decodedCafs:
-            post = etree.XML(decodedCaf)
-            try:
-                td = int(post.find('CAF/DA/TD').text)
-            except Exception:
-                td = None
-            if td != int(TipoDTE):
-                continue
-            rut_emisor = (post.find('CAF/DA/RE').text or "").strip()
-            d = int(post.find('CAF/DA/RNG/D').text)
-            h = int(post.find('CAF/DA/RNG/H').text)
-            ranges.append((rut_emisor, d, h, post))
-        return ranges
+        try:
+            TipoDTE = int(TipoDTE)
+        except Exception:
+            return []
+        return [(r.rut_emisor, r.desde, r.hasta, r.post)
+                for r in self._rangos if r.TipoDTE == TipoDTE]
 
-    def next_folio(self, TipoDTE, rut_emisor=None, state_path=None):
+    def _folio_key(self, TipoDTE, rut_emisor=None):
         """
-        Devuelve el siguiente folio (incremental +1) dentro del rango del CAF.
-        - Solo usa CAF cuyo TD coincida con TipoDTE.
-        - Persiste el último folio usado en un JSON local, para no repetir folios.
+        Retorna la clave de estado "RUT|TipoDTE" y los rangos [(d, h)] de los
+        CAF cargados para ese TipoDTE.
+        - Si se pasa rut_emisor, preferimos el CAF del mismo RUT.
         """
         ranges = self._caf_ranges(TipoDTE)
         if not ranges:
             raise UserError(f"No hay CAF cargado para TipoDTE {TipoDTE}")
-
-        # Si se pasa rut_emisor, preferimos el CAF del mismo RUT.
         if rut_emisor:
             rut_emisor = rut_emisor.strip()
             filtered = [r for r in ranges if r[0] == rut_emisor]
             if filtered:
                 ranges = filtered
-
-        # Elegimos el primer rango (en la práctica suele venir 1 CAF por tipo).
-        caf_rut, d, h, _post = ranges[0]
+        caf_rut = ranges[0][0]
         key_rut = rut_emisor or caf_rut
         if not key_rut:
             key_rut = caf_rut or "SIN_RUT"
-        state_path = state_path or self._state_path()
-        state = self._load_state(state_path)
         key = f"{key_rut}|{int(TipoDTE)}"
-        last = int(state.get(key, d - 1))
-        nxt = max(d, last + 1)
-        if nxt > h:
-            raise UserError(
-                f"Sin folios disponibles para {key_rut} TipoDTE {TipoDTE}. "
-                f"Rango CAF: {d}-{h}. Último usado: {last}. Solicita un nuevo CAF."
-            )
-        state[key] = nxt
-        self._save_state(state_path, state)
-        return nxt
+        return key, [(d, h) for _rut, d, h, _post in ranges]
 
-    def get_caf_file(self, folio, TipoDTE):
-        """Esta función es llamada desde dte"""
-        if not self.decodedCafs:
+    def _allocator(self, state_path=None):
+        allocator = self.folio_allocator
+        if state_path or not allocator:
+            allocator = get_folio_allocator(state_path)
+        return allocator
+
+    def next_folio(self, TipoDTE, rut_emisor=None, state_path=None):
+        """
+        Devuelve el siguiente folio (incremental +1) dentro del rango del CAF.
+        - Solo usa CAF cuyo TD coincida con TipoDTE.
+        - Si hay folios reservados con reserve_folios, entrega esos primero.
+        - Persiste el último folio usado (folio_allocator), para no repetir folios
+          aunque varios procesos emitan con el mismo CAF.
+        """
+        key, rangos = self._folio_key(TipoDTE, rut_emisor)
+        allocator = self._allocator(state_path)
+        reservados = self._reservados.get((allocator, key))
+        if reservados:
+            return reservados.pop(0)
+        return allocator.reservar(key, rangos)[0]
+
+    def reserve_folios(self, TipoDTE, n, rut_emisor=None, state_path=None):
+        """
+        Reserva n folios en una sola transacción de estado (pueden abarcar
+        más de un CAF del mismo TipoDTE) y retorna la lista.
+        Los folios quedan en reserva y next_folio los entrega en orden;
+        los que no se entreguen se devuelven con release_folios (o al
+        terminar el proceso).
+        """
+        key, rangos = self._folio_key(TipoDTE, rut_emisor)
+        allocator = self._allocator(state_path)
+        folios = allocator.reservar(key, rangos, n)
+        self._reservados.setdefault((allocator, key), []).extend(folios)
+        self._rangos_reserva[(allocator, key)] = rangos
+        _cafs_con_reserva.add(self)
+        return list(folios)
+
+    def release_folios(self):
+        """
+        Devuelve al estado los folios reservados que no se entregaron.
+        Retorna los que no se pudieron devolver (ya se asignaron folios
+        posteriores); esos quedan sin usar y deben anularse en el SII.
+        """
+        no_devueltos = []
+        for (allocator, key), folios in self._reservados.items():
+            if not folios:
+                continue
+            pendientes = allocator.liberar(
+                key, folios, self._rangos_reserva.get((allocator, key)))
+            if pendientes:
+                _logger.warning(
+                    "Folios reservados sin usar para %s (anular en SII): %s"
+                    % (key, pendientes))
+            no_devueltos.extend(pendientes)
+        self._reservados = {}
+        self._rangos_reserva = {}
+        return no_devueltos
+
+    def reservar_documentos(self, TipoDTE, documentos, rut_emisor=None):
+        """Reserva en un solo bloque los folios de los documentos que vienen
+        sin folio, para que next_folio no escriba el estado por documento.
+        Si la reserva falla, next_folio los asigna uno a uno."""
+        por_asignar = folios_por_asignar(documentos)
+        if por_asignar < 2:
+            return
+        try:
+            self.reserve_folios(TipoDTE, por_asignar, rut_emisor=rut_emisor)
+        except Exception:
+            _logger.warning("No se pudo reservar bloque de folios", exc_info=True)
+
+    def get_caf(self, folio, TipoDTE, rut_emisor=None):
+        """Retorna el CafRango que contiene el folio, sin volver a parsear.
+        El nodo CAF es compartido: quien lo inserte en otro árbol debe copiarlo."""
+        if not self._rangos:
             raise UserError('There is no CAF file available or in use ' +
                             'for this Document. Please enable one.')
-        for decodedCaf in self.decodedCafs:
-            post = etree.XML(decodedCaf)
-            folio_inicial = post.find('CAF/DA/RNG/D').text
-            folio_final = post.find('CAF/DA/RNG/H').text
-            if folio in range(int(folio_inicial), (int(folio_final)+1)):
-                return post
-        if folio > int(folio_final):
+        folio = int(folio)
+        TipoDTE = int(TipoDTE)
+        rango = None
+        if rut_emisor:
+            rango = self._buscar(
+                self._por_emisor, (rut_emisor.strip(), TipoDTE), folio)
+        if not rango:
+            rango = self._buscar(self._por_tipo, TipoDTE, folio)
+        if rango:
+            return rango
+        rangos = self._por_tipo.get(TipoDTE, ([], []))[1]
+        if rangos and folio > rangos[-1].hasta:
             msg = '''El folio de este documento: {} está fuera de rango \
 del CAF vigente (desde {} hasta {}). Solicite un nuevo CAF en el sitio \
-www.sii.cl'''.format(folio, folio_inicial, folio_final)
+www.sii.cl'''.format(folio, rangos[-1].desde, rangos[-1].hasta)
             raise UserError(msg)
         raise UserError('No Existe Caf para %s folio %s' % (TipoDTE, folio))
+
+    def get_caf_file(self, folio, TipoDTE):
+        """Esta función es llamada desde dte"""
+        return self.get_caf(folio, TipoDTE).post
+
+
+def folios_por_asignar(documentos):
+    """Cantidad de documentos que vienen sin folio (o con folio 0)."""
+    cantidad = 0
+    for docData in documentos:
+        try:
+            folio = docData.get("Encabezado", {}).get("IdDoc", {}).get("Folio", 0)
+            if int(folio or 0) <= 0:
+                cantidad += 1
+        except Exception:
+            pass
+    return cantidad
+
+
+@atexit.register
+def _liberar_reservas():
+    for caf in list(_cafs_con_reserva):
+        try:
+            caf.release_folios()
+        except Exception:
+            _logger.warning("No se pudieron liberar folios reservados",
+                            exc_info=True)
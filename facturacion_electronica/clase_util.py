@@ -6,6 +6,8 @@ import re
 from lxml import etree
 import collections
 import decimal
+import threading
+from facturacion_electronica import instrumentacion
 import logging
 _logger = logging.getLogger(__name__)
 
@@ -18,6 +20,14 @@ def round0(val):
     decimal.getcontext().rounding = decimal.ROUND_HALF_UP
     return int(decimal.Decimal(val).to_integral_value())
 
+def set_defaults(obj):
+    """Inicializa cada slot de `obj` con su valor de `obj._defaults`
+    (modelos con __slots__: los valores por defecto se declaran una vez en
+    la clase y los getters no necesitan hasattr)."""
+    for campo, valor in obj._defaults.items():
+        setattr(obj, campo, valor)
+
+
 def set_from_keys(obj, vals={}, priorizar=[]):
     for p in priorizar:
         val = vals.get(p)
@@ -59,6 +69,54 @@ def create_xml(to_xml, root=None):
                 _logger.warning("%s %s" %(k, v))
     return root
 
+def es_item(tag):
+    """Claves 'item' / 'items*' que en los dict solo agrupan listas."""
+    return tag == 'item' or tag.startswith('items')
+
+
+def build_xml(to_xml, root=None):
+    """Como create_xml, pero arma el árbol final: las claves item/items*
+    no generan nodo y sus elementos quedan directo en el padre, así no hace
+    falta limpiar_items ni volver a parsear."""
+    if isinstance(to_xml, list):
+        for r in to_xml:
+            if isinstance(r, (list, dict)):
+                build_xml(r, root)
+            else:
+                root.text = str(r)
+        return root
+    for k, v in to_xml.items():
+        if root is None:
+            root = el = etree.Element(k)
+        elif es_item(k):
+            el = root
+        else:
+            el = etree.SubElement(root, k)
+        if isinstance(v, (list, dict)):
+            build_xml(v, el)
+        elif type(v) is not bool:
+            el.text = str(v)
+        else:
+            _logger.warning("%s %s" %(k, v))
+    return root
+
+
+def indentar(el, nivel=0):
+    """Indenta el árbol en el lugar igual que pretty_print: no toca los
+    nodos que ya traen texto entre sus hijos."""
+    hijos = list(el)
+    if not hijos or el.text is not None or \
+            any(h.tail is not None for h in hijos):
+        return el
+    sangria = '\n' + '  ' * (nivel + 1)
+    el.text = sangria
+    for h in hijos:
+        h.tail = sangria
+        indentar(h, nivel + 1)
+    hijos[-1].tail = '\n' + '  ' * nivel
+    return el
+
+
 def limpiar_items(xml):
     xml =re.sub(r"<items[a-zA-Z]*>", r"", xml)
     xml =re.sub(r"</items[a-zA-Z]*>", r"", xml)
@@ -126,28 +184,59 @@ def time_stamp(formato='%Y-%m-%dT%H:%M:%S'):
     return datetime.now(tz).strftime(formato)
 
 
-def validar_xml(some_xml_string, validacion='doc'):
-    if validacion == 'bol':
-        return some_xml_string
-    # Slim package: Boleta (DTE 39) + tracking only.
-    # We only ship the XSDs required by this flow.
-    validacion_type = {
-        'doc': 'DTE_v10.xsd',
-        'env_boleta': 'EnvioBOLETA_v11.xsd',
-        'sig': 'xmldsignature_v10.xsd',
-    }
-    if validacion not in validacion_type:
+# Slim package: Boleta (DTE 39) + tracking only.
+# We only ship the XSDs required by this flow.
+XSD_FILES = {
+    'doc': 'DTE_v10.xsd',
+    'env_boleta': 'EnvioBOLETA_v11.xsd',
+    'sig': 'xmldsignature_v10.xsd',
+}
+_xml_schemas = {}
+_xml_schemas_lock = threading.Lock()
+
+
+def get_xml_schema(validacion):
+    """Retorna el XMLSchema compilado para el tipo de validación.
+    Se compila una sola vez por proceso y se reutiliza."""
+    xmlschema = _xml_schemas.get(validacion)
+    if xmlschema is not None:
+        return xmlschema
+    if validacion not in XSD_FILES:
         raise UserError(
             "XSD validation not included in boleta_rapida_tracking_min for type: %s. "
             "This repo only includes schemas for 'doc', 'env_boleta' and 'sig'."
             % validacion
         )
-    xsdpath = os.path.dirname(os.path.realpath(__file__)) + '/xsd/'
-    xsd_file = xsdpath + validacion_type[validacion]
+    with _xml_schemas_lock:
+        xmlschema = _xml_schemas.get(validacion)
+        if xmlschema is None:
+            xsdpath = os.path.dirname(os.path.realpath(__file__)) + '/xsd/'
+            xmlschema_doc = etree.parse(xsdpath + XSD_FILES[validacion])
+            xmlschema = etree.XMLSchema(xmlschema_doc)
+            _xml_schemas[validacion] = xmlschema
+    return xmlschema
+
+
+def cargar_esquemas(validaciones=None):
+    """Precarga los XSD (por ejemplo al iniciar un servidor), para que la
+    primera firma no pague la compilación."""
+    for validacion in (validaciones or XSD_FILES):
+        get_xml_schema(validacion)
+
+
+@instrumentacion.medido(
+    'validar_xml',
+    etiquetas=lambda xml, validacion='doc': {'tipo': validacion})
+def validar_xml(some_xml_string, validacion='doc'):
+    """Valida contra el XSD; acepta el XML en texto o un elemento lxml."""
+    if validacion == 'bol':
+        return True
+    xmlschema = get_xml_schema(validacion)
     try:
-        xmlschema_doc = etree.parse(xsd_file)
-        xmlschema = etree.XMLSchema(xmlschema_doc)
-        xml_doc = etree.fromstring(some_xml_string)
+        if etree.iselement(some_xml_string):
+            xml_doc = some_xml_string
+        else:
+            xml_doc = etree.fromstring(some_xml_string)
         result = xmlschema.validate(xml_doc)
         if not result:
             xmlschema.assert_(xml_doc)
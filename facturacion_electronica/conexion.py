@@ -3,17 +3,25 @@ import collections
 from datetime import datetime
 from lxml import etree
 import codecs
+import io
 import json
-import time
+import os
+import threading
 import ssl
+import tempfile
 from facturacion_electronica import clase_util as util
+from facturacion_electronica import instrumentacion
+from facturacion_electronica import reintentos
+from facturacion_electronica.token_cache import get_token_cache
 
 import logging
 _logger = logging.getLogger(__name__)
 
 try:
-    from zeep import Client
+    from zeep import Client, Settings
+    from zeep.cache import SqliteCache
     from zeep.transports import Transport
+    from zeep.wsdl import Document
 except ImportError:
     print('Cannot import ZEEP')
 
@@ -24,6 +32,7 @@ except:
     raise UserError('Error en cargar urllib3')
 try:
     from requests import Session
+    from requests.adapters import HTTPAdapter
 except:
     raise UserError("No se puede cargar Session")
 try:
@@ -51,6 +60,20 @@ claim_url = {
     'produccion': 'https://ws1.sii.cl/WSREGISTRORECLAMODTE/registroreclamodteservice',
 }
 
+
+def set_url_local(base):
+    """Apunta el Modo 'local' a un servidor que imita al SII (sii_mock),
+    para probar envío y tracking sin red. `base` como 'http://host:port/'."""
+    if not base.endswith('/'):
+        base += '/'
+    server_url['local'] = base
+    api_url['local'] = base + 'recursos/v1/'
+    api_url_envio['local'] = base + 'recursos/v1/'
+    claim_url['local'] = base + 'registroreclamodteservice'
+
+
+set_url_local(os.environ.get("SII_URL_LOCAL") or 'http://127.0.0.1:8089/')
+
 connection_status = {
     '0': 'Upload OK',
     '1': 'El Sender no tiene permiso para enviar',
@@ -71,9 +94,137 @@ class UserError(Exception):
     pass
 
 
+# Pool SOAP por proceso: una Session keep-alive y cada WSDL parseado una vez.
+# Los WSDL descargados además quedan en un SqliteCache (SII_WSDL_CACHE_PATH,
+# 'none' para desactivarlo; por defecto en el directorio temporal del sistema)
+# y así un proceso nuevo no los vuelve a bajar.
+_soap_lock = threading.Lock()
+_soap_pid = None
+_soap_session = None
+_soap_wsdl = {}
+
+
+def wsdl_cache():
+    path = os.environ.get("SII_WSDL_CACHE_PATH")
+    if path == 'none':
+        return None
+    if not path:
+        path = os.path.join(
+            tempfile.gettempdir(), "facturacion_electronica",
+            "wsdl_cache.sqlite3")
+    try:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        return SqliteCache(path=path, timeout=86400)
+    except Exception as e:
+        _logger.warning("No se pudo abrir cache WSDL %s: %s" % (path, str(e)))
+        return None
+
+
+def _soap_pool():
+    global _soap_pid, _soap_session, _soap_wsdl
+    # Las conexiones abiertas no deben compartirse después de un fork.
+    if _soap_pid != os.getpid():
+        session = Session()
+        adapter = HTTPAdapter(pool_connections=10, pool_maxsize=20)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        _soap_session = session
+        _soap_wsdl = {}
+        _soap_pid = os.getpid()
+    return _soap_session, _soap_wsdl
+
+
+def get_soap_client(url, token=False):
+    """Cliente zeep para `url` sobre la Session del proceso. El WSDL se
+    descarga y parsea solo la primera vez; `token` viaja como Cookie."""
+    with _soap_lock:
+        session, documentos = _soap_pool()
+        documento = documentos.get(url)
+        if documento is None:
+            transport = Transport(
+                cache=wsdl_cache(), timeout=10, session=session)
+            documento = Document(url, transport, settings=Settings())
+            documentos[url] = documento
+    settings = Settings()
+    if token:
+        settings.extra_http_headers = {'Cookie': 'TOKEN=' + token}
+    return Client(
+        documento,
+        transport=Transport(timeout=10, session=session),
+        settings=settings,
+        )
+
+
+def reset_soap_clients():
+    """Descarta WSDL parseados y la Session (por ejemplo si el SII cambia
+    un servicio)."""
+    global _soap_pid
+    with _soap_lock:
+        _soap_pid = None
+
+
+class CuerpoArchivo(io.RawIOBase):
+    """Cuerpo multipart que lee el archivo del envío por partes, para subir
+    sobres escritos en streaming sin cargarlos en memoria."""
+
+    def __init__(self, inicio, archivo, fin):
+        archivo.seek(0, 2)
+        self.largo = len(inicio) + archivo.tell() + len(fin)
+        archivo.seek(0)
+        self._partes = [io.BytesIO(inicio), archivo, io.BytesIO(fin)]
+        self._actual = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while self._actual < len(self._partes):
+            datos = self._partes[self._actual].read(len(b))
+            if datos:
+                b[:len(datos)] = datos
+                return len(datos)
+            self._actual += 1
+        return 0
+
+
+def cuerpo_multipart(params):
+    """Retorna (cuerpo, content_type, largo) del multipart de un envío. Si el
+    archivo es un objeto con read() (sobre en streaming) el cuerpo es un
+    CuerpoArchivo en vez de bytes."""
+    urllib3.filepost.writer = codecs.lookup('ISO-8859-1')[3]
+    file_name, archivo, content_type = params['archivo']
+    if not hasattr(archivo, 'read'):
+        body, content_type = urllib3.filepost.encode_multipart_formdata(params)
+        return body, content_type, len(body)
+    marca = b'\x00archivo\x00'
+    campos = dict(params)
+    campos['archivo'] = (file_name, marca, content_type)
+    body, content_type = urllib3.filepost.encode_multipart_formdata(campos)
+    inicio, fin = body.split(marca)
+    cuerpo = CuerpoArchivo(inicio, archivo, fin)
+    return cuerpo, content_type, cuerpo.largo
+
+
+def token_rechazado(respuesta):
+    """Detecta respuestas SOAP del SII por token vencido o inexistente."""
+    try:
+        resp = etree.XML(respuesta.replace(
+                '<?xml version="1.0" encoding="UTF-8"?>', '')\
+            .replace('SII:', '')\
+            .replace(' xmlns="http://www.sii.cl/XMLSchema"', ''))
+    except Exception:
+        return False
+    for tag in ['RESP_HDR/GLOSA_ESTADO', 'RESP_HDR/GLOSA']:
+        glosa = resp.find(tag)
+        if glosa is not None and 'TOKEN' in (glosa.text or '').upper():
+            return True
+    return False
+
+
 class Conexion(object):
 
-    def __init__(self, emisor=None, firma_electronica=None, api=False, token=None):
+    def __init__(self, emisor=None, firma_electronica=None, api=False,
+                 token=None, init_token=True):
         self.Emisor = emisor
         self.api = api
         if not self.Emisor:
@@ -90,6 +241,8 @@ class Conexion(object):
                 pass
         try:
             if not self.token:
+                self._token = get_token_cache().get(self.token_key)
+            if not self.token and init_token:
                 self.token = True
         except:
             pass
@@ -132,6 +285,15 @@ class Conexion(object):
     def Emisor(self, val):
         self._emisor = val
 
+    @property
+    def token_key(self):
+        return (
+            self.Emisor.RUTEmisor,
+            self.Emisor.Modo,
+            bool(self.api),
+            self.firma.rut_firmante,
+        )
+
     @property
     def seed(self):
         if not hasattr(self, '_seed') or not self._seed:
@@ -151,19 +313,17 @@ class Conexion(object):
         url = server_url[self.Emisor.Modo] + 'DTEWS/CrSeed.jws?WSDL'
         if self.api:
             url = api_url[self.Emisor.Modo] + 'boleta.electronica.semilla'
-            req = pool.request('GET', url, headers={
-                'Accept': "application/xml"})
+            with self._span('conexion.semilla'):
+                req = pool.request('GET', url, headers={
+                    'Accept': "application/xml"})
             resp = req.data.decode('UTF-8')
         else:
             _server = self._client(url)
-            intent = 0
-            resp = False
-            while intent < 10 and not resp:
-                intent += 1
-                try:
-                    resp = _server.service.getSeed()
-                except Exception as e:
-                    time.sleep(1)
+            with self._span('conexion.semilla'):
+                resp = reintentos.ejecutar(_server.service.getSeed, url)
+        self._leer_seed(resp)
+
+    def _leer_seed(self, resp):
         root = etree.fromstring(resp.replace(
                 '<?xml version="1.0" encoding="UTF-8"?>', ''))
         self._seed = root[0][0].text
@@ -183,23 +343,34 @@ class Conexion(object):
         if self.api:
             url = api_url[self.Emisor.Modo] + 'boleta.electronica.token'
             seed = '<?xml version="1.0" encoding="UTF-8"?>' + self.seed
-            req = pool.request('POST', url, body=seed, headers={
-                'Accept': "application/xml",
-                "Content-Type": "application/xml"})
+            with self._span('conexion.token'):
+                req = pool.request('POST', url, body=seed, headers={
+                    'Accept': "application/xml",
+                    "Content-Type": "application/xml"})
             resp = req.data.decode('UTF-8')
         else:
             _server = self._client(url)
-            intent = 0
-            resp = False
-            while intent < 10 and not resp:
-                intent += 1
-                try:
-                    resp = _server.service.getToken(self.seed)
-                except Exception as e:
-                    time.sleep(1)
+            seed = self.seed
+            with self._span('conexion.token'):
+                resp = reintentos.ejecutar(
+                    lambda: _server.service.getToken(seed), url)
+        self._leer_token(resp)
+
+    def _leer_token(self, resp):
         respuesta = etree.fromstring(resp.replace(
                 '<?xml version="1.0" encoding="UTF-8"?>', ''))
         self._token = respuesta[0][0].text
+        get_token_cache().set(self.token_key, self._token)
+
+    def renovar_token(self):
+        """Descarta el token actual (vencido o rechazado por el SII) y toma
+        uno vigente del cache o solicita uno nuevo."""
+        cache = get_token_cache()
+        cache.invalidate(self.token_key, self.token)
+        self._token = cache.get(self.token_key)
+        if not self._token:
+            self.token = True
+        return self.token
 
     def init_params(self):
         params = collections.OrderedDict()
@@ -212,9 +383,8 @@ class Conexion(object):
         params['dvCompany'] = self.Emisor.RUTEmisor[-1]
         return params
 
-    def send_xml_file(self, envio_dte=None, file_name="envio"):
-        if not self.token:
-            raise UserError("No hay Token")
+    def _envio_request(self, envio_dte, file_name):
+        """URL, campos multipart y headers para subir un envío."""
         base = server_url[self.Emisor.Modo]
         if self.api:
             base = api_url_envio[self.Emisor.Modo]
@@ -236,40 +406,47 @@ class Conexion(object):
         if self.api:
             headers['Accept'] = 'application/json'
         params = self.init_params()
+        if not hasattr(envio_dte, 'read'):
+            envio_dte = '<?xml version="1.0" encoding="ISO-8859-1"?>\n%s'\
+                    % envio_dte
         params['archivo'] = (
                     file_name,
-                    '<?xml version="1.0" encoding="ISO-8859-1"?>\n%s'\
-                    % envio_dte,
+                    envio_dte,
                     "text/xml")
-        urllib3.filepost.writer = codecs.lookup('ISO-8859-1')[3]
-        multi = urllib3.filepost.encode_multipart_formdata(params)
-        try:
-            headers.update({'Content-Length': '{}'.format(len(multi[0]))})
-            response = pool.request_encode_body(
-                                        'POST',
-                                        url,
-                                        params,
-                                        headers
-                                    )
-        except Exception as e:
-            _logger.warning("e %s" %str(e))
-            return {'status': 'NoEnviado', 'xml_resp': str(e)}
+        return url, params, headers
+
+    def _envio_sin_autenticar(self, status, data):
         if self.api:
-            resp = json.loads(response.data.decode('ISO-8859-1'))
+            return status == 401
+        if status != 200:
+            return False
+        code = etree.fromstring(data).find('STATUS')
+        return code is not None and code.text == '5'
+
+    def _procesar_envio(self, status, data):
+        if self.api:
+            if status != 200:
+                _logger.warning("HTTP %s en envío: %s" % (status, data[:200]))
+                return {
+                    'sii_xml_response': data,
+                    'status': 'NoEnviado',
+                    'sii_send_ident': '',
+                }
+            resp = json.loads(data.decode('ISO-8859-1'))
             return {
-                'sii_xml_response': response.data,
+                'sii_xml_response': data,
                 'status': util.estado_envio(resp.get('estado')),
                 'sii_send_ident': resp.get('trackid'),
                 'estado_sii': resp.get('estado'),
             }
         retorno = {
-                'sii_xml_response': response.data.decode(),
+                'sii_xml_response': data.decode(),
                 'status': 'NoEnviado',
                 'sii_send_ident': '',
                 }
-        if response.status != 200:
+        if status != 200:
             return retorno
-        respuesta_dict = etree.fromstring(response.data)
+        respuesta_dict = etree.fromstring(data)
         code = respuesta_dict.find('STATUS').text
         if code != '0':
             _logger.warning(connection_status[code])
@@ -282,7 +459,122 @@ class Conexion(object):
                 })
         return retorno
 
-    def consulta_estado_envio(self, track_id):
+    def send_xml_file(self, envio_dte=None, file_name="envio",
+                      reintentar_token=True):
+        if not self.token:
+            raise UserError("No hay Token")
+        url, params, headers = self._envio_request(envio_dte, file_name)
+        body, content_type, largo = cuerpo_multipart(params)
+        try:
+            headers.update({
+                'Content-Length': '{}'.format(largo),
+                'Content-Type': content_type,
+            })
+            with self._span('conexion.envio') as span:
+                span.bytes = largo
+                response = pool.request(
+                                            'POST',
+                                            url,
+                                            body=body,
+                                            headers=headers
+                                        )
+        except Exception as e:
+            _logger.warning("e %s" %str(e))
+            return {'status': 'NoEnviado', 'xml_resp': str(e)}
+        if reintentar_token and self._envio_sin_autenticar(
+                response.status, response.data):
+            self.renovar_token()
+            return self.send_xml_file(envio_dte, file_name, False)
+        return self._procesar_envio(response.status, response.data)
+
+    def _url_estado_envio_api(self, track_id):
+        rut = self.Emisor.RUTEmisor
+        return '{0}boleta.electronica.envio/{1}-{2}-{3}'.format(
+                        api_url[self.Emisor.Modo],
+                        rut[:-2],
+                        rut[-1],
+                        track_id
+                    )
+
+    def _headers_api(self):
+        return {
+            'Accept': 'application/json',
+            'Cookie': 'TOKEN={}'.format(self.token),
+        }
+
+    def _procesar_estado_envio_api(self, url, status, data, content_type=""):
+        raw = data or b""
+        text = raw.decode('ISO-8859-1', errors='replace')
+        self.sii_message = text
+
+        # Mantener compatibilidad con callers: retornamos "status" y adjuntamos detalle de error.
+        if status == 404:
+            return {
+                'status': 'Enviado',
+                'detalles': '',
+                'detalle_rep_rech': [],
+                'xml_resp': text,
+                'errores': [f"HTTP 404 (no encontrado) al consultar envío: {url}"],
+            }
+        if status != 200:
+            return {
+                'status': 'Enviado',
+                'detalles': '',
+                'detalle_rep_rech': [],
+                'xml_resp': text,
+                'errores': [f"HTTP {status} al consultar envío: {url}"],
+            }
+        if not raw:
+            return {
+                'status': 'Enviado',
+                'detalles': '',
+                'detalle_rep_rech': [],
+                'xml_resp': '',
+                'errores': [f"Respuesta vacía del SII al consultar envío: {url}"],
+            }
+        # A veces el SII responde 200 con solo espacios/saltos de línea.
+        # Eso no es JSON válido y antes terminaba en JSONDecodeError.
+        if not text.strip():
+            return {
+                'status': 'Enviado',
+                'detalles': '',
+                'detalle_rep_rech': [],
+                'xml_resp': text,
+                'errores': [f"Respuesta vacía (solo espacios) del SII al consultar envío: {url}"],
+            }
+
+        # SII debería responder JSON; si llega HTML u otro contenido, evitamos JSONDecodeError
+        content_type = (content_type or "").lower()
+        looks_json = ("application/json" in content_type) or text.lstrip().startswith(("{", "["))
+        if not looks_json:
+            preview = text.strip().replace("\n", " ")[:200]
+            return {
+                'status': 'Enviado',
+                'detalles': '',
+                'detalle_rep_rech': [],
+                'xml_resp': text,
+                'errores': [f"Respuesta no-JSON del SII (Content-Type='{content_type}'): {preview}"],
+            }
+
+        try:
+            resp = json.loads(text)
+        except Exception as e:
+            preview = text.strip().replace("\n", " ")[:200]
+            return {
+                'status': 'Enviado',
+                'detalles': '',
+                'detalle_rep_rech': [],
+                'xml_resp': text,
+                'errores': [f"Error parseando JSON del SII: {e}. Content-Type='{content_type}'. Preview: {preview}"],
+            }
+        return {
+            'status': util.estado_envio(resp.get('estado'), resp.get('estadistica')),
+            'detalles': resp.get('estadistica'),
+            'detalle_rep_rech': resp.get('detalle_rep_rech'),
+            'xml_resp': text,
+        }
+
+    def consulta_estado_envio(self, track_id, reintentar_token=True):
         resultado = {
             'status': 'Enviado',
             'xml_resp': '',
@@ -293,96 +585,23 @@ class Conexion(object):
             return resultado
         rut = self.Emisor.RUTEmisor
         if self.api:
-            url = '{0}boleta.electronica.envio/{1}-{2}-{3}'.format(
-                            api_url[self.Emisor.Modo],
-                            rut[:-2],
-                            rut[-1],
-                            track_id
-                        )
-            headers = {
-                'Accept': 'application/json',
-                'Cookie': 'TOKEN={}'.format(self.token),
-            }
+            url = self._url_estado_envio_api(track_id)
             try:
-                response = pool.request(
-                        'GET',
-                        url,
-                        headers=headers
-                    )
-                raw = response.data or b""
-                text = raw.decode('ISO-8859-1', errors='replace')
-                self.sii_message = text
-
-                # Mantener compatibilidad con callers: retornamos "status" y adjuntamos detalle de error.
-                if response.status == 404:
-                    return {
-                        'status': 'Enviado',
-                        'detalles': '',
-                        'detalle_rep_rech': [],
-                        'xml_resp': text,
-                        'errores': [f"HTTP 404 (no encontrado) al consultar envío: {url}"],
-                    }
-                if response.status != 200:
-                    return {
-                        'status': 'Enviado',
-                        'detalles': '',
-                        'detalle_rep_rech': [],
-                        'xml_resp': text,
-                        'errores': [f"HTTP {response.status} al consultar envío: {url}"],
-                    }
-                if not raw:
-                    return {
-                        'status': 'Enviado',
-                        'detalles': '',
-                        'detalle_rep_rech': [],
-                        'xml_resp': '',
-                        'errores': [f"Respuesta vacía del SII al consultar envío: {url}"],
-                    }
-                # A veces el SII responde 200 con solo espacios/saltos de línea.
-                # Eso no es JSON válido y antes terminaba en JSONDecodeError.
-                if not text.strip():
-                    return {
-                        'status': 'Enviado',
-                        'detalles': '',
-                        'detalle_rep_rech': [],
-                        'xml_resp': text,
-                        'errores': [f"Respuesta vacía (solo espacios) del SII al consultar envío: {url}"],
-                    }
-
-                # SII debería responder JSON; si llega HTML u otro contenido, evitamos JSONDecodeError
-                content_type = ""
-                try:
-                    content_type = (response.headers.get("Content-Type") or "").lower()
-                except Exception:
-                    content_type = ""
-                looks_json = ("application/json" in content_type) or text.lstrip().startswith(("{", "["))
-                if not looks_json:
-                    preview = text.strip().replace("\n", " ")[:200]
-                    return {
-                        'status': 'Enviado',
-                        'detalles': '',
-                        'detalle_rep_rech': [],
-                        'xml_resp': text,
-                        'errores': [f"Respuesta no-JSON del SII (Content-Type='{content_type}'): {preview}"],
-                    }
-
-                try:
-                    resp = json.loads(text)
-                except Exception as e:
-                    preview = text.strip().replace("\n", " ")[:200]
-                    return {
-                        'status': 'Enviado',
-                        'detalles': '',
-                        'detalle_rep_rech': [],
-                        'xml_resp': text,
-                        'errores': [f"Error parseando JSON del SII: {e}. Content-Type='{content_type}'. Preview: {preview}"],
-                    }
-                return {
-                    'status': util.estado_envio(resp.get('estado'), resp.get('estadistica')),
-                    'detalles': resp.get('estadistica'),
-                    'detalle_rep_rech': resp.get('detalle_rep_rech'),
-                    'xml_resp': text,
-                }
+                with self._span('conexion.estado_envio'):
+                    response = pool.request(
+                            'GET',
+                            url,
+                            headers=self._headers_api()
+                        )
+                if response.status == 401 and reintentar_token:
+                    self.renovar_token()
+                    return self.consulta_estado_envio(track_id, False)
+                return self._procesar_estado_envio_api(
+                    url,
+                    response.status,
+                    response.data,
+                    response.headers.get("Content-Type"),
+                )
             except Exception as e:
                 resultado['detalle_rep_rech'] = []
                 resultado['errores'].append(str(e))
@@ -395,29 +614,31 @@ class Conexion(object):
         except Exception as e:
             resultado['errores'].append(str(e))
             return resultado
-        intent = 0
-        respuesta = False
-        while intent < 10 and not respuesta:
-            intent += 1
-            try:
-                if self.cesion:
-                    respuesta = _server.service.getEstEnvio(
-                                self.token,
-                                track_id
-                            )
-                else:
-                    respuesta = _server.service.getEstUp(
-                                rut[:-2],
-                                str(rut[-1]),
-                                track_id,
-                                self.token
-                            )
-            except Exception as e:
-                time.sleep(1)
-                resultado['errores'].append(str(e))
+
+        def _consultar():
+            if self.cesion:
+                return _server.service.getEstEnvio(
+                            self.token,
+                            track_id
+                        )
+            return _server.service.getEstUp(
+                        rut[:-2],
+                        str(rut[-1]),
+                        track_id,
+                        self.token
+                    )
+        try:
+            with self._span('conexion.estado_envio'):
+                respuesta = reintentos.ejecutar(_consultar, url)
+        except Exception as e:
+            respuesta = False
+            resultado['errores'].append(str(e))
         if not respuesta:
             resultado['errores'].append("No se obtuvo respuesta")
             return resultado
+        if reintentar_token and token_rechazado(respuesta):
+            self.renovar_token()
+            return self.consulta_estado_envio(track_id, False)
         self.sii_message = respuesta
         return util.procesar_respuesta_envio(respuesta)
 
@@ -437,26 +658,53 @@ class Conexion(object):
         except Exception as e:
             resultado['errores'].append(str(e))
             return resultado
-        intent = 0
-        respuesta = False
-        while intent < 10 and not respuesta:
-            intent += 1
-            try:
-                respuesta = _server.service.reenvioCorreo(
-                    self.token,
-                    rut[:-2],
-                    str(rut[-1]),
-                    track_id,
-                )
-            except Exception as e:
-                time.sleep(1)
+        try:
+            with self._span('conexion.reenvio_correo'):
+                respuesta = reintentos.ejecutar(
+                    lambda: _server.service.reenvioCorreo(
+                        self.token,
+                        rut[:-2],
+                        str(rut[-1]),
+                        track_id,
+                    ),
+                    url)
+        except Exception as e:
+            respuesta = False
+            resultado['errores'].append(str(e))
         if not respuesta:
             resultado['errores'].append("No se obtuvo respuesta")
             return resultado
         self.sii_message = respuesta
         return util.procesar_respuesta_envio(respuesta)
 
-    def consulta_estado_dte(self, doc):
+    def _url_estado_dte_api(self, doc):
+        receptor = doc._receptor.RUTRecep
+        fecha = datetime.strptime(doc.FechaEmis, "%Y-%m-%d").strftime("%d-%m-%Y")
+        return '{0}boleta.electronica/{1}-{2}-{3}-{4}/estado?rut_receptor={5}&dv_receptor={6}&monto={7}&fechaEmision={8}'.format(
+                    api_url[self.Emisor.Modo],
+                    self.Emisor.RUTEmisor[:-2],
+                    self.Emisor.RUTEmisor[-1],
+                    doc.TipoDTE,
+                    doc.Folio,
+                    receptor[:-2],
+                    receptor[-1],
+                    doc.MntTotal,
+                    fecha,
+                )
+
+    def _procesar_estado_dte_api(self, status, data, resultado):
+        if status == 404:
+            resultado['detalle_rep_rech'] = []
+            resultado['errores'].append("404 error")
+            return resultado
+        resp = json.loads(data.decode('ISO-8859-1'))
+        return {
+            'glosa': resp['descripcion'],
+            'status': util.estado_documento(resp['codigo']),
+            'xml_resp': data.decode('ISO-8859-1'),
+        }
+
+    def consulta_estado_dte(self, doc, reintentar_token=True):
         resultado = {
             'status': 'Enviado',
             'xml_resp': '',
@@ -468,36 +716,17 @@ class Conexion(object):
         receptor = doc._receptor.RUTRecep
         fecha = datetime.strptime(doc.FechaEmis, "%Y-%m-%d").strftime("%d-%m-%Y")
         if self.api:
-            url = '{0}boleta.electronica/{1}-{2}-{3}-{4}/estado?rut_receptor={5}&dv_receptor={6}&monto={7}&fechaEmision={8}'.format(
-                        api_url[self.Emisor.Modo],
-                        self.Emisor.RUTEmisor[:-2],
-                        self.Emisor.RUTEmisor[-1],
-                        doc.TipoDTE,
-                        doc.Folio,
-                        receptor[:-2],
-                        receptor[-1],
-                        doc.MntTotal,
-                        fecha,
+            with self._span('conexion.estado_dte'):
+                response = pool.request(
+                        'GET',
+                        self._url_estado_dte_api(doc),
+                        headers=self._headers_api()
                     )
-            headers = {
-                'Accept': 'application/json',
-                'Cookie': 'TOKEN={}'.format(self.token),
-            }
-            response = pool.request(
-                    'GET',
-                    url,
-                    headers=headers
-                )
-            if response.status == 404:
-                resultado['detalle_rep_rech'] = []
-                resultado['errores'].append("404 error")
-                return resultado
-            resp = json.loads(response.data.decode('ISO-8859-1'))
-            return {
-                'glosa': resp['descripcion'],
-                'status': util.estado_documento(resp['codigo']),
-                'xml_resp': response.data.decode('ISO-8859-1'),
-            }
+            if response.status == 401 and reintentar_token:
+                self.renovar_token()
+                return self.consulta_estado_dte(doc, False)
+            return self._procesar_estado_dte_api(
+                response.status, response.data, resultado)
         url = server_url[self.Emisor.Modo] + 'DTEWS/QueryEstDte.jws?WSDL'
         if self.cesion:
             url = server_url[self.Emisor.Modo] + 'DTEWS/services/wsRPETCConsulta?wsdl'
@@ -507,43 +736,45 @@ class Conexion(object):
             resultado['errores'].append(str(e))
             return resultado
         rut = self.firma.rut_firmante
-        intent = 0
-        respuesta = False
-        while intent < 10 and not respuesta:
-            intent += 1
-            try:
-                if self.cesion:
-                    """ Consulta para Emitidas. Se debe obtener IdCesion, para consulta avanzada """
-                    respuesta = _server.service.getEstCesion(
-                        self.token,
-                        self.Emisor.RUTEmisor[:-2],
-                        str(self.Emisor.RUTEmisor[-1]),
-                        str(doc.TipoDTE),
-                        str(doc.Folio),
-                        doc.IdCesion,
-                    )
-                else:
-                    respuesta = _server.service.getEstDte(
-                        rut[:-2],
-                        str(rut[-1]),
-                        self.Emisor.RUTEmisor[:-2],
-                        str(self.Emisor.RUTEmisor[-1]),
-                        receptor[:-2],
-                        str(receptor[-1]),
-                        str(doc.TipoDTE),
-                        str(doc.Folio),
-                        fecha,
-                        str(doc.MntTotal),
-                        self.token
-                    )
-            except Exception as e:
-                time.sleep(1)
-                if intent == 10:
-                    _logger.warning("error en consulta", exc_info=True)
+
+        def _consultar():
+            if self.cesion:
+                """ Consulta para Emitidas. Se debe obtener IdCesion, para consulta avanzada """
+                return _server.service.getEstCesion(
+                    self.token,
+                    self.Emisor.RUTEmisor[:-2],
+                    str(self.Emisor.RUTEmisor[-1]),
+                    str(doc.TipoDTE),
+                    str(doc.Folio),
+                    doc.IdCesion,
+                )
+            return _server.service.getEstDte(
+                rut[:-2],
+                str(rut[-1]),
+                self.Emisor.RUTEmisor[:-2],
+                str(self.Emisor.RUTEmisor[-1]),
+                receptor[:-2],
+                str(receptor[-1]),
+                str(doc.TipoDTE),
+                str(doc.Folio),
+                fecha,
+                str(doc.MntTotal),
+                self.token
+            )
+        try:
+            with self._span('conexion.estado_dte'):
+                respuesta = reintentos.ejecutar(_consultar, url)
+        except Exception as e:
+            respuesta = False
+            resultado['errores'].append(str(e))
+            _logger.warning("error en consulta", exc_info=True)
         if not respuesta:
             resultado['detalle_rep_rech'] = []
             resultado['errores'].append("No se pudo obtener estado DTE")
             return resultado
+        if reintentar_token and token_rechazado(respuesta):
+            self.renovar_token()
+            return self.consulta_estado_dte(doc, False)
         return util.procesar_respuesta_dte(respuesta, self.cesion)
 
     def consulta_estado_cesion_relac(self, doc):
@@ -563,24 +794,23 @@ class Conexion(object):
             resultado['errores'].append(str(e))
             return resultado
         rut = doc.Emisor.RUTEmisor
-        intent = 0
-        respuesta = False
-        while intent < 10 and not respuesta:
-            intent += 1
-            try:
-                respuesta = _server.service.getEstCesionRelac(
-                    self.token,
-                    rut[:-2],
-                    str(rut[-1]),
-                    str(doc.TipoDTE),
-                    str(doc.Folio),
-                    doc._receptor.RUTRecep[:-2],
-                    doc._receptor.RUTRecep[-1]
-                )
-            except Exception as e:
-                time.sleep(1)
-                if intent == 10:
-                    _logger.warning("error en consulta", exc_info=True)
+        try:
+            with self._span('conexion.estado_cesion_relac'):
+                respuesta = reintentos.ejecutar(
+                    lambda: _server.service.getEstCesionRelac(
+                        self.token,
+                        rut[:-2],
+                        str(rut[-1]),
+                        str(doc.TipoDTE),
+                        str(doc.Folio),
+                        doc._receptor.RUTRecep[:-2],
+                        doc._receptor.RUTRecep[-1]
+                    ),
+                    url)
+        except Exception as e:
+            respuesta = False
+            resultado['errores'].append(str(e))
+            _logger.warning("error en consulta", exc_info=True)
         if not respuesta:
             resultado['detalle_rep_rech'] = []
             resultado['errores'].append("No se pudo obtener estado cesion DTE relac")
@@ -596,14 +826,15 @@ class Conexion(object):
         self.seed_file = msg
 
     def _client(self, url, use_token=False):
-        session = Session()
-        if use_token:
-            session.headers['Cookie'] = 'TOKEN=' + self.token
-        transport = Transport(timeout=10, session=session)
-        return Client(
-            url,
-            transport=transport
-            )
+        token = self.token if use_token else False
+        with self._span('conexion.cliente_soap'):
+            return reintentos.ejecutar(
+                lambda: get_soap_client(url, token), url,
+                reintentar_vacio=False)
+
+    def _span(self, etapa):
+        return instrumentacion.span(
+            etapa, servicio='api' if self.api else 'soap')
 
     def set_dte_claim(self, doc):
         resultado = {
@@ -620,22 +851,21 @@ class Conexion(object):
         except Exception as e:
             resultado['errores'].append(str(e))
             return resultado
-        intent = 0
-        respuesta = False
-        while intent < 10 and not respuesta:
-            intent += 1
-            try:
-                respuesta = _server.service.ingresarAceptacionReclamoDoc(
-                    doc['RUTEmisor'][:-2],
-                    str(doc['RUTEmisor'][-1]),
-                    str(doc['TipoDTE']),
-                    str(doc['Folio']),
-                    doc['Claim']
-                )
-            except Exception as e:
-                time.sleep(1)
-                if intent == 10:
-                    _logger.warning("error en set claim", exc_info=True)
+        try:
+            with self._span('conexion.set_claim'):
+                respuesta = reintentos.ejecutar(
+                    lambda: _server.service.ingresarAceptacionReclamoDoc(
+                        doc['RUTEmisor'][:-2],
+                        str(doc['RUTEmisor'][-1]),
+                        str(doc['TipoDTE']),
+                        str(doc['Folio']),
+                        doc['Claim']
+                    ),
+                    url)
+        except Exception as e:
+            respuesta = False
+            resultado['errores'].append(str(e))
+            _logger.warning("error en set claim", exc_info=True)
         resultado['respuesta'] = respuesta
         return resultado
 
@@ -654,19 +884,18 @@ class Conexion(object):
         except Exception as e:
             resultado['errores'].append(str(e))
             return resultado
-        intent = 0
-        respuesta = False
-        while intent < 10 and not respuesta:
-            intent += 1
-            try:
-                respuesta = _server.service.listarEventosHistDoc(
-                    doc['RUTEmisor'][:-2],
-                    str(doc['RUTEmisor'][-1]),
-                    str(doc['TipoDTE']),
-                    str(doc['Folio']),)
-            except Exception as e:
-                time.sleep(1)
-                if intent == 10:
-                    _logger.warning("error en get claim", exc_info=True)
+        try:
+            with self._span('conexion.get_claim'):
+                respuesta = reintentos.ejecutar(
+                    lambda: _server.service.listarEventosHistDoc(
+                        doc['RUTEmisor'][:-2],
+                        str(doc['RUTEmisor'][-1]),
+                        str(doc['TipoDTE']),
+                        str(doc['Folio']),),
+                    url)
+        except Exception as e:
+            respuesta = False
+            resultado['errores'].append(str(e))
+            _logger.warning("error en get claim", exc_info=True)
         resultado['respuesta'] = respuesta
         return resultado
@@ -0,0 +1,295 @@
+# -#- coding: utf-8 -#-
+"""
+Contraparte asíncrona de Conexion, para consultar miles de envíos o DTE en
+paralelo (por ejemplo la conciliación nocturna de boletas).
+
+Las llamadas HTTP (API boletas y DTEUpload) usan aiohttp si está instalado;
+si no, corren sobre el PoolManager de conexion en hilos (asyncio.to_thread).
+Los servicios SOAP (zeep) siempre corren en hilos, sobre el pool de clientes
+de conexion. Las respuestas se procesan con los mismos métodos de Conexion.
+
+    async with AsyncConexion(emisor, firma, api=True) as conn:
+        resultados = await gather_limitado(
+            [conn.consulta_estado_envio(t) for t in track_ids], limite=50)
+
+Para el estado de muchos DTE, consulta_estados_dte entrega (DTE.ID,
+resultado) a medida que llegan, con concurrencia y tasa acotadas:
+
+    async for id_dte, resultado in conn.consulta_estados_dte(docs):
+        ...
+"""
+import asyncio
+import os
+from facturacion_electronica.conexion import (
+    Conexion,
+    UserError,
+    api_url,
+    cuerpo_multipart,
+    pool,
+)
+from facturacion_electronica.token_cache import get_token_cache
+
+import logging
+_logger = logging.getLogger(__name__)
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+
+async def gather_limitado(coros, limite=20, return_exceptions=True):
+    """asyncio.gather con a lo más `limite` corrutinas en curso. Mantiene el
+    orden de entrada en los resultados."""
+    semaforo = asyncio.Semaphore(limite)
+
+    async def _correr(coro):
+        async with semaforo:
+            return await coro
+
+    return await asyncio.gather(
+        *[_correr(c) for c in coros],
+        return_exceptions=return_exceptions,
+    )
+
+
+class LimiteTasa(object):
+    """Espacia las llamadas para no superar `por_segundo` (0 = sin límite).
+    Se usa dentro de un solo event loop."""
+
+    def __init__(self, por_segundo=0):
+        por_segundo = float(por_segundo or 0)
+        self.intervalo = 1.0 / por_segundo if por_segundo > 0 else 0
+        self._proxima = 0
+
+    async def esperar(self):
+        if not self.intervalo:
+            return
+        ahora = asyncio.get_running_loop().time()
+        turno = max(ahora, self._proxima)
+        self._proxima = turno + self.intervalo
+        if turno > ahora:
+            await asyncio.sleep(turno - ahora)
+
+
+class AsyncConexion(object):
+
+    def __init__(self, emisor=None, firma_electronica=None, api=False,
+                 token=None, limite=20):
+        self.conexion = Conexion(
+            emisor, firma_electronica, api, token=token, init_token=False)
+        self.limite = limite
+        self._session = None
+        self._token_lock = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    @property
+    def api(self):
+        return self.conexion.api
+
+    @property
+    def cesion(self):
+        return self.conexion.cesion
+
+    @cesion.setter
+    def cesion(self, val):
+        self.conexion.cesion = val
+
+    @property
+    def token(self):
+        return self.conexion.token
+
+    @property
+    def session(self):
+        if self._session is None:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.limite),
+                timeout=aiohttp.ClientTimeout(total=30),
+            )
+        return self._session
+
+    async def _request(self, method, url, body=None, headers=None):
+        """Retorna (status, data, content_type)."""
+        if aiohttp is None:
+            response = await asyncio.to_thread(
+                pool.request, method, url, body=body, headers=headers)
+            return (response.status, response.data,
+                    response.headers.get('Content-Type'))
+        async with self.session.request(
+                method, url, data=body, headers=headers) as response:
+            data = await response.read()
+            return (response.status, data,
+                    response.headers.get('Content-Type'))
+
+    async def obtener_token(self, rechazado=None):
+        """Token vigente (cache o nuevo). Con `rechazado`, descarta ese token
+        salvo que otra corrutina ya lo haya renovado."""
+        conexion = self.conexion
+        if self._token_lock is None:
+            self._token_lock = asyncio.Lock()
+        async with self._token_lock:
+            cache = get_token_cache()
+            if rechazado and conexion.token == rechazado:
+                cache.invalidate(conexion.token_key, rechazado)
+                conexion._token = False
+            if not conexion.token:
+                conexion._token = cache.get(conexion.token_key)
+            if conexion.token:
+                return conexion.token
+            if not conexion.api:
+                await asyncio.to_thread(setattr, conexion, 'token', True)
+                return conexion.token
+            modo = conexion.Emisor.Modo
+            status, data, ct = await self._request(
+                'GET',
+                api_url[modo] + 'boleta.electronica.semilla',
+                headers={'Accept': "application/xml"},
+            )
+            conexion._leer_seed(data.decode('UTF-8'))
+            seed = '<?xml version="1.0" encoding="UTF-8"?>' + conexion.seed
+            status, data, ct = await self._request(
+                'POST',
+                api_url[modo] + 'boleta.electronica.token',
+                body=seed.encode('UTF-8'),
+                headers={
+                    'Accept': "application/xml",
+                    "Content-Type": "application/xml"},
+            )
+            conexion._leer_token(data.decode('UTF-8'))
+            return conexion.token
+
+    async def send_xml_file(self, envio_dte=None, file_name="envio",
+                            reintentar_token=True):
+        conexion = self.conexion
+        token = await self.obtener_token()
+        if not token:
+            raise UserError("No hay Token")
+        url, params, headers = conexion._envio_request(envio_dte, file_name)
+        body, content_type, largo = cuerpo_multipart(params)
+        headers.update({
+            'Content-Length': '{}'.format(largo),
+            'Content-Type': content_type,
+        })
+        try:
+            status, data, ct = await self._request('POST', url, body, headers)
+        except Exception as e:
+            _logger.warning("e %s" %str(e))
+            return {'status': 'NoEnviado', 'xml_resp': str(e)}
+        if reintentar_token and conexion._envio_sin_autenticar(status, data):
+            await self.obtener_token(token)
+            return await self.send_xml_file(envio_dte, file_name, False)
+        return conexion._procesar_envio(status, data)
+
+    async def consulta_estado_envio(self, track_id, reintentar_token=True):
+        conexion = self.conexion
+        resultado = {
+            'status': 'Enviado',
+            'xml_resp': '',
+            'errores': []
+        }
+        try:
+            token = await self.obtener_token()
+        except Exception as e:
+            resultado['errores'].append(str(e))
+            return resultado
+        if not token:
+            resultado['errores'].append("No hay Token en consulta envío")
+            return resultado
+        if not conexion.api:
+            return await asyncio.to_thread(
+                conexion.consulta_estado_envio, track_id)
+        url = conexion._url_estado_envio_api(track_id)
+        try:
+            status, data, ct = await self._request(
+                'GET', url, headers=conexion._headers_api())
+            if status == 401 and reintentar_token:
+                await self.obtener_token(token)
+                return await self.consulta_estado_envio(track_id, False)
+            return conexion._procesar_estado_envio_api(url, status, data, ct)
+        except Exception as e:
+            resultado['detalle_rep_rech'] = []
+            resultado['errores'].append(str(e))
+            return resultado
+
+    async def consulta_estado_dte(self, doc, reintentar_token=True):
+        conexion = self.conexion
+        resultado = {
+            'status': 'Enviado',
+            'xml_resp': '',
+            'errores': []
+        }
+        try:
+            token = await self.obtener_token()
+        except Exception as e:
+            resultado['errores'].append(str(e))
+            return resultado
+        if not token:
+            resultado['errores'].append("No hay Token en consulta DTE")
+            return resultado
+        if not conexion.api:
+            return await asyncio.to_thread(conexion.consulta_estado_dte, doc)
+        status, data, ct = await self._request(
+            'GET',
+            conexion._url_estado_dte_api(doc),
+            headers=conexion._headers_api(),
+        )
+        if status == 401 and reintentar_token:
+            await self.obtener_token(token)
+            return await self.consulta_estado_dte(doc, False)
+        return conexion._procesar_estado_dte_api(status, data, resultado)
+
+    async def _consulta_estado_dte_lote(self, doc, tasa):
+        await tasa.esperar()
+        try:
+            resultado = await self.consulta_estado_dte(doc)
+        except Exception as e:
+            _logger.warning("error en consulta %s" % doc.ID, exc_info=True)
+            resultado = {
+                'status': 'Enviado',
+                'xml_resp': '',
+                'detalle_rep_rech': [],
+                'errores': [str(e)],
+            }
+        return doc.ID, resultado
+
+    async def consulta_estados_dte(self, docs, limite=None, por_segundo=None):
+        """Consulta el estado de cada documento de `docs` (iterable, se
+        consume a medida que se avanza) con la misma sesión y token. Hay a lo
+        más `limite` consultas en curso (SII_CONSULTA_CONCURRENCIA, por
+        defecto el límite de la conexión) y se inician a lo más `por_segundo`
+        por segundo (SII_CONSULTA_POR_SEGUNDO, por defecto 20, 0 = sin
+        límite). Entrega (DTE.ID, resultado) en el orden en que llegan."""
+        if limite is None:
+            limite = os.environ.get('SII_CONSULTA_CONCURRENCIA') or self.limite
+        if por_segundo is None:
+            por_segundo = os.environ.get('SII_CONSULTA_POR_SEGUNDO') or 20
+        limite = max(1, int(limite))
+        tasa = LimiteTasa(por_segundo)
+        docs = iter(docs)
+        pendientes = set()
+        try:
+            while True:
+                for doc in docs:
+                    pendientes.add(asyncio.ensure_future(
+                        self._consulta_estado_dte_lote(doc, tasa)))
+                    if len(pendientes) >= limite:
+                        break
+                if not pendientes:
+                    return
+                listos, pendientes = await asyncio.wait(
+                    pendientes, return_when=asyncio.FIRST_COMPLETED)
+                for tarea in listos:
+                    yield tarea.result()
+        finally:
+            for tarea in pendientes:
+                tarea.cancel()
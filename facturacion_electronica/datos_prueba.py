@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+"""
+Datos sintéticos para pruebas y benchmarks: certificado PFX autofirmado, CAF
+generado (con su propia llave RSA) y payloads de Documento variados (cantidad
+de líneas, líneas exentas, descuentos globales y referencias). Nada de esto
+sirve ante el SII: solo contra el SII local (sii_mock) o sin envío.
+
+    data = payload_sintetico(200, tipos=[39, 33])
+    envio = Envio(data)
+"""
+import base64
+import datetime
+import random
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.hazmat.primitives.serialization import pkcs12
+from cryptography.x509.oid import NameOID
+
+
+RUT_EMISOR = '76387093-6'
+RUT_FIRMANTE = '11111111-1'
+PASSWORD = b'prueba'
+
+
+def certificado_prueba(rut=RUT_FIRMANTE, password=PASSWORD):
+    """PFX autofirmado en base64, como 'string_firma' de firma_electronica."""
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    nombre = x509.Name([
+        x509.NameAttribute(NameOID.COMMON_NAME, 'Firmante Prueba'),
+        x509.NameAttribute(NameOID.SERIAL_NUMBER, rut),
+    ])
+    desde = datetime.datetime(2024, 1, 1)
+    cert = x509.CertificateBuilder().subject_name(nombre).issuer_name(
+        nombre).public_key(key.public_key()).serial_number(1)\
+        .not_valid_before(desde)\
+        .not_valid_after(desde + datetime.timedelta(days=3650))\
+        .sign(key, hashes.SHA256())
+    return base64.b64encode(pkcs12.serialize_key_and_certificates(
+        b'prueba', key, cert, None,
+        serialization.BestAvailableEncryption(password))).decode()
+
+
+def caf_prueba(rut=RUT_EMISOR, tipo=39, desde=1, hasta=1000):
+    """CAF en base64 (como 'caf_file') con una llave RSA de 512 bits propia;
+    su FRMA no es del SII."""
+    key = rsa.generate_private_key(public_exponent=65537, key_size=512)
+    pem = key.private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.TraditionalOpenSSL,
+        serialization.NoEncryption()).decode()
+    modulo = base64.b64encode(
+        key.public_key().public_numbers().n.to_bytes(64, 'big')).decode()
+    caf = (
+        '<?xml version="1.0"?>\n<AUTORIZACION>\n<CAF version="1.0">\n<DA>\n'
+        '<RE>%s</RE>\n<RS>EMPRESA PRUEBA</RS>\n<TD>%s</TD>\n'
+        '<RNG><D>%s</D><H>%s</H></RNG>\n<FA>2024-01-01</FA>\n'
+        '<RSAPK><M>%s</M><E>AQAB</E></RSAPK>\n<IDK>100</IDK>\n</DA>\n'
+        '<FRMA algoritmo="SHA1withRSA">cHJ1ZWJh</FRMA>\n</CAF>\n'
+        '<RSASK>%s</RSASK>\n<RSAPUBK>x</RSAPUBK>\n</AUTORIZACION>\n') % (
+            rut, tipo, desde, hasta, modulo, pem)
+    return base64.b64encode(caf.encode('ISO-8859-1')).decode()
+
+
+def _linea(azar, i, exenta):
+    linea = {
+        'NmbItem': 'Producto %s Ñandú & <%s>' % (i, azar.randint(1, 999)),
+        'QtyItem': azar.randint(1, 12),
+        'UnmdItem': 'UN',
+        'PrcItem': azar.randint(100, 250000),
+    }
+    if azar.random() < 0.2:
+        linea['DscItem'] = 'Descripción del producto %s' % i
+    if exenta:
+        linea['IndExe'] = 1
+    else:
+        linea['Impuesto'] = [{
+            'CodImp': 14, 'price_include': True, 'TasaImp': 19.0}]
+    return linea
+
+
+def documentos_sinteticos(n, tipo=39, folio=1, lineas=(1, 20), semilla=0):
+    """`n` documentos con folios correlativos desde `folio`. La cantidad de
+    líneas varía en el rango `lineas`; algunas líneas son exentas, uno de
+    cada cinco documentos lleva descuento global y uno de cada cuatro una
+    referencia."""
+    azar = random.Random(semilla)
+    boleta = tipo in [39, 41]
+    documentos = []
+    for i in range(n):
+        detalle = [
+            _linea(azar, j + 1, azar.random() < 0.15)
+            for j in range(azar.randint(*lineas))]
+        if all(linea.get('IndExe') for linea in detalle):
+            detalle[0] = _linea(azar, 1, False)
+        receptor = {
+            'RUTRecep': '66666666-6',
+            'RznSocRecep': 'Cliente Prueba %s' % i,
+            'DirRecep': 'Santiago',
+            'CmnaRecep': 'Santiago',
+        }
+        if not boleta:
+            receptor.update({
+                'RUTRecep': '76086428-5',
+                'GiroRecep': 'Comercio',
+                'CiudadRecep': 'Santiago',
+            })
+        doc = {
+            'NroDTE': i + 1,
+            'Encabezado': {
+                'IdDoc': {
+                    'Folio': folio + i,
+                    'FchEmis': '2025-01-01',
+                },
+                'Receptor': receptor,
+            },
+            'Detalle': detalle,
+        }
+        if boleta:
+            doc['IndServicio'] = 3
+        else:
+            doc['Encabezado']['IdDoc']['FmaPago'] = 1
+        if i % 5 == 4:
+            doc['DscRcgGlobal'] = [{
+                'TpoMov': 'D',
+                'GlosaDR': 'Descuento global',
+                'TpoValor': '%',
+                'ValorDR': azar.choice([5, 10, 15]),
+            }]
+        if i % 4 == 3:
+            referencia = {'NroLinRef': 1, 'RazonRef': 'Pedido %s' % i}
+            if not boleta:
+                referencia.update({
+                    'TpoDocRef': '801',
+                    'FolioRef': str(1000 + i),
+                    'FchRef': '2025-01-01',
+                })
+            doc['Referencia'] = [referencia]
+        documentos.append(doc)
+    return documentos
+
+
+def payload_sintetico(n, tipos=(39,), lineas=(1, 20), semilla=0,
+                      firma=None, test=True, modo='certificacion'):
+    """Payload completo para Envio / timbrar_y_enviar con `n` documentos por
+    tipo, cada tipo con su CAF. `firma` permite reutilizar un PFX ya
+    generado (certificado_prueba tarda en crear la llave)."""
+    documento = []
+    for tipo in tipos:
+        documento.append({
+            'TipoDTE': tipo,
+            'caf_file': [caf_prueba(RUT_EMISOR, tipo, 1, max(n, 1000))],
+            'documentos': documentos_sinteticos(
+                n, tipo, 1, lineas, semilla + tipo),
+        })
+    return {
+        'test': test,
+        'verify': True,
+        'ID': 'SetDoc',
+        'Emisor': {
+            'RUTEmisor': RUT_EMISOR,
+            'RznSoc': 'EMPRESA PRUEBA',
+            'GiroEmis': 'GIRO DE PRUEBA',
+            'Actecos': [620200],
+            'DirOrigen': 'DIRECCION 123',
+            'CmnaOrigen': 'SANTIAGO',
+            'CiudadOrigen': 'SANTIAGO',
+            'Modo': modo,
+            'NroResol': 0,
+            'FchResol': '2018-07-18',
+            'ValorIva': 19,
+        },
+        'firma_electronica': {
+            'init_signature': True,
+            'string_password': PASSWORD,
+            'string_firma': firma or certificado_prueba(),
+            'rut_firmante': RUT_FIRMANTE,
+        },
+        'Documento': documento,
+    }
@@ -1240,6 +1240,8 @@ llevar estrictamente las palabras Dice: y debe decir:')
     @property
     def sii_barcode_img(self):
         if not hasattr(self, '_sii_barcode_img'):
+            if self.barcode_render == 'lazy' and self.sii_barcode:
+                return self.render_barcode()
             return False
         return self._sii_barcode_img
 
@@ -6,8 +6,39 @@ import collections
 
 
 class LineaDetalle(object):
+    # None: campo no informado (el getter entrega su valor por defecto).
+    _defaults = {
+        'uom_id': False,
+        '_valor_iva': 19,
+        '_cod_imp_adic': None,
+        '_cdgs': None,
+        '_dsc_item': None,
+        '_dcto_otr_mnda': False,
+        '_descuento_monto': 0.0,
+        '_descuento_pct': 0.0,
+        '_fct_conv': False,
+        '_ind_exe': False,
+        '_impuestos': None,
+        '_moneda': False,
+        '_moneda_decimales': 0,
+        '_monto_item': 0,
+        '_monto_item_otr_mnda': 0,
+        '_name': None,
+        '_no_product': False,
+        '_nro_lin_det': 1,
+        '_prc_item': False,
+        '_prc_otr_mon': None,
+        '_qty_item': 0,
+        '_recargo_otr_mnda': False,
+        '_recargo_monto': 0.0,
+        '_recargo_pct': 0.0,
+        '_tpo_doc_liq': False,
+        '_unidad_item': None,
+    }
+    __slots__ = tuple(_defaults)
 
     def __init__(self, vals, valor_iva=19, NroLinDet=1):
+        util.set_defaults(self)
         self._valor_iva = valor_iva
         util.set_from_keys(self, vals, priorizar=['moneda_decimales', 'PrcItem', 'QtyItem', 'DscItem'])
         if not vals.get('Impuesto'):
@@ -17,7 +48,7 @@ class LineaDetalle(object):
 
     @property
     def CodImpAdic(self):
-        if not hasattr(self, '_cod_imp_adic'):
+        if self._cod_imp_adic is None:
             return []
         return self._cod_imp_adic
 
@@ -27,7 +58,7 @@ class LineaDetalle(object):
 
     @property
     def CdgItem(self):
-        if not hasattr(self, '_cdgs'):
+        if self._cdgs is None:
             return []
         cdg_items = []
         for cdg in self._cdgs:
@@ -39,7 +70,7 @@ class LineaDetalle(object):
 
     @CdgItem.setter
     def CdgItem(self, cdgs):
-        if not hasattr(self, '_cdgs'):
+        if self._cdgs is None:
             self._cdgs = []
         if type(cdgs) is dict:
             self.no_product = cdgs.get('VlrCodigo') == 'NO_PRODUCT'
@@ -51,7 +82,7 @@ class LineaDetalle(object):
 
     @property
     def DscItem(self):
-        if not hasattr(self, '_dsc_item'):
+        if self._dsc_item is None:
             return False
         return self._dsc_item[:1000]
 
@@ -61,8 +92,6 @@ class LineaDetalle(object):
 
     @property
     def DctoOtrMnda(self):
-        if not hasattr(self, '_dcto_otr_mnda'):
-            return False
         return self._dcto_otr_mnda
 
     @DctoOtrMnda.setter
@@ -73,8 +102,6 @@ class LineaDetalle(object):
 
     @property
     def DescuentoMonto(self):
-        if not hasattr(self, '_descuento_monto'):
-            return 0.0
         return self._descuento_monto
 
     @DescuentoMonto.setter
@@ -86,8 +113,6 @@ class LineaDetalle(object):
 
     @property
     def DescuentoPct(self):
-        if not hasattr(self, '_descuento_pct'):
-            return 0.0
         return self._descuento_pct
 
     @DescuentoPct.setter
@@ -98,8 +123,6 @@ class LineaDetalle(object):
 
     @property
     def FctConv(self):
-        if not hasattr(self, '_fct_conv'):
-            return False
         return self._fct_conv
 
     @FctConv.setter
@@ -108,8 +131,6 @@ class LineaDetalle(object):
 
     @property
     def IndExe(self):
-        if not hasattr(self, '_ind_exe'):
-            return False
         return self._ind_exe
 
     '''
@@ -126,7 +147,7 @@ class LineaDetalle(object):
 
     @property
     def Impuesto(self):
-        if not hasattr(self, '_impuestos'):
+        if self._impuestos is None:
             return []
         return self._impuestos
 
@@ -157,8 +178,6 @@ class LineaDetalle(object):
 
     @property
     def Moneda(self):
-        if not hasattr(self, '_moneda'):
-            return False
         return self._moneda
 
     @Moneda.setter
@@ -167,8 +186,6 @@ class LineaDetalle(object):
 
     @property
     def moneda_decimales(self):
-        if not hasattr(self, '_moneda_decimales'):
-            return 0
         return self._moneda_decimales
 
     @moneda_decimales.setter
@@ -177,8 +194,6 @@ class LineaDetalle(object):
 
     @property
     def MontoItem(self):
-        if not hasattr(self, '_monto_item'):
-            return 0
         return self._monto_item
 
     @MontoItem.setter
@@ -189,8 +204,6 @@ class LineaDetalle(object):
 
     @property
     def MontoItemOtrMnda(self):
-        if not hasattr(self, '_monto_item_otr_mnda'):
-            return 0
         return self._monto_item_otr_mnda
 
     @MontoItemOtrMnda.setter
@@ -201,7 +214,7 @@ class LineaDetalle(object):
 
     @property
     def NmbItem(self):
-        if not hasattr(self, '_name'):
+        if self._name is None:
             dsc = self.DscItem or ''
         else:
             dsc = self._name
@@ -213,8 +226,6 @@ class LineaDetalle(object):
 
     @property
     def no_product(self):
-        if not hasattr(self, '_no_product'):
-            return False
         return self._no_product
 
     @no_product.setter
@@ -223,8 +234,6 @@ class LineaDetalle(object):
 
     @property
     def NroLinDet(self):
-        if not hasattr(self, '_nro_lin_det'):
-            return 1
         return self._nro_lin_det
 
     @NroLinDet.setter
@@ -252,8 +261,6 @@ class LineaDetalle(object):
 
     @property
     def PrcItem(self):
-        if not hasattr(self, '_prc_item'):
-            return False
         return self._prc_item
 
     @PrcItem.setter
@@ -265,7 +272,7 @@ class LineaDetalle(object):
 
     @property
     def PrcOtrMon(self):
-        if not hasattr(self, '_prc_otr_mon'):
+        if self._prc_otr_mon is None:
             return False
         return round(self._prc_otr_mon, 4)
 
@@ -275,8 +282,6 @@ class LineaDetalle(object):
 
     @property
     def QtyItem(self):
-        if not hasattr(self, '_qty_item'):
-            return 0
         return self._qty_item
 
     @QtyItem.setter
@@ -288,8 +293,6 @@ class LineaDetalle(object):
 
     @property
     def RecargoOtrMnda(self):
-        if not hasattr(self, '_recargo_otr_mnda'):
-            return False
         return self._recargo_otr_mnda
 
     @RecargoOtrMnda.setter
@@ -298,8 +301,6 @@ class LineaDetalle(object):
 
     @property
     def RecargoMonto(self):
-        if not hasattr(self, '_recargo_monto'):
-            return 0.0
         return self._recargo_monto
 
     @RecargoMonto.setter
@@ -311,8 +312,6 @@ class LineaDetalle(object):
 
     @property
     def RecargoPct(self):
-        if not hasattr(self, '_recargo_pct'):
-            return 0.0
         return self._recargo_pct
 
     @RecargoPct.setter
@@ -323,8 +322,6 @@ class LineaDetalle(object):
 
     @property
     def TpoDocLiq(self):
-        if not hasattr(self, '_tpo_doc_liq'):
-            return False
         return self._tpo_doc_liq
 
     @TpoDocLiq.setter
@@ -333,7 +330,7 @@ class LineaDetalle(object):
 
     @property
     def UnmdItem(self):
-        if not hasattr(self, '_unidad_item'):
+        if self._unidad_item is None:
             return False
         return self._unidad_item[:4]
 
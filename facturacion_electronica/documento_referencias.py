@@ -3,13 +3,22 @@ from facturacion_electronica import clase_util as util
 
 
 class Referencia(object):
+    _defaults = {
+        '_cod_ref': False,
+        '_fch_ref': False,
+        '_folio_ref': False,
+        '_nro_lin_ref': False,
+        '_razon_ref': False,
+        '_tpo_doc_ref': False,
+    }
+    __slots__ = tuple(_defaults)
+
     def __init__(self, vals):
+        util.set_defaults(self)
         util.set_from_keys(self, vals)
 
     @property
     def CodRef(self):
-        if not hasattr(self, '_cod_ref'):
-            return False
         return self._cod_ref
 
     @CodRef.setter
@@ -23,8 +32,6 @@ class Referencia(object):
 
     @property
     def FchRef(self):
-        if not hasattr(self, '_fch_ref'):
-            return False
         return self._fch_ref
 
     @FchRef.setter
@@ -33,8 +40,6 @@ class Referencia(object):
 
     @property
     def FolioRef(self):
-        if not hasattr(self, '_folio_ref'):
-            return False
         return self._folio_ref
 
     @FolioRef.setter
@@ -43,8 +48,6 @@ class Referencia(object):
 
     @property
     def NroLinRef(self):
-        if not hasattr(self, '_nro_lin_ref'):
-            return False
         return self._nro_lin_ref
 
     @NroLinRef.setter
@@ -53,8 +56,6 @@ class Referencia(object):
 
     @property
     def RazonRef(self):
-        if not hasattr(self, '_razon_ref'):
-            return False
         return self._razon_ref
 
     @RazonRef.setter
@@ -63,8 +64,6 @@ class Referencia(object):
 
     @property
     def TpoDocRef(self):
-        if not hasattr(self, '_tpo_doc_ref'):
-            return False
         return self._tpo_doc_ref
 
     @TpoDocRef.setter
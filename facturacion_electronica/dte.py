@@ -1,11 +1,13 @@
 # -#- coding: utf-8 -#-
 from facturacion_electronica.caf import Caf
 from facturacion_electronica.emisor import Emisor as Emis
-from facturacion_electronica.firma import Firma
 from facturacion_electronica import clase_util as util
+from facturacion_electronica import instrumentacion
 from lxml import etree
 import collections
 import base64
+import os
+import re
 import pdf417gen
 import logging
 _logger = logging.getLogger(__name__)
@@ -22,6 +24,77 @@ class UserError(Exception):
 
 xmlns = "http://www.sii.cl/SiiDte"
 
+# Modo de render del PDF417 en set_barcode:
+# 'eager' genera el PNG al timbrar, 'lazy' al leer sii_barcode_img por
+# primera vez y 'none' nunca (solo TED y matriz de codewords).
+BARCODE_RENDER = ['none', 'lazy', 'eager']
+
+
+# Caracteres que lxml no acepta en el texto de un nodo.
+_XML_INVALIDO = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f\ud800-\udfff\ufffe\uffff]')
+_PARSER_TED = etree.XMLParser(encoding='ISO-8859-1')
+
+
+def _nodo_ted(tag, valor):
+    """`<tag>valor</tag>` en ISO-8859-1, escapado igual que lxml."""
+    if valor is None:
+        return b'<%s/>' % tag
+    if _XML_INVALIDO.search(valor):
+        raise ValueError("All strings must be XML compatible: Unicode or "
+                         "ASCII, no NULL bytes or control characters")
+    texto = valor.replace('&', '&amp;').replace('<', '&lt;').replace(
+        '>', '&gt;').replace('\r', '&#13;')
+    return b'<%s>%s</%s>' % (
+        tag, texto.encode('ISO-8859-1', 'xmlcharrefreplace'), tag)
+
+
+def armar_ted(campos, caf, timestamp):
+    """Arma el TED concatenando bytes: los campos del DD (pares (tag,
+    texto)), el nodo CAF ya serializado (CafRango.caf_xml) y TSTED; firma el
+    DD con la llave del CAF y agrega FRMT. Retorna (ted, nodo): el TED sin
+    saltos de línea (sii_barcode) y el nodo para el Documento, que conserva
+    los saltos de línea del CAF. Ambos salen del mismo buffer y son iguales
+    byte a byte a armar el TED con lxml."""
+    dd = b''.join([b'<DD>'] + [
+        _nodo_ted(tag, texto) for tag, texto in campos] + [
+        caf.caf_xml,
+        _nodo_ted(b'TSTED', timestamp),
+        b'</DD>',
+    ])
+    frmt = caf.llave.sign(dd.replace(b'\n', b''))
+    buffer = b''.join([
+        b'<TED version="1.0">',
+        dd,
+        b'<FRMT algoritmo="SHA1withRSA">',
+        frmt.encode(),
+        b'</FRMT></TED>',
+    ])
+    nodo = etree.fromstring(buffer, parser=_PARSER_TED)
+    # Al parsear, <X></X> queda sin texto y se serializaría como <X/>.
+    for hijo, (tag, texto) in zip(nodo[0], campos):
+        if texto == '':
+            hijo.text = ''
+    return buffer.replace(b'\n', b''), nodo
+
+
+def pdf417_codewords(ted):
+    """Matriz PDF417 del TED (lista de filas de codewords) con los
+    parámetros del SII; sirve para que impresoras o PDFs la dibujen."""
+    return pdf417gen.encode(
+        ted,
+        security_level=5,
+        columns=13,
+        encoding='ISO-8859-1',
+    )
+
+
+def pdf417_image(codewords, scale=3, padding=10):
+    return pdf417gen.render_image(
+        codewords,
+        padding=padding,
+        scale=scale,
+    )
+
 
 class DTE(object):
 
@@ -54,6 +127,9 @@ class DTE(object):
 
     @caf_file.setter
     def caf_file(self, vals):
+        if isinstance(vals, Caf):
+            self._cafs = vals
+            return
         try:
             self._cafs = Caf(vals)
         except Exception as e:
@@ -80,6 +156,18 @@ class DTE(object):
     def ID(self, val):
         self._id = val
 
+    @property
+    def barcode_render(self):
+        if not hasattr(self, '_barcode_render'):
+            self.barcode_render = os.environ.get('PDF417_RENDER') or 'eager'
+        return self._barcode_render
+
+    @barcode_render.setter
+    def barcode_render(self, val):
+        if val not in BARCODE_RENDER:
+            raise UserError("Modo de render PDF417 no soportado: %s" % val)
+        self._barcode_render = val
+
     @property
     def sii_barcode(self):
         if not hasattr(self, '_sii_barcode'):
@@ -89,6 +177,17 @@ class DTE(object):
     @sii_barcode.setter
     def sii_barcode(self, val):
         self._sii_barcode = val
+        for cache in ['_sii_barcode_codewords', '_sii_barcode_img']:
+            if hasattr(self, cache):
+                delattr(self, cache)
+
+    @property
+    def sii_barcode_codewords(self):
+        if not self.sii_barcode:
+            return False
+        if not hasattr(self, '_sii_barcode_codewords'):
+            self._sii_barcode_codewords = pdf417_codewords(self.sii_barcode)
+        return self._sii_barcode_codewords
 
     @property
     def sii_xml_request(self):
@@ -142,9 +241,8 @@ class DTE(object):
         return xml
 
     def firmar(self, message, uri, type='doc'):
-        string = util.limpiar_items(message)
         if self.firma.firma:
-            return self.firma.firmar(string, uri, type)
+            return self.firma.firmar(message, uri, type)
         raise UserError('No tiene Firma Válida')
 
     def get_xml_file(self):
@@ -160,18 +258,22 @@ class DTE(object):
         return self.Folio
 
     def pdf417bc(self, ted):
-        bc = pdf417gen.encode(
-            ted,
-            security_level=5,
-            columns=13,
-            encoding='ISO-8859-1',
-        )
-        image = pdf417gen.render_image(
-            bc,
-            padding=10,
-            scale=3,
-        )
-        return image
+        if ted == self.sii_barcode:
+            return pdf417_image(self.sii_barcode_codewords)
+        return pdf417_image(pdf417_codewords(ted))
+
+    def render_barcode(self):
+        """Genera el PNG (base64) del PDF417 del TED en sii_barcode_img."""
+        if not self.sii_barcode:
+            return False
+        with instrumentacion.span('dte.render_barcode') as span:
+            barcodefile = BytesIO()
+            image = self.pdf417bc(self.sii_barcode)
+            image.save(barcodefile, 'PNG')
+            data = barcodefile.getvalue()
+            span.bytes = len(data)
+        self.sii_barcode_img = base64.b64encode(data)
+        return self.sii_barcode_img
 
     def get_related_invoices_data(self):
         """
@@ -230,58 +332,39 @@ class DTE(object):
         Emisor['CiudadOrigen'] = self.Emisor.CiudadOrigen
         return Emisor
 
+    @instrumentacion.medido(
+        'dte.set_barcode',
+        etiquetas=lambda self, xml: {'tipo_dte': self.TipoDTE})
     def set_barcode(self, xml):
-        ted = False
         folio = self.Folio
-        timbre = """<TED><DD><RE>99999999-9</RE><TD>11</TD><F>1</F>\
-<FE>2000-01-01</FE><RR>99999999-9</RR><RSR>\
-XXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXX</RSR><MNT>10000</MNT><IT1>IIIIIII\
-</IT1></DD></TED>"""
-        parser = etree.XMLParser(remove_blank_text=True)
-        result = etree.fromstring(timbre, parser=parser)
-        xml.append(result)
-        result.find('DD/RE').text = self.Emisor.RUTEmisor
-        result.find('DD/TD').text = str(self.TipoDTE)
-        result.find('DD/F').text = str(folio)
         if not self.FechaEmis:
             raise UserError("Problema con la fecha %s" % self.FechaEmis)
-        result.find('DD/FE').text = self.FechaEmis
         if not self._receptor.RUTRecep:
             raise UserError("Completar RUT del Receptor")
-        result.find('DD/RR').text = '55555555-5' if self.es_exportacion else self._receptor.RUTRecep
-        result.find('DD/RSR').text = self._receptor.RznSocRecep[:40]
-        result.find('DD/MNT').text = str(self.MntTotal)
-        if self.no_product:
-            result.find('DD/MNT').text = '0'
+        it1 = 'IIIIIII'
         for line in self._lineas_detalle:
             if line.NroLinDet == 1:
-                result.find('DD/IT1').text = line.NmbItem[:40]
+                it1 = line.NmbItem[:40]
                 break
-        resultcaf = self.caf_files.get_caf_file(folio, self.TipoDTE)
-        result.find('DD').append(resultcaf.find('CAF'))
+        rsr = self._receptor.RznSocRecep
+        campos = [
+            (b'RE', self.Emisor.RUTEmisor),
+            (b'TD', str(self.TipoDTE)),
+            (b'F', str(folio)),
+            (b'FE', self.FechaEmis),
+            (b'RR', '55555555-5' if self.es_exportacion else self._receptor.RUTRecep),
+            (b'RSR', rsr[:40] if rsr is not None else None),
+            (b'MNT', '0' if self.no_product else str(self.MntTotal)),
+            (b'IT1', it1),
+        ]
+        resultcaf = self.caf_files.get_caf(
+            folio, self.TipoDTE, self.Emisor.RUTEmisor)
         timestamp = self.timestamp_timbre
-        etree.SubElement(result.find('DD'), 'TSTED').text = timestamp
-        keypriv = resultcaf.find('RSASK').text.replace('\t', '')
-        ddxml = etree.tostring(result.find('DD'), encoding="ISO-8859-1", xml_declaration=False).replace(b'\n', b'')
-        firma_caf = Firma({
-                    'priv_key': keypriv,
-                    'init_signature': False,
-                    'rut_firmante': '60803000-K',
-                    })
-        frmt = firma_caf.generar_firma(ddxml)
-        result.set("version", "1.0")
-        ted_xml = etree.SubElement(result, 'FRMT')
-        ted_xml.set("algoritmo", "SHA1withRSA")
-        ted_xml.text = frmt
-        ted = etree.tostring(result, encoding="ISO-8859-1", xml_declaration=False).replace(b'\n', b'')
+        ted, result = armar_ted(campos, resultcaf, timestamp)
+        xml.append(result)
         self.sii_barcode = ted
-        image = False
-        if ted:
-            barcodefile = BytesIO()
-            image = self.pdf417bc(ted)
-            image.save(barcodefile, 'PNG')
-            data = barcodefile.getvalue()
-            self.sii_barcode_img = base64.b64encode(data)
+        if ted and self.barcode_render == 'eager':
+            self.render_barcode()
         ted_xml = etree.SubElement(xml, 'TmstFirma')
         ted_xml.text = timestamp
 
@@ -317,7 +400,7 @@ folio: %s" % (
     def _dte_to_xml(self, dte, tpo_dte="Documento"):
         #ted = dte[tpo_dte + ' ID']['TEDd']
         #dte[(tpo_dte + ' ID')]['TEDd'] = ''
-        xml = util.create_xml(dte)
+        xml = util.build_xml(dte)
         return xml
 
     def _tag_dte(self):
@@ -333,22 +416,17 @@ folio: %s" % (
             return
         folio = self.Folio
         tpo_dte = self._tag_dte()
-        dte = collections.OrderedDict()
-        dte[tpo_dte] = self._dte()
-        xml = self._dte_to_xml(dte, tpo_dte)
-        if self.caf_files:
-            self.set_barcode(xml)
-        #xml.set('xmlns', xmlns)
-        xml.set('ID', self.ID)
-        xml_pret = etree.tostring(
-                xml,
-                pretty_print=True, encoding="ISO-8859-1", xml_declaration=False).decode('ISO-8859-1')
-        dte_xml = self.crear_DTE(xml_pret)
-        type = 'doc'
-        if self.es_boleta():
-            type = 'bol'
-        einvoice = self.firmar(dte_xml, self.ID, type)
-        self.sii_xml_request = einvoice
+        with instrumentacion.span(
+                'dte.timbrar', tipo_dte=self.TipoDTE) as span:
+            dte = collections.OrderedDict()
+            dte[tpo_dte] = self._dte()
+            xml = self._dte_to_xml(dte, tpo_dte)
+            if self.caf_files:
+                self.set_barcode(xml)
+            #xml.set('xmlns', xmlns)
+            xml.set('ID', self.ID)
+            self.sii_xml_request = self._firmar_documento(xml)
+            span.bytes = instrumentacion.largo(self.sii_xml_request)
 
     def timbrar_xml(self):
         if not self.sii_xml_request:
@@ -358,12 +436,27 @@ folio: %s" % (
         xml = etree.fromstring(self.sii_xml_request.encode('ISO-8859-1'))
         if self.caf_files:
             self.set_barcode(xml)
-        xml_pret = etree.tostring(
-                xml,
-                pretty_print=True, encoding="ISO-8859-1", xml_declaration=False).decode('ISO-8859-1')
-        dte_xml = self.crear_DTE(xml_pret)
+        self.sii_xml_request = self._firmar_documento(xml)
+
+    def _firmar_documento(self, xml):
+        """Arma el DTE sobre el árbol del Documento, lo firma y lo serializa
+        una sola vez. El Documento se indenta con util.indentar (dos
+        espacios por nivel) y queda entre saltos de línea dentro de DTE; los
+        espacios no son byte a byte los de crear_DTE, solo el contenido."""
+        ns = 'http://www.sii.cl/SiiDte'
+        util.indentar(xml)
+        dte = etree.Element('{%s}DTE' % ns, nsmap={None: ns}, version="1.0")
+        dte.text = '\n'
+        dte.append(xml)
+        xml.tail = '\n\n'
+        for el in xml.iter(etree.Element):
+            if not el.tag.startswith('{'):
+                el.tag = '{%s}%s' % (ns, el.tag)
         type = 'doc'
         if self.es_boleta():
             type = 'bol'
-        einvoice = self.firmar(dte_xml, self.ID, type)
-        self.sii_xml_request = einvoice
+        if self.firmar(dte, self.ID, type) is False:
+            return False
+        return etree.tostring(
+                dte, encoding="ISO-8859-1", xml_declaration=False
+            ).decode('ISO-8859-1')
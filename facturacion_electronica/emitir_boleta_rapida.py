@@ -3,7 +3,6 @@ import os
 import json
 from typing import Dict, Any
 import copy
-import base64
 
 from facturacion_electronica import facturacion_electronica as fe
 from facturacion_electronica import clase_util as util
@@ -11,6 +10,7 @@ from facturacion_electronica.util_certificado import (
     inyectar_certificado_en_data,
     inyectar_caf_en_data,
 )
+from facturacion_electronica.barcodes import render_lote
 from facturacion_electronica.emisor import Emisor
 from facturacion_electronica.firma import Firma
 from facturacion_electronica.conexion import Conexion, api_url, api_url_envio
@@ -24,6 +24,8 @@ def main():
     # Rutas/credenciales (preferir env vars para no hardcodear):
     # - PFX_PATH, PFX_PASS, RUT_FIRMANTE
     # - CAF39_PATH
+    # Los PDF417 se generan por lote al final (barcodes.render_lote), no al timbrar.
+    os.environ.setdefault("PDF417_RENDER", "none")
     ejemplo_json_path = os.path.abspath(os.path.join(
         os.path.dirname(__file__),
         "ejemplos/ejemplo_basico_39.json"
@@ -176,23 +178,21 @@ def main():
                 "TipoDTE": d.get("TipoDTE"),
                 "Folio": d.get("Folio"),
                 "ok_xml": bool(d.get("sii_xml_dte")),
-                "ok_barcode_img": bool(d.get("sii_barcode_img")),
+                "ok_barcode": bool(d.get("sii_barcode")),
                 "error": d.get("error"),
             })
-            # Guardar imagen de timbre electrónico (PDF417) si está disponible
-            img_b64 = d.get("sii_barcode_img")
-            if img_b64:
-                try:
-                    out_dir = os.environ.get("BARCODE_OUT_DIR") or os.path.abspath(os.path.join(os.path.dirname(__file__), "out", "barcodes"))
-                    os.makedirs(out_dir, exist_ok=True)
-                    fname = "pdf417_T{0}_F{1}.png".format(d.get("TipoDTE"), d.get("Folio"))
-                    out_path = os.path.join(out_dir, fname)
-                    png_data = base64.b64decode(img_b64)
-                    with open(out_path, "wb") as fpng:
-                        fpng.write(png_data)
+        # Guardar imágenes de timbre electrónico (PDF417) por lote
+        teds = [d["sii_barcode"] for d in resp.get("detalles", []) if d.get("sii_barcode")]
+        if teds:
+            try:
+                out_dir = os.environ.get("BARCODE_OUT_DIR") or os.path.abspath(os.path.join(os.path.dirname(__file__), "out", "barcodes"))
+                stats = render_lote(teds, out_dir)
+                for out_path in stats["archivos"]:
                     print("[boleta] PDF417 (timbre electrónico) guardado en:", out_path)
-                except Exception as e:
-                    print("[boleta] No se pudo guardar PDF417:", str(e))
+                print("[boleta] PDF417: {0} archivos en {1}s ({2}/s)".format(
+                    stats["cantidad"], stats["segundos"], stats["por_segundo"]))
+            except Exception as e:
+                print("[boleta] No se pudo guardar PDF417:", str(e))
 
     print("\n=== FIN FLUJO EMISIÓN BOLETA RÁPIDA ===\n")
 
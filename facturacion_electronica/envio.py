@@ -14,12 +14,54 @@ from facturacion_electronica.emisor import Emisor as Emis
 from facturacion_electronica.respuesta import Respuesta
 from facturacion_electronica.firma import Firma
 from facturacion_electronica import clase_util as util
+from facturacion_electronica import instrumentacion
 from facturacion_electronica.clase_util import UserError
 from facturacion_electronica.caf import Caf
+from facturacion_electronica.escritor_envio import EscritorEnvio
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from lxml import etree
+import copy
+import os
 import logging
 _logger = logging.getLogger(__name__)
 
+# Lo que timbrar() deja calculado en el documento y vuelve desde el pool.
+_ATRIBUTOS_TIMBRE = [
+    '_sii_xml_request',
+    '_sii_barcode',
+    '_sii_barcode_img',
+    '_timestamp_timbre',
+]
+_pools = {}
+MAX_DTE = 500
+MAX_BYTES = 8 * 1024 * 1024
+# Carátula, raíz y firma del sobre, además de los DTE.
+_RESERVA_SOBRE = 8 * 1024
+# Para el estado combinado de varios sobres: gana el peor.
+_ESTADOS = ['Rechazado', 'NoEnviado', 'draft', 'Enviado', 'EnProceso',
+            'Aceptado']
+
+
+def _prioridad_estado(estado):
+    return _ESTADOS.index(estado) if estado in _ESTADOS else 0
+
+
+def _timbrar_documento(dte):
+    """Corre en un proceso del pool. Si falla retorna {} y el documento se
+    vuelve a timbrar en el proceso principal, que registra el error."""
+    try:
+        dte.timbrar()
+    except Exception:
+        return {}
+    return {k: getattr(dte, k) for k in _ATRIBUTOS_TIMBRE if hasattr(dte, k)}
+
+
+def _pool_timbrado(workers):
+    key = (os.getpid(), workers)
+    if key not in _pools:
+        _pools[key] = ProcessPoolExecutor(max_workers=workers)
+    return _pools[key]
+
 
 class Envio(object):
 
@@ -99,13 +141,16 @@ class Envio(object):
                     caf_mgr = Caf(caf_file)
                 except Exception:
                     caf_mgr = None
+            rut_emisor = getattr(self.Emisor, "RUTEmisor", None) or getattr(self.Emisor, "rut", None)
+            if caf_mgr:
+                caf_mgr.reservar_documentos(
+                    TipoDTE, vals["documentos"], rut_emisor=rut_emisor)
             for docData in vals["documentos"]:
                 # Auto-folio: si viene 0/None, asigna el siguiente folio del CAF (persistente).
                 try:
                     iddoc = docData.setdefault("Encabezado", {}).setdefault("IdDoc", {})
                     folio_val = iddoc.get("Folio", 0) or 0
                     if int(folio_val) <= 0 and caf_mgr:
-                        rut_emisor = getattr(self.Emisor, "RUTEmisor", None) or getattr(self.Emisor, "rut", None)
                         iddoc["Folio"] = caf_mgr.next_folio(TipoDTE, rut_emisor=rut_emisor)
                 except Exception:
                     pass
@@ -118,9 +163,11 @@ class Envio(object):
                 docu.verify = self.verify
                 docu.test = self.test
                 if caf_file:
-                    docu.caf_file = caf_file
+                    docu.caf_file = caf_mgr or caf_file
                 docu.TipoDTE = TipoDTE
                 _documentos.append(docu)
+            if caf_mgr:
+                caf_mgr.release_folios()
         self._documentos = sorted(_documentos, key=lambda t: t.NroDTE)
 
     @property
@@ -172,6 +219,89 @@ class Envio(object):
     def firma(self):
         return self.firma_electronica
 
+    @property
+    def workers(self):
+        """Procesos para timbrar en paralelo (opt-in): 0/1 en serie, True o -1
+        usa todos los núcleos. Por defecto env var TIMBRADO_WORKERS."""
+        if not hasattr(self, '_workers'):
+            self.workers = os.environ.get('TIMBRADO_WORKERS') or 0
+        return self._workers
+
+    @workers.setter
+    def workers(self, val):
+        if val is True or str(val) == '-1':
+            val = os.cpu_count() or 1
+        self._workers = int(val or 0)
+
+    @property
+    def stream(self):
+        """Escribe el sobre en streaming (EscritorEnvio) en vez de armarlo
+        en memoria. Por defecto env var ENVIO_STREAM."""
+        if not hasattr(self, '_stream'):
+            self.stream = os.environ.get('ENVIO_STREAM')
+        return self._stream
+
+    @stream.setter
+    def stream(self, val):
+        self._stream = str(val).lower() in ['1', 'true', 'yes']
+
+    @property
+    def stream_path(self):
+        """Archivo donde queda el sobre en modo stream; sin él se usa un
+        temporal que se descarta después del envío."""
+        if not hasattr(self, '_stream_path'):
+            return os.environ.get('ENVIO_STREAM_PATH') or False
+        return self._stream_path
+
+    @stream_path.setter
+    def stream_path(self, val):
+        self._stream_path = val
+
+    @property
+    def max_dte(self):
+        """Documentos por sobre; sobre eso do_dte_send envía varios sobres.
+        Por defecto ENVIO_MAX_DTE o 500 (máximo del XSD de EnvioBOLETA)."""
+        if not hasattr(self, '_max_dte'):
+            self.max_dte = os.environ.get('ENVIO_MAX_DTE') or MAX_DTE
+        return self._max_dte
+
+    @max_dte.setter
+    def max_dte(self, val):
+        self._max_dte = int(val)
+
+    @property
+    def max_bytes(self):
+        """Tamaño máximo de cada sobre (ENVIO_MAX_BYTES); el SII rechaza los
+        archivos demasiado grandes (STATUS 2, error en tamaño del archivo)."""
+        if not hasattr(self, '_max_bytes'):
+            self.max_bytes = os.environ.get('ENVIO_MAX_BYTES') or MAX_BYTES
+        return self._max_bytes
+
+    @max_bytes.setter
+    def max_bytes(self, val):
+        self._max_bytes = int(val)
+
+    @property
+    def concurrencia(self):
+        """Sobres que se envían a la vez cuando hay más de uno."""
+        if not hasattr(self, '_concurrencia'):
+            self.concurrencia = os.environ.get('ENVIO_CONCURRENCIA') or 4
+        return self._concurrencia
+
+    @concurrencia.setter
+    def concurrencia(self, val):
+        self._concurrencia = max(1, int(val))
+
+    @property
+    def sobre(self):
+        if not hasattr(self, '_sobre'):
+            return False
+        return self._sobre
+
+    @sobre.setter
+    def sobre(self, val):
+        self._sobre = val
+
     @property
     def firma_electronica(self):
         if not hasattr(self, '_firma_electronica'):
@@ -374,27 +504,29 @@ class Envio(object):
            self.ID)
         return xml
 
-    def caratula_dte(self, EnvioDTE, SubTotDTE):
-        xml = '''<SetDTE ID="{8}">
-<Caratula version="1.0">
+    def caratula(self, SubTotDTE):
+        xml = '''<Caratula version="1.0">
 <RutEmisor>{0}</RutEmisor>
 <RutEnvia>{1}</RutEnvia>
 <RutReceptor>{2}</RutReceptor>
 <FchResol>{3}</FchResol>
 <NroResol>{4}</NroResol>
 <TmstFirmaEnv>{5}</TmstFirmaEnv>
-{6}</Caratula>{7}
-</SetDTE>
-'''.format(self.Emisor.RUTEmisor,
+{6}</Caratula>'''.format(self.Emisor.RUTEmisor,
            self.firma_electronica.rut_firmante\
             if self.firma_electronica else '66666666-6',
            self.RutReceptor,
            self.Emisor.FchResol,
            self.Emisor.NroResol,
            self.TmstFirmaEnv,
-           SubTotDTE,
-           EnvioDTE,
-           self.ID)
+           SubTotDTE)
+        return xml
+
+    def caratula_dte(self, EnvioDTE, SubTotDTE):
+        xml = '''<SetDTE ID="{0}">
+{1}{2}
+</SetDTE>
+'''.format(self.ID, self.caratula(SubTotDTE), EnvioDTE)
         return xml
 
     def caratula_libro(self):
@@ -556,26 +688,39 @@ xsi:schemaLocation="http://www.sii.cl/SiiDte RespuestaEnvioDTE_v10.xsd" >
                             self.sii_xml_request, self.ID, type)
         self.sii_xml_request = result
 
-    def generate_xml_send(self):
+    def timbrar_paralelo(self):
+        """Timbra y firma en el pool los documentos pendientes; cada uno
+        vuelve a su lugar, así el orden del sobre no cambia."""
+        pendientes = [dte for dte in self.Documento if not dte.sii_xml_request]
+        if self.workers < 2 or len(pendientes) < 2:
+            return
+        chunksize = max(1, len(pendientes) // (self.workers * 4))
+        resultados = _pool_timbrado(self.workers).map(
+            _timbrar_documento, pendientes, chunksize=chunksize)
+        for dte, atributos in zip(pendientes, resultados):
+            for k, v in atributos.items():
+                setattr(dte, k, v)
+
+    def _timbrar(self, dte):
+        try:
+            dte.timbrar()
+            return True
+        except Exception as e:
+            _logger.warning("Error al timbrar", exc_info=True)
+            self.errores = {
+                    'FechaEmis': dte.FechaEmis,
+                    'Folio': dte.Folio,
+                    'TipoDTE': dte.TipoDTE,
+                    'error': str(e),
+                }
+        return False
+
+    def _sub_tot_dte(self):
         tots_dte = {}
-        documentos = ''
         for dte in self.Documento:
-            try:
-                dte.timbrar()
-                tots_dte.setdefault(dte.TipoDTE, {'total': 0, 'folios': []})
-                tots_dte[dte.TipoDTE]['total'] += 1
-                tots_dte[dte.TipoDTE]['folios'].append(dte.Folio)
-                documentos += '\n' + dte.sii_xml_request
-            except Exception as e:
-                _logger.warning("Error al timbrar", exc_info=True)
-                self.errores = {
-                        'FechaEmis': dte.FechaEmis,
-                        'Folio': dte.Folio,
-                        'TipoDTE': dte.TipoDTE,
-                        'error': str(e),
-                    }
-        if self.errores:
-            return
+            tots_dte.setdefault(dte.TipoDTE, {'total': 0, 'folios': []})
+            tots_dte[dte.TipoDTE]['total'] += 1
+            tots_dte[dte.TipoDTE]['folios'].append(dte.Folio)
         SubTotDTE = ''
         filename = ''
         for key, value in tots_dte.items():
@@ -587,8 +732,34 @@ xsi:schemaLocation="http://www.sii.cl/SiiDte RespuestaEnvioDTE_v10.xsd" >
                     filename += '%s-' % (f)
         if not self.filename:
             self.filename = self.filename[:-1] + ".xml"
+        return SubTotDTE
+
+    def generate_xml_send(self):
+        with instrumentacion.span('envio.generate_xml_send') as span:
+            self._generate_xml_send()
+            if self.sobre:
+                span.bytes = self.sobre.archivo.seek(0, 2)
+                self.sobre.archivo.seek(0)
+            else:
+                span.bytes = instrumentacion.largo(self.sii_xml_request)
+
+    def _generate_xml_send(self):
+        try:
+            self.timbrar_paralelo()
+        except Exception:
+            _logger.warning("Timbrado paralelo falló, se timbra en serie",
+                            exc_info=True)
+        if self.stream:
+            return self.generate_xml_stream()
+        documentos = []
+        for dte in self.Documento:
+            if self._timbrar(dte):
+                documentos.append('\n' + dte.sii_xml_request)
+        if self.errores:
+            return
+        SubTotDTE = self._sub_tot_dte()
         # firma del sobre
-        dtes = self.caratula_dte(documentos, SubTotDTE)
+        dtes = self.caratula_dte(''.join(documentos), SubTotDTE)
         env = 'env'
         if self.es_boleta:
             self.sii_xml_request = self.envio_boleta(dtes)
@@ -597,9 +768,110 @@ xsi:schemaLocation="http://www.sii.cl/SiiDte RespuestaEnvioDTE_v10.xsd" >
             self.envio_dte(dtes)
         self.firmar(env)
 
+    def generate_xml_stream(self):
+        """Como generate_xml_send, pero cada DTE se escribe en el sobre
+        (EscritorEnvio) apenas se timbra y el sobre queda en `self.sobre`,
+        un archivo listo para Conexion.send_xml_file."""
+        if not self.firma_electronica or not self.firma_electronica.firma:
+            raise UserError('No tiene Firma Válida')
+        escritor = EscritorEnvio(
+            self.firma_electronica,
+            self.ID,
+            'env_boleta' if self.es_boleta else 'env',
+            destino=self.stream_path or None,
+        )
+        try:
+            escritor.abrir(self.caratula(self._sub_tot_dte()))
+            for dte in self.Documento:
+                if self._timbrar(dte) and not self.errores:
+                    escritor.agregar(dte.sii_xml_request)
+            if self.errores:
+                escritor.close()
+                return
+            escritor.cerrar()
+        except Exception:
+            escritor.close()
+            raise
+        self.sobre = escritor
+
+    def planificar_envios(self):
+        """Timbra los documentos y los reparte en lotes que respetan
+        max_dte y max_bytes; cada lote va en su propio sobre. Un documento
+        que por sí solo supera max_bytes queda en un lote aparte."""
+        try:
+            self.timbrar_paralelo()
+        except Exception:
+            _logger.warning("Timbrado paralelo falló, se timbra en serie",
+                            exc_info=True)
+        for dte in self.Documento:
+            self._timbrar(dte)
+        if self.errores:
+            return [self.Documento]
+        limite = self.max_bytes - _RESERVA_SOBRE
+        lotes = []
+        lote = []
+        total = 0
+        for dte in self.Documento:
+            largo = len(dte.sii_xml_request) + 1
+            if lote and (len(lote) >= self.max_dte or total + largo > limite):
+                lotes.append(lote)
+                lote = []
+                total = 0
+            lote.append(dte)
+            total += largo
+        if lote:
+            lotes.append(lote)
+        return lotes or [self.Documento]
+
+    def _sub_envio(self, documentos, n):
+        envio = copy.copy(self)
+        for attr in ['_sii_xml_request', '_sobre', '_errores']:
+            envio.__dict__.pop(attr, None)
+        envio._documentos = documentos
+        nombre, ext = os.path.splitext(self.filename)
+        envio.filename = '%s_%s%s' % (nombre, n, ext)
+        if self.stream_path:
+            nombre, ext = os.path.splitext(self.stream_path)
+            envio.stream_path = '%s_%s%s' % (nombre, n, ext)
+        return envio
+
+    def do_dte_send_lotes(self, lotes):
+        """Firma y envía cada lote como un sobre aparte, en paralelo
+        (ENVIO_CONCURRENCIA) con la misma conexión y token. Retorna un
+        resultado combinado con un track id por sobre en 'sii_send_ident'
+        y el resultado de cada uno en 'envios'."""
+        if not hasattr(self, '_api') and self.Documento:
+            self.api = self.Documento[0].es_boleta()
+        self.conexion
+        envios = [self._sub_envio(lote, n + 1) for n, lote in enumerate(lotes)]
+        workers = min(self.concurrencia, len(envios))
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            resultados = list(pool.map(lambda e: e.do_dte_send(), envios))
+        detalles = []
+        errores = []
+        for envio, r in zip(envios, resultados):
+            r['folios'] = [d.Folio for d in envio.Documento]
+            r.setdefault('sii_send_filename', envio.filename)
+            detalles.extend(r.get('detalles', []))
+            if r.get('errores'):
+                errores.append(r['errores'])
+        estados = [r.get('status') for r in resultados]
+        return {
+            'status': min(estados, key=_prioridad_estado),
+            'sii_send_ident': [r.get('sii_send_ident') for r in resultados],
+            'envios': resultados,
+            'detalles': detalles,
+            'errores': errores,
+        }
+
     def do_dte_send(self):
         try:
-            self.generate_xml_send()
+            lotes = self.planificar_envios()
+            if len(lotes) > 1:
+                _logger.info("Se envían %s sobres" % len(lotes))
+                return self.do_dte_send_lotes(lotes)
+            if not self.errores:
+                self.generate_xml_send()
         except Exception as e:
             return {
                 'status': "Rechazado",
@@ -609,14 +881,23 @@ xsi:schemaLocation="http://www.sii.cl/SiiDte RespuestaEnvioDTE_v10.xsd" >
         result = {
             'status': 'draft',
             }
-        if self.errores or not self.sii_xml_request:
+        sobre = self.sii_xml_request
+        if self.sobre:
+            sobre = self.sobre.archivo
+        if self.errores or not sobre:
             self.errores = 'No se creó xml'
             result['errores'] = self.errores
             return result
+        if not hasattr(self, '_api') and self.Documento:
+            self.api = self.Documento[0].es_boleta()
+        if self.conexion:
+            result = self.conexion.send_xml_file(
+                            sobre,
+                            self.filename
+                        )
+        # Después del envío: con PDF417_RENDER=lazy el PNG se genera aquí.
         detalles = []
         for r in self.Documento:
-            if not hasattr(self, '_api'):
-                self.api = r.es_boleta()
             detalles.append({
                     'NroDTE': r.NroDTE,
                     'TipoDTE': r.TipoDTE,
@@ -627,20 +908,22 @@ xsi:schemaLocation="http://www.sii.cl/SiiDte RespuestaEnvioDTE_v10.xsd" >
                     'MntTotal': r.MntTotal,
                     'ImptoReten': r.ImptoReten,
                     'sii_barcode_img': r.sii_barcode_img,
+                    'sii_barcode': r.sii_barcode.decode('ISO-8859-1') if r.sii_barcode else False,
                     'sii_xml_dte': r.sii_xml_request
                 })
-        if self.conexion:
-            result = self.conexion.send_xml_file(
-                            self.sii_xml_request,
-                            self.filename
-                        )
         result.update({
-                'sii_xml_request': '<?xml version="1.0" encoding="ISO-8859-1"?>\n'\
-                + self.sii_xml_request,
                 'sii_send_filename': self.filename,
                 'detalles': detalles,
                 'errores': self.errores,
                 })
+        if self.sobre:
+            # El sobre no se carga en memoria: queda en stream_path si se
+            # indicó, si no el archivo temporal se descarta.
+            result['sii_xml_file'] = self.sobre.path
+            self.sobre.close()
+        else:
+            result['sii_xml_request'] = '<?xml version="1.0" encoding="ISO-8859-1"?>\n'\
+                + self.sii_xml_request
         return result
 
     def do_libro_send(self):
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""
+Escritor en streaming de sobres EnvioBOLETA / EnvioDTE.
+
+Los DTE firmados se escriben uno a uno en un archivo (temporal por defecto)
+y el digest de SetDTE se calcula a medida que se escriben: cada parte se
+canoniza dentro de un SetDTE vacío con los mismos namespaces que hereda en
+el sobre, así que el resultado es el mismo que C14N del SetDTE completo. El
+sobre nunca está entero en memoria ni se vuelve a parsear para firmarlo.
+
+    escritor = EscritorEnvio(firma, 'SetDoc', 'env_boleta')
+    escritor.abrir(caratula)
+    for dte in documentos:
+        escritor.agregar(dte.sii_xml_request)
+    escritor.cerrar()
+    conexion.send_xml_file(escritor.archivo, 'envio.xml')
+"""
+import base64
+import hashlib
+import tempfile
+from lxml import etree
+from facturacion_electronica import clase_util as util
+from facturacion_electronica.clase_util import UserError
+from facturacion_electronica.firma import XSI_NS
+
+import logging
+_logger = logging.getLogger(__name__)
+
+
+SII_NS = 'http://www.sii.cl/SiiDte'
+SOBRES = {
+    'env_boleta': ('EnvioBOLETA', 'EnvioBOLETA_v11.xsd'),
+    'env': ('EnvioDTE', 'EnvioDTE_v10.xsd'),
+}
+# Sobre en memoria hasta este tamaño; sobre eso pasa a disco.
+SPOOL_MAX = 8 * 1024 * 1024
+DECLARACION = '<?xml version="1.0" encoding="ISO-8859-1"?>\n'
+_CONTEXTO = '<SetDTE xmlns="%s" xmlns:xsi="%s">' % (SII_NS, XSI_NS)
+
+
+def canonizar_en_set(xml):
+    """C14N de un fragmento (Caratula o DTE) tal como queda dentro del
+    SetDTE del sobre: sin los xmlns que ya declara el sobre."""
+    c14n = etree.tostring(
+        etree.fromstring(_CONTEXTO + xml + '</SetDTE>'), method="c14n")
+    inicio = _CONTEXTO.encode()
+    if not c14n.startswith(inicio):
+        raise UserError("No se pudo canonizar el fragmento del sobre")
+    return c14n[len(inicio):-len(b'</SetDTE>')]
+
+
+class EscritorEnvio(object):
+
+    def __init__(self, firma, ID='SetDoc', tipo='env_boleta', destino=None,
+                 spool_max=SPOOL_MAX):
+        if tipo not in SOBRES:
+            raise UserError("Tipo de sobre no soportado: %s" % tipo)
+        self.firma = firma
+        self.ID = ID
+        self.tipo = tipo
+        self.path = destino if isinstance(destino, str) else False
+        if self.path:
+            self.archivo = open(self.path, 'w+b')
+        elif destino is not None:
+            self.archivo = destino
+        else:
+            self.archivo = tempfile.SpooledTemporaryFile(max_size=spool_max)
+        self.cantidad = 0
+        self._sha1 = hashlib.sha1()
+        self._estado = 'nuevo'
+
+    def _escribir(self, texto, canonico=None):
+        self.archivo.write(texto.encode('ISO-8859-1'))
+        if canonico is not None:
+            self._sha1.update(canonico)
+
+    def abrir(self, caratula):
+        """Escribe el inicio del sobre y la Carátula (ya con SubTotDTE)."""
+        if self._estado != 'nuevo':
+            raise UserError("El sobre ya fue abierto")
+        raiz, xsd = SOBRES[self.tipo]
+        self._escribir(
+            DECLARACION
+            + '<%s xmlns="%s" xmlns:xsi="%s" '
+            'xsi:schemaLocation="%s %s" version="1.0">\n' % (
+                raiz, SII_NS, XSI_NS, SII_NS, xsd))
+        self._escribir(
+            '<SetDTE ID="%s">\n' % self.ID,
+            ('<SetDTE xmlns="%s" xmlns:xsi="%s" ID="%s">\n' % (
+                SII_NS, XSI_NS, self.ID)).encode())
+        self._escribir(caratula, canonizar_en_set(caratula))
+        self._estado = 'abierto'
+
+    def agregar(self, dte_xml):
+        """Agrega un DTE firmado (sii_xml_request del documento)."""
+        if self._estado != 'abierto':
+            raise UserError("El sobre no está abierto")
+        self._escribir('\n', b'\n')
+        self._escribir(dte_xml, canonizar_en_set(dte_xml))
+        self.cantidad += 1
+
+    def cerrar(self):
+        """Cierra SetDTE, agrega la firma del sobre y deja el archivo al
+        inicio, listo para enviar. Con verify valida el sobre contra el XSD
+        en streaming."""
+        if self._estado != 'abierto':
+            raise UserError("El sobre no está abierto")
+        self._escribir('\n</SetDTE>', b'\n</SetDTE>')
+        digest = base64.b64encode(self._sha1.digest()).decode()
+        firma = self.firma.nodo_firma(digest, self.ID, self.tipo)
+        if firma is False:
+            raise UserError("No se pudo firmar el sobre")
+        self._escribir('\n\n' + etree.tostring(
+            firma, encoding='ISO-8859-1', xml_declaration=False
+        ).decode('ISO-8859-1') + '\n</%s>' % SOBRES[self.tipo][0])
+        self.archivo.flush()
+        self._estado = 'cerrado'
+        if self.firma.verify:
+            self.validar()
+        self.archivo.seek(0)
+        return self.archivo
+
+    def validar(self):
+        """Valida el sobre escrito contra su XSD sin cargarlo completo."""
+        xmlschema = util.get_xml_schema(self.tipo)
+        self.archivo.seek(0)
+        try:
+            for event, el in etree.iterparse(
+                    self.archivo, events=('end',), schema=xmlschema):
+                if el.getparent() is not None \
+                        and el.getparent().tag == '{%s}SetDTE' % SII_NS:
+                    el.clear()
+                    while el.getprevious() is not None:
+                        del el.getparent()[0]
+        except etree.XMLSyntaxError as e:
+            message = 'XML Malformed Error:  %s' % e
+            _logger.warning(message)
+            raise UserError(message)
+        finally:
+            self.archivo.seek(0)
+        return True
+
+    def close(self):
+        self.archivo.close()
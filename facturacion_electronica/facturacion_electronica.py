@@ -14,6 +14,7 @@ from facturacion_electronica.emisor import Emisor
 from facturacion_electronica.envio import Envio
 from facturacion_electronica.firma import Firma
 from facturacion_electronica.caf import Caf
+from facturacion_electronica import instrumentacion
 import json
 import csv
 import base64
@@ -47,6 +48,10 @@ def procesar_documento(vals):
                 caf_mgr = Caf(caf_file)
             except Exception:
                 caf_mgr = None
+        rut_emisor = vals.get("Emisor", {}).get("RUTEmisor")
+        if caf_mgr:
+            caf_mgr.reservar_documentos(
+                TipoDTE, docs["documentos"], rut_emisor=rut_emisor)
         for docData in docs["documentos"]:
             # Si no viene Folio (o viene 0), lo asignamos automáticamente usando el CAF
             # y persistimos el último folio usado para no repetir.
@@ -54,7 +59,7 @@ def procesar_documento(vals):
                 iddoc = docData.setdefault("Encabezado", {}).setdefault("IdDoc", {})
                 folio_val = iddoc.get("Folio", 0) or 0
                 if int(folio_val) <= 0 and caf_mgr:
-                    iddoc["Folio"] = caf_mgr.next_folio(TipoDTE, rut_emisor=vals.get("Emisor", {}).get("RUTEmisor"))
+                    iddoc["Folio"] = caf_mgr.next_folio(TipoDTE, rut_emisor=rut_emisor)
             except Exception:
                 pass
             docu = Documento(
@@ -66,11 +71,16 @@ def procesar_documento(vals):
             docu._firma = firma
             docu.verify = verify
             docu.test = test
-            docu.caf_file = caf_file
+            docu.caf_file = caf_mgr or caf_file
             _documentos.append(docu)
+        if caf_mgr:
+            caf_mgr.release_folios()
     return _documentos
 
 
+@instrumentacion.medido(
+    'timbrar',
+    tamano=lambda r: sum(len(d.get('sii_xml_dte') or '') for d in r))
 def timbrar(vals):
     _dtes = False
     if vals.get('Documento'):
@@ -440,6 +450,75 @@ def consulta_estado_dte(vals):
                 documento)
     return respuesta
 
+
+CAMPOS_CONSULTA = ['TipoDTE', 'Folio', 'FchEmis', 'MntTotal', 'RUTRecep']
+
+
+def _documentos_consulta(vals, emisor):
+    """Documentos a consultar: los de vals['Documento'] (mismo formato que
+    consulta_estado_dte) y las tuplas o dicts de vals['consultas'] con
+    (TipoDTE, Folio, FchEmis, MntTotal, RUTRecep)."""
+    for d in vals.get('Documento', []):
+        for r in d['documentos']:
+            documento = Documento(r, emisor=emisor, resumen=True)
+            documento.TipoDTE = int(d["TipoDTE"])
+            yield documento
+    for c in vals.get('consultas', []):
+        if not isinstance(c, dict):
+            c = dict(zip(CAMPOS_CONSULTA, c))
+        documento = Documento({
+            'Encabezado': {
+                'IdDoc': {'Folio': c['Folio'], 'FchEmis': c['FchEmis']},
+                'Receptor': {'RUTRecep': c['RUTRecep']},
+                'Totales': {'MntTotal': c['MntTotal']},
+            }},
+            emisor=emisor,
+            resumen=True)
+        documento.TipoDTE = int(c['TipoDTE'])
+        yield documento
+
+
+def iter_estado_dte(vals):
+    """Como consulta_estado_dte para miles de documentos: una sola sesión y
+    token por servicio (API boletas / SOAP), consultas concurrentes con
+    límite de tasa (AsyncConexion.consulta_estados_dte) y entrega de
+    (DTE.ID, resultado) a medida que llegan. 'concurrencia' y 'por_segundo'
+    en vals ajustan los límites."""
+    import asyncio
+    from facturacion_electronica.conexion_async import AsyncConexion
+    firma = Firma(vals["firma_electronica"])
+    emisor = Emisor(vals["Emisor"])
+    grupos = {}
+    for documento in _documentos_consulta(vals, emisor):
+        api = vals.get('api', documento.es_boleta())
+        grupos.setdefault(api, []).append(documento)
+    loop = asyncio.new_event_loop()
+    try:
+        for api, documentos in sorted(grupos.items(), reverse=True):
+            conn = AsyncConexion(
+                emisor, firma, api,
+                token=vals.get("token") or vals.get("sii_token"))
+            consultas = conn.consulta_estados_dte(
+                documentos,
+                limite=vals.get('concurrencia'),
+                por_segundo=vals.get('por_segundo'))
+            try:
+                while True:
+                    try:
+                        yield loop.run_until_complete(consultas.__anext__())
+                    except StopAsyncIteration:
+                        break
+            finally:
+                loop.run_until_complete(consultas.aclose())
+                loop.run_until_complete(conn.close())
+    finally:
+        loop.close()
+
+
+def consulta_estado_dte_lote(vals):
+    """Resultado de iter_estado_dte como dict por DTE.ID."""
+    return dict(iter_estado_dte(vals))
+
 def consulta_estado_cesion_relac(vals):
     firma = Firma(vals["firma_electronica"])
     emisor = Emisor(vals["Emisor"])
@@ -462,9 +541,9 @@ def ingreso_reclamo_documento(vals):
     firma = Firma(vals["firma_electronica"])
     emisor = Emisor(vals["Emisor"])
     respuesta = {}
+    conexion = Conexion(emisor, firma)
     for d in vals['DTEClaim']:
         key = "RUT%sT%sF%s" %(d['RUTEmisor'], d['TipoDTE'], d['Folio'])
-        conexion = Conexion(emisor, firma)
         respuesta[key] = conexion.set_dte_claim(d)
     return respuesta
 
@@ -473,9 +552,9 @@ def consulta_reclamo_documento(vals):
     firma = Firma(vals["firma_electronica"])
     emisor = Emisor(vals["Emisor"])
     respuesta = {}
+    conexion = Conexion(emisor, firma)
     for d in vals['DTEClaim']:
         key = "RUT%sT%sF%s" %(d['RUTEmisor'], d['TipoDTE'], d['Folio'])
-        conexion = Conexion(emisor, firma)
         respuesta[key] = conexion.get_dte_claim(d)
     return respuesta
 
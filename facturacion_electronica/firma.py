@@ -1,6 +1,7 @@
 # -#- coding: utf-8 -#-
 from facturacion_electronica.signature_cert import SignatureCert
 from facturacion_electronica import clase_util as util
+from facturacion_electronica import instrumentacion
 from facturacion_electronica.clase_util import UserError
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives.serialization import load_pem_private_key
@@ -21,10 +22,99 @@ type_ = crypto.FILETYPE_PEM
 USING_PYTHON2 = True if sys.version_info < (3, 0) else False
 
 
+XMLDSIG_NS = 'http://www.w3.org/2000/09/xmldsig#'
+XSI_NS = 'http://www.w3.org/2001/XMLSchema-instance'
+
+
+def _ds(tag):
+    return '{%s}%s' % (XMLDSIG_NS, tag)
+
+
+def c14n(nodo):
+    """C14N inclusivo de `nodo`, con los namespaces que hereda.
+
+    Al canonizar un subárbol, libxml2 pierde los namespaces declarados más
+    arriba (emite xmlns="" desde el segundo nivel), por eso los hijos pasan
+    un momento a una copia del nodo que declara todo su nsmap."""
+    if nodo.getparent() is None:
+        return etree.tostring(nodo, method="c14n")
+    copia = etree.Element(nodo.tag, dict(nodo.attrib), nsmap=nodo.nsmap)
+    copia.text = nodo.text
+    hijos = list(nodo)
+    copia.extend(hijos)
+    try:
+        return etree.tostring(copia, method="c14n")
+    finally:
+        nodo.extend(hijos)
+
+
+def long_to_bytes(n, blocksize=0):
+    s = b''
+    if USING_PYTHON2:
+        n = long(n)  # noqa
+    pack = struct.pack
+    while n > 0:
+        s = pack(b'>I', n & 0xffffffff) + s
+        n = n >> 32
+    # strip off leading zeros
+    for i in range(len(s)):
+        if s[i] != b'\000'[0]:
+            break
+    else:
+        # only happens when n == 0
+        s = b'\000'
+        i = 0
+    s = s[i:]
+    # add back some pad bytes.  this could be done more efficiently w.r.t. the
+    # de-padding being done above, but sigh...
+    if blocksize > 0 and len(s) % blocksize:
+        s = (blocksize - len(s) % blocksize) * b'\000' + s
+    return s
+
+
+class SigningKey(object):
+    """Llave privada ya cargada, junto con los textos de KeyInfo
+    (Modulus, Exponent y X509Certificate) listos para insertar en cada firma."""
+
+    def __init__(self, priv_key, cert=False):
+        self.key = load_pem_private_key(
+                priv_key,
+                password=None,
+                backend=default_backend()
+            )
+        self.cert = cert
+        numbers = self.key.public_key().public_numbers()
+        self.modulus = textwrap.fill(
+                    base64.b64encode(long_to_bytes(numbers.n)).decode(),
+                    64
+                )
+        self.exponent = base64.b64encode(long_to_bytes(numbers.e)).decode()
+        self.x509_certificate = '\n' + textwrap.fill(cert, 64) if cert else ''
+
+    def sign(self, texto, algo='sha1'):
+        sha_algo = SHA1
+        if algo == 'sha256':
+            sha_algo = SHA256
+        if type(texto) is not bytes:
+            texto = texto.encode()
+        signature = self.key.sign(
+                texto,
+                padding=PKCS1v15(),
+                algorithm=sha_algo()
+            )
+        return base64.b64encode(signature).decode()
+
+
 class Firma(object):
     def __init__(self, vals={}):
         self.firma_electronica = vals
 
+    def __getstate__(self):
+        # La llave cargada no se puede serializar; se recarga al firmar.
+        state = self.__dict__.copy()
+        state.pop('_signing_key', None)
+        return state
+
     @property
     def errores(self):
         if not hasattr(self, '_errores'):
@@ -77,6 +167,8 @@ class Firma(object):
     @privkey.setter
     def privkey(self, val):
         self._priv_key = val
+        if hasattr(self, '_signing_key'):
+            del self._signing_key
 
     @property
     def cert(self):
@@ -106,11 +198,14 @@ class Firma(object):
 
     @property
     def key(self):
-        return load_pem_private_key(
-                self.privkey,
-                password=None,
-                backend=default_backend()
-            )
+        return self.signing_key.key
+
+    @property
+    def signing_key(self):
+        if not hasattr(self, '_signing_key') or \
+                self._signing_key.cert != self.cert:
+            self._signing_key = SigningKey(self.privkey, self.cert)
+        return self._signing_key
 
     @property
     def key_pub(self):
@@ -141,87 +236,89 @@ class Firma(object):
         return x
 
     def long_to_bytes(self, n, blocksize=0):
-        s = b''
-        if USING_PYTHON2:
-            n = long(n)  # noqa
-        pack = struct.pack
-        while n > 0:
-            s = pack(b'>I', n & 0xffffffff) + s
-            n = n >> 32
-        # strip off leading zeros
-        for i in range(len(s)):
-            if s[i] != b'\000'[0]:
-                break
-        else:
-            # only happens when n == 0
-            s = b'\000'
-            i = 0
-        s = s[i:]
-        # add back some pad bytes.  this could be done more efficiently w.r.t. the
-        # de-padding being done above, but sigh...
-        if blocksize > 0 and len(s) % blocksize:
-            s = (blocksize - len(s) % blocksize) * b'\000' + s
-        return s
-
-    def append_sig(self, tag, string, firma, type):
-        '''
-            @TODO encontrar una mejor manera de hacer esto
-        '''
-        tag = "</%s>" % tag.split('}')[-1]
-        result = string.replace(tag, "%s\n%s" %(firma, tag))
-        if type != 'token' and self.verify:
-            if type == 'libro_boleta':
-                xmlns = 'xmlns="http://www.w3.org/2000/09/xmldsig#"'
-                xmlns_sii = 'xmlns="http://www.sii.cl/SiiDte"'
-                result = result.replace(xmlns, xmlns_sii)
-            result = result if util.validar_xml(result, type) else ''
-        return result
+        return long_to_bytes(n, blocksize)
 
+    @instrumentacion.medido(
+        'firma.firmar',
+        tamano=instrumentacion.largo,
+        etiquetas=lambda self, string, uri=False, type="doc": {'tipo': type})
     def firmar(self, string, uri=False, type="doc"):
+        """Firma un XML en texto y lo retorna serializado. Si recibe un
+        elemento lxml, lo firma en el mismo árbol y retorna el elemento."""
+        if etree.iselement(string):
+            return string if self.firmar_nodo(string, uri, type) else False
         el = etree.fromstring(string)
-        if type == 'token':
-            string_to_canon = etree.tostring(el)
-        else:
-            ''' @mejorar esto, se supone es document con xmlns="http://www.sii.cl/SiiDte" '''
-            string_to_canon = etree.tostring(el[0], encoding='ISO-8859-1', xml_declaration=False).decode('ISO-8859-1')
-        mess = etree.tostring(etree.fromstring(string_to_canon), method="c14n")
-        digest = base64.b64encode(self.digest(mess))
+        if not self.firmar_nodo(el, uri, type):
+            return False
+        result = etree.tostring(
+            el, encoding='ISO-8859-1', xml_declaration=False
+        ).decode('ISO-8859-1')
+        if type == 'libro_boleta' and self.verify:
+            xmlns = 'xmlns="%s"' % XMLDSIG_NS
+            xmlns_sii = 'xmlns="http://www.sii.cl/SiiDte"'
+            result = result.replace(xmlns, xmlns_sii)
+            result = result if util.validar_xml(result, type) else ''
+        return result
+
+    def firmar_nodo(self, root, uri=False, type="doc"):
+        """Firma `root` sobre el árbol: canoniza una vez el nodo referenciado
+        (root[0], o root completo en el token) y agrega Signature como último
+        hijo, sin serializar ni volver a parsear. Retorna True si la firma
+        (y el documento, según `type`) valida."""
+        nodo = root if type == 'token' else root[0]
+        digest = base64.b64encode(self.digest(c14n(nodo))).decode()
+        sig_root = self.nodo_firma(digest, uri, type)
+        if sig_root is False:
+            return False
+        sig_root.tail = '\n'
+        root.append(sig_root)
+        if type not in ['token', 'libro_boleta'] and self.verify:
+            return bool(util.validar_xml(root, type))
+        return True
+
+    def nodo_firma(self, digest, uri=False, type="doc"):
+        """Arma el nodo Signature para un digest (base64) ya calculado.
+        Retorna False si no valida contra el XSD de la firma."""
         reference_uri = '#'+uri if uri else ''
-        signed_info = etree.Element("SignedInfo")
+        nsmap = {None: XMLDSIG_NS}
+        if type not in ['doc', 'recep']:
+            nsmap['xsi'] = XSI_NS
+        signed_info = etree.Element(_ds("SignedInfo"), nsmap=nsmap)
         etree.SubElement(
                     signed_info,
-                    "CanonicalizationMethod",
+                    _ds("CanonicalizationMethod"),
                     Algorithm='http://www.w3.org/TR/2001/REC-xml-c14n-20010315'
                 )
         etree.SubElement(
                     signed_info,
-                    "SignatureMethod",
+                    _ds("SignatureMethod"),
                     Algorithm='http://www.w3.org/2000/09/xmldsig#rsa-sha1'
                 )
         reference = etree.SubElement(
                     signed_info,
-                    "Reference",
+                    _ds("Reference"),
                     URI=reference_uri
                 )
         transforms = etree.SubElement(
                     reference,
-                    "Transforms"
+                    _ds("Transforms")
                 )
         etree.SubElement(
                     transforms,
-                    "Transform",
+                    _ds("Transform"),
                     Algorithm="http://www.w3.org/TR/2001/REC-xml-c14n-20010315"
                 )
         etree.SubElement(
                     reference,
-                    "DigestMethod",
+                    _ds("DigestMethod"),
                     Algorithm="http://www.w3.org/2000/09/xmldsig#sha1"
                 )
         digest_value = etree.SubElement(
                     reference,
-                    "DigestValue"
+                    _ds("DigestValue")
                 )
         digest_value.text = digest
+        # SignedInfo todavía es raíz: se canoniza con sus propios xmlns.
         signed_info_c14n = etree.tostring(
                     signed_info,
                     method="c14n",
@@ -229,20 +326,9 @@ class Firma(object):
                     with_comments=False,
                     inclusive_ns_prefixes=None
                 )
-        att = 'xmlns="http://www.w3.org/2000/09/xmldsig#"'
-        if type not in ['doc', 'recep']:
-            att += ' xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance"'
-        #@TODO Find better way to add xmlns:xsi attrib
-        signed_info_c14n = signed_info_c14n.decode().replace(
-                "<SignedInfo>",
-                "<SignedInfo %s>" % att
-            )
-        sig_root = etree.Element(
-            "Signature",
-            attrib={'xmlns': 'http://www.w3.org/2000/09/xmldsig#'}
-        )
-        sig_root.append(etree.fromstring(signed_info_c14n))
-        signature_value = etree.SubElement(sig_root, "SignatureValue")
+        sig_root = etree.Element(_ds("Signature"), nsmap={None: XMLDSIG_NS})
+        sig_root.append(signed_info)
+        signature_value = etree.SubElement(sig_root, _ds("SignatureValue"))
         algo = 'sha1'
         if type == 'token':
             algo = 'sha256'
@@ -251,51 +337,27 @@ class Firma(object):
                     signature,
                     64
                 )
-        key_info = etree.SubElement(sig_root, "KeyInfo")
-        key_value = etree.SubElement(key_info, "KeyValue")
-        rsa_key_value = etree.SubElement(key_value, "RSAKeyValue")
-        modulus = etree.SubElement(rsa_key_value, "Modulus")
-        modulus.text = textwrap.fill(
-                    base64.b64encode(
-                            self.long_to_bytes(
-                                    self.key.public_key().public_numbers().n
-                                )
-                        ).decode(),
-                    64
-                )
-        exponent = etree.SubElement(rsa_key_value, "Exponent")
-        exponent.text = self.ensure_str(
-                    base64.b64encode(
-                            self.long_to_bytes(
-                                        self.key.public_key().public_numbers().e
-                                    )
-                                )
-                    )
-        x509_data = etree.SubElement(key_info, "X509Data")
-        x509_certificate = etree.SubElement(x509_data, "X509Certificate")
-        x509_certificate.text = '\n' + textwrap.fill(self.cert, 64)
-        firma = etree.tostring(sig_root).decode('ISO-8859-1')
-        if not util.validar_xml(firma, 'sig'):
+        signing_key = self.signing_key
+        key_info = etree.SubElement(sig_root, _ds("KeyInfo"))
+        key_value = etree.SubElement(key_info, _ds("KeyValue"))
+        rsa_key_value = etree.SubElement(key_value, _ds("RSAKeyValue"))
+        modulus = etree.SubElement(rsa_key_value, _ds("Modulus"))
+        modulus.text = signing_key.modulus
+        exponent = etree.SubElement(rsa_key_value, _ds("Exponent"))
+        exponent.text = signing_key.exponent
+        x509_data = etree.SubElement(key_info, _ds("X509Data"))
+        x509_certificate = etree.SubElement(x509_data, _ds("X509Certificate"))
+        x509_certificate.text = signing_key.x509_certificate
+        if not util.validar_xml(sig_root, 'sig'):
             return False
-        return self.append_sig(el.tag, string, firma, type)
+        return sig_root
 
     def digest(self, data):
         sha1 = hashlib.new('sha1', data)
         return sha1.digest()
 
     def generar_firma(self, texto, algo="sha1"):
-        sha_algo = SHA1
-        if algo == 'sha256':
-            sha_algo = SHA256
-        if type(texto) is not bytes:
-            texto=texto.encode()
-        signature = self.key.sign(
-                texto,
-                padding=PKCS1v15(),
-                algorithm=sha_algo()
-            )
-        text = base64.b64encode(signature).decode()
-        return text
+        return self.signing_key.sign(texto, algo)
 
     def verificar_digest(self, digest, mess):
         our = base64.b64encode(self.digest(mess)).decode()
@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+"""
+Asignación de folios compartida entre procesos.
+
+El estado guarda el último folio usado por clave "RUTEmisor|TipoDTE".
+Backends disponibles:
+- 'json': archivo JSON (comportamiento original). En POSIX se protege con
+  fcntl.flock sobre "<archivo>.lock" para que varios workers no repitan folios.
+- 'sqlite': base SQLite en modo WAL; cada reserva es una transacción
+  BEGIN IMMEDIATE, sin reescribir todo el estado ni hacer fsync por folio.
+  Si existe un JSON con el mismo nombre base (folio_state.json), se importa
+  al abrir, para no repetir folios ya usados.
+
+Se elige con la env var FOLIO_BACKEND ('json' por defecto) y la ruta con
+FOLIO_STATE_PATH.
+"""
+import abc
+import json
+import os
+import sqlite3
+import threading
+from facturacion_electronica.clase_util import UserError
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+_allocators = {}
+_allocators_lock = threading.Lock()
+
+
+def default_state_path(backend='json'):
+    env_path = os.environ.get("FOLIO_STATE_PATH")
+    if env_path:
+        return env_path
+    base_dir = os.path.dirname(__file__)
+    out_dir = os.path.join(base_dir, "out")
+    os.makedirs(out_dir, exist_ok=True)
+    if backend == 'sqlite':
+        return os.path.join(out_dir, "folio_state.sqlite3")
+    return os.path.join(out_dir, "folio_state.json")
+
+
+def get_folio_allocator(state_path=None, backend=None):
+    """Retorna (y reutiliza dentro del proceso) el allocator para la ruta."""
+    backend = backend or os.environ.get("FOLIO_BACKEND") or 'json'
+    if backend not in ['json', 'sqlite']:
+        raise UserError("FOLIO_BACKEND no soportado: %s" % backend)
+    state_path = state_path or default_state_path(backend)
+    key = (backend, os.path.abspath(state_path))
+    with _allocators_lock:
+        allocator = _allocators.get(key)
+        if allocator is None:
+            if backend == 'sqlite':
+                allocator = SqliteFolioAllocator(state_path)
+                json_path = os.path.splitext(state_path)[0] + '.json'
+                if os.path.exists(json_path):
+                    allocator.importar_json(json_path)
+            else:
+                allocator = JsonFolioAllocator(state_path)
+            _allocators[key] = allocator
+    return allocator
+
+
+class FolioAllocator(abc.ABC):
+    """Interfaz común. Las subclases implementan _reservar dentro de una
+    transacción exclusiva entre procesos."""
+
+    def __init__(self, state_path):
+        self.state_path = state_path
+        self._lock = threading.Lock()
+
+    def _tomar(self, key, last, rangos, cantidad):
+        """Folios siguientes a `last`, recorriendo los rangos en orden
+        (puede abarcar más de un CAF)."""
+        folios = []
+        for desde, hasta in sorted(rangos):
+            inicio = max(desde, last + 1)
+            if inicio > hasta:
+                continue
+            fin = min(hasta, inicio + cantidad - len(folios) - 1)
+            folios.extend(range(inicio, fin + 1))
+            if len(folios) == cantidad:
+                return folios
+        rut, TipoDTE = key.split('|')
+        txt_rangos = ', '.join('%s-%s' % r for r in sorted(rangos))
+        raise UserError(
+            f"Sin folios disponibles para {rut} TipoDTE {TipoDTE}. "
+            f"Rango CAF: {txt_rangos}. Último usado: {last}. "
+            f"Solicitados: {cantidad}. Solicita un nuevo CAF."
+        )
+
+    def _devolver(self, last, folios, rangos=None):
+        """Solo se pueden devolver los folios que forman la cola del último
+        usado; retorna (nuevo último, folios que no se pudieron devolver).
+        Con `rangos`, la cola salta el hueco entre un CAF y el anterior."""
+        pendientes = sorted(set(folios))
+        anterior = {}
+        previo = None
+        for desde, hasta in sorted(rangos or []):
+            anterior[desde] = previo if previo is not None else desde - 1
+            previo = hasta
+        while pendientes and pendientes[-1] == last:
+            folio = pendientes.pop()
+            last = anterior.get(folio, folio - 1)
+        return last, pendientes
+
+    def reservar(self, key, rangos, cantidad=1):
+        """Reserva `cantidad` folios dentro de los rangos [(desde, hasta)] en
+        una sola transacción y retorna la lista. El estado queda persistido
+        antes de retornar."""
+        if cantidad < 1:
+            return []
+        with self._lock:
+            return self._reservar(key, rangos, cantidad)
+
+    def liberar(self, key, folios, rangos=None):
+        """Devuelve folios reservados que no se usaron. Retorna los que no
+        se pudieron devolver porque ya se asignaron folios posteriores.
+        `rangos` son los mismos [(desde, hasta)] de la reserva."""
+        if not folios:
+            return []
+        with self._lock:
+            return self._liberar(key, folios, rangos)
+
+    @abc.abstractmethod
+    def ultimo(self, key):
+        """Último folio usado para `key`, o None si no hay estado."""
+
+    @abc.abstractmethod
+    def _reservar(self, key, rangos, cantidad):
+        """Toma `cantidad` folios y persiste el nuevo último usado."""
+
+    @abc.abstractmethod
+    def _liberar(self, key, folios, rangos=None):
+        """Devuelve la cola de `folios` y retorna los no devueltos."""
+
+
+class JsonFolioAllocator(FolioAllocator):
+
+    def _load_state(self):
+        try:
+            if not os.path.exists(self.state_path):
+                return {}
+            with open(self.state_path, "r", encoding="utf-8") as f:
+                return json.load(f) or {}
+        except Exception:
+            return {}
+
+    def _save_state(self, state):
+        tmp = self.state_path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(state, f, ensure_ascii=False, indent=2, sort_keys=True)
+        os.replace(tmp, self.state_path)
+
+    def _bloquear(self):
+        if fcntl is None:
+            return None
+        lock_file = open(self.state_path + ".lock", "a")
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        return lock_file
+
+    def _desbloquear(self, lock_file):
+        if lock_file is None:
+            return
+        fcntl.flock(lock_file, fcntl.LOCK_UN)
+        lock_file.close()
+
+    def ultimo(self, key):
+        return self._load_state().get(key)
+
+    def _reservar(self, key, rangos, cantidad):
+        lock_file = self._bloquear()
+        try:
+            state = self._load_state()
+            last = int(state.get(key, min(rangos)[0] - 1))
+            folios = self._tomar(key, last, rangos, cantidad)
+            state[key] = folios[-1]
+            self._save_state(state)
+        finally:
+            self._desbloquear(lock_file)
+        return folios
+
+    def _liberar(self, key, folios, rangos=None):
+        lock_file = self._bloquear()
+        try:
+            state = self._load_state()
+            if key not in state:
+                return sorted(folios)
+            last, pendientes = self._devolver(int(state[key]), folios, rangos)
+            if last != state[key]:
+                state[key] = last
+                self._save_state(state)
+        finally:
+            self._desbloquear(lock_file)
+        return pendientes
+
+
+class SqliteFolioAllocator(FolioAllocator):
+
+    def __init__(self, state_path):
+        super(SqliteFolioAllocator, self).__init__(state_path)
+        self._conn = None
+        self._pid = None
+
+    @property
+    def conn(self):
+        # Las conexiones SQLite no sobreviven un fork (gunicorn preload):
+        # se abre una por proceso.
+        if self._conn is None or self._pid != os.getpid():
+            conn = sqlite3.connect(
+                self.state_path,
+                timeout=30,
+                isolation_level=None,
+                check_same_thread=False,
+            )
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS folio_state ("
+                "key TEXT PRIMARY KEY, ultimo INTEGER NOT NULL)"
+            )
+            self._conn = conn
+            self._pid = os.getpid()
+        return self._conn
+
+    def importar_json(self, json_path):
+        """Toma el estado de un folio_state.json previo, para no repetir
+        folios al cambiar de backend. Nunca retrocede un folio ya usado."""
+        state = JsonFolioAllocator(json_path)._load_state()
+        with self._lock:
+            conn = self.conn
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                for key, ultimo in state.items():
+                    conn.execute(
+                        "INSERT INTO folio_state (key, ultimo) VALUES (?, ?) "
+                        "ON CONFLICT(key) DO UPDATE SET "
+                        "ultimo = MAX(ultimo, excluded.ultimo)",
+                        (key, int(ultimo)),
+                    )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+
+    def ultimo(self, key):
+        row = self.conn.execute(
+            "SELECT ultimo FROM folio_state WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def _reservar(self, key, rangos, cantidad):
+        conn = self.conn
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT ultimo FROM folio_state WHERE key = ?",
+                (key,)).fetchone()
+            last = row[0] if row else min(rangos)[0] - 1
+            folios = self._tomar(key, last, rangos, cantidad)
+            conn.execute(
+                "INSERT INTO folio_state (key, ultimo) VALUES (?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET ultimo = excluded.ultimo",
+                (key, folios[-1]),
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return folios
+
+    def _liberar(self, key, folios, rangos=None):
+        conn = self.conn
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT ultimo FROM folio_state WHERE key = ?",
+                (key,)).fetchone()
+            if not row:
+                conn.execute("ROLLBACK")
+                return sorted(folios)
+            last, pendientes = self._devolver(row[0], folios, rangos)
+            conn.execute(
+                "UPDATE folio_state SET ultimo = ? WHERE key = ?",
+                (last, key),
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return pendientes
@@ -4,14 +4,26 @@ import math
 
 
 class Impuestos(object):
+    # None: Retencion no informada, se calcula según CodImp.
+    _defaults = {
+        '_cod_imp': 0,
+        '_credec': 0.0,
+        '_mepco': '',
+        '_price_include': False,
+        '_retencion': None,
+        '_tasa_imp': 0,
+        '_tpo_imp': 0,
+        '_tasa_imp_otr_mnda': 0,
+        '_tpo_imp_otr_mnda': 0,
+    }
+    __slots__ = tuple(_defaults)
 
     def __init__(self, vals=None):
+        util.set_defaults(self)
         util.set_from_keys(self, vals)
 
     @property
     def CodImp(self):
-        if not hasattr(self, '_cod_imp'):
-            return 0
         return self._cod_imp
 
     @CodImp.setter
@@ -20,8 +32,6 @@ class Impuestos(object):
 
     @property
     def CredEC(self):
-        if not hasattr(self, '_credec'):
-            return 0.0
         return self._credec
 
     @CredEC.setter
@@ -30,8 +40,6 @@ class Impuestos(object):
 
     @property
     def mepco(self):
-        if not hasattr(self, '_mepco'):
-            return ''
         return self._mepco
 
     @mepco.setter
@@ -40,8 +48,6 @@ class Impuestos(object):
 
     @property
     def price_include(self):
-        if not hasattr(self, '_price_include'):
-            return False
         return self._price_include
 
     @price_include.setter
@@ -50,7 +56,7 @@ class Impuestos(object):
 
     @property
     def Retencion(self):
-        if not hasattr(self, '_retencion'):
+        if self._retencion is None:
             if self.es_retencion:
                 return self.TasaImp
             return 0
@@ -62,8 +68,6 @@ class Impuestos(object):
 
     @property
     def TasaImp(self):
-        if not hasattr(self, '_tasa_imp'):
-            return 0
         return self._tasa_imp
 
     @TasaImp.setter
@@ -72,8 +76,6 @@ class Impuestos(object):
 
     @property
     def TpoImp(self):
-        if not hasattr(self, '_tpo_imp'):
-            return 0
         return self._tpo_imp
 
     @TpoImp.setter
@@ -82,8 +84,6 @@ class Impuestos(object):
 
     @property
     def TasaImpOtrMnda(self):
-        if not hasattr(self, '_tasa_imp_otr_mnda'):
-            return 0
         return self._tasa_imp_otr_mnda
 
     @TasaImpOtrMnda.setter
@@ -92,8 +92,6 @@ class Impuestos(object):
 
     @property
     def TpoImpOtrMnda(self):
-        if not hasattr(self, '_tpo_imp_otr_mnda'):
-            return 0
         return self._tpo_imp_otr_mnda
 
     @TpoImpOtrMnda.setter
@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+"""
+Emisión masiva desde un archivo plano (CSV o JSON Lines): una fila por línea
+de detalle, agrupadas por documento, por ejemplo el diario de un POS.
+
+El archivo se lee en streaming y se procesa por bloques de max_dte
+documentos (ENVIO_MAX_DTE, 500): cada bloque reserva sus folios de una vez
+(Caf.reserve_folios), se timbra y firma (TIMBRADO_WORKERS) y se escribe en
+disco antes de leer el siguiente, así que en memoria hay a lo más un bloque.
+
+    resumen = emitir(vals, leer_filas('diario.csv'), 'out/diario')
+
+`vals` es el payload de siempre (Emisor, firma_electronica, test...) con un
+solo grupo en vals['Documento'] que trae TipoDTE y caf_file, sin
+'documentos'. En `destino` quedan:
+
+- dte/T<tipo>F<folio>.xml: cada DTE firmado.
+- EnvioBOLETA_<n>.xml (EnvioDTE_<n>.xml para otros tipos): los sobres
+  firmados, repartidos según max_dte y max_bytes como en do_dte_send.
+- indice.csv: documento, NroDTE, TipoDTE, Folio, MntTotal y sobre de cada
+  documento emitido.
+
+Columnas (los nombres son los del payload): `documento` identifica el
+documento y sus filas deben venir seguidas. Del documento se toman, de su
+primera fila, Folio (vacío o 0 = siguiente folio del CAF), FchEmis,
+IndServicio, RUTRecep, RznSocRecep, GiroRecep, DirRecep, CmnaRecep,
+CiudadRecep y CorreoRecep. De cada fila: NmbItem, DscItem, QtyItem,
+UnmdItem, PrcItem, DescuentoPct, DescuentoMonto e IndExe, y para el impuesto
+CodImp (14), TasaImp (ValorIva del Emisor) y price_include (sí en boletas).
+Las columnas vacías se omiten.
+
+    python -m facturacion_electronica.ingesta diario.csv out/diario
+
+toma el payload de INGESTA_PAYLOAD (JSON) y, si se indican, el certificado
+de PFX_PATH, PFX_PASS y RUT_FIRMANTE y el CAF de CAF_PATH.
+"""
+import copy
+import csv
+import itertools
+import json
+import os
+import sys
+from facturacion_electronica.clase_util import UserError
+from facturacion_electronica.envio import Envio
+from facturacion_electronica.escritor_envio import DECLARACION
+
+import logging
+_logger = logging.getLogger(__name__)
+
+
+CLAVE = 'documento'
+ID_DOC = ['Folio', 'FchEmis']
+RECEPTOR = ['RUTRecep', 'RznSocRecep', 'GiroRecep', 'DirRecep', 'CmnaRecep',
+            'CiudadRecep', 'CorreoRecep']
+LINEA = ['NmbItem', 'DscItem', 'QtyItem', 'UnmdItem', 'PrcItem',
+         'DescuentoPct', 'DescuentoMonto', 'IndExe']
+ENTEROS = ['Folio', 'IndServicio', 'IndExe', 'CodImp']
+INDICE = ['documento', 'NroDTE', 'TipoDTE', 'Folio', 'MntTotal', 'sobre']
+
+
+def leer_filas(path, formato=None, delimitador=',', encoding='utf-8'):
+    """Filas (dict) de un CSV con encabezado o de un JSON Lines, una a la
+    vez. Sin `formato` se decide por la extensión (.jsonl / .ndjson)."""
+    if not formato:
+        ext = os.path.splitext(path)[1].lower()
+        formato = 'jsonl' if ext in ['.jsonl', '.ndjson'] else 'csv'
+    with open(path, newline='' if formato == 'csv' else None,
+              encoding=encoding) as f:
+        if formato == 'csv':
+            for fila in csv.DictReader(f, delimiter=delimitador):
+                yield fila
+        elif formato == 'jsonl':
+            for n, linea in enumerate(f, 1):
+                if not linea.strip():
+                    continue
+                try:
+                    yield json.loads(linea)
+                except ValueError as e:
+                    raise UserError("Línea %s de %s: %s" % (n, path, e))
+        else:
+            raise UserError("Formato no soportado: %s" % formato)
+
+
+def _valor(campo, valor):
+    if valor is None or (isinstance(valor, str) and not valor.strip()):
+        return None
+    if campo in ENTEROS:
+        return int(valor)
+    if campo == 'price_include' and isinstance(valor, str):
+        return valor.strip().lower() in ['1', 'true', 'yes', 'si', 'sí']
+    return valor
+
+
+def _tomar(fila, campos):
+    valores = {}
+    for campo in campos:
+        valor = _valor(campo, fila.get(campo))
+        if valor is not None:
+            valores[campo] = valor
+    return valores
+
+
+def _linea(fila, boleta, tasa_iva):
+    linea = _tomar(fila, LINEA)
+    if linea.get('IndExe'):
+        return linea
+    impuesto = _tomar(fila, ['CodImp', 'TasaImp', 'price_include'])
+    impuesto.setdefault('CodImp', 14)
+    impuesto.setdefault('TasaImp', tasa_iva)
+    impuesto.setdefault('price_include', boleta)
+    linea['Impuesto'] = [impuesto]
+    return linea
+
+
+def agrupar_documentos(filas, TipoDTE=39, TasaIVA=19, clave=CLAVE):
+    """Documentos (formato de vals['Documento'][i]['documentos']) armados
+    con las filas seguidas que comparten `clave`; la clave queda en
+    'documento' y NroDTE es correlativo desde 1."""
+    boleta = TipoDTE in [39, 41]
+    grupos = itertools.groupby(filas, key=lambda fila: fila.get(clave))
+    for nro, (valor, lineas) in enumerate(grupos, 1):
+        if _valor(clave, valor) is None:
+            raise UserError("Fila sin %s (documento %s)" % (clave, nro))
+        primera = next(lineas)
+        documento = {
+            'documento': valor,
+            'NroDTE': nro,
+            'Encabezado': {
+                'IdDoc': _tomar(primera, ID_DOC),
+                'Receptor': _tomar(primera, RECEPTOR),
+            },
+            'Detalle': [_linea(fila, boleta, TasaIVA)
+                        for fila in itertools.chain([primera], lineas)],
+        }
+        servicio = _valor('IndServicio', primera.get('IndServicio'))
+        if servicio or boleta:
+            documento['IndServicio'] = servicio or 3
+        yield documento
+
+
+def _escribir_dte(carpeta, dte):
+    path = os.path.join(carpeta, 'T%sF%s.xml' % (dte.TipoDTE, dte.Folio))
+    with open(path, 'wb') as f:
+        f.write((DECLARACION + dte.sii_xml_request).encode('ISO-8859-1'))
+
+
+def emitir(vals, filas, destino, guardar_dte=True):
+    """Timbra, firma y arma los sobres de los documentos de `filas` (ver
+    leer_filas) por bloques y los deja en `destino`. Se detiene en el
+    primer bloque con errores; los bloques anteriores quedan escritos.
+    Retorna documentos, sobres, indice y errores."""
+    vals = copy.deepcopy(vals)
+    grupos = vals.pop('Documento', None) or []
+    if len(grupos) != 1 or not grupos[0].get('caf_file'):
+        raise UserError(
+            "vals['Documento'] debe traer un grupo con TipoDTE y caf_file")
+    grupo = grupos[0]
+    TipoDTE = int(grupo.get('TipoDTE') or 39)
+    base = Envio(vals)
+    base.es_boleta = TipoDTE in [39, 41]
+    base.stream = True
+    base.stream_path = os.path.join(
+        destino, 'EnvioBOLETA.xml' if base.es_boleta else 'EnvioDTE.xml')
+    carpeta = os.path.join(destino, 'dte')
+    os.makedirs(carpeta if guardar_dte else destino, exist_ok=True)
+    tasa_iva = getattr(base.Emisor, 'ValorIva', None) or 19
+    documentos = agrupar_documentos(filas, TipoDTE, tasa_iva)
+    resumen = {
+        'documentos': 0,
+        'sobres': [],
+        'indice': os.path.join(destino, 'indice.csv'),
+        'errores': [],
+    }
+    with open(resumen['indice'], 'w', newline='') as f:
+        indice = csv.writer(f)
+        indice.writerow(INDICE)
+        while True:
+            bloque = list(itertools.islice(documentos, base.max_dte))
+            if not bloque:
+                break
+            claves = {d['NroDTE']: d.pop('documento') for d in bloque}
+            envio = base._sub_envio([], 0)
+            envio.Documento = [dict(grupo, documentos=bloque)]
+            lotes = envio.planificar_envios()
+            if envio.errores:
+                resumen['errores'] = envio.errores
+                break
+            for lote in lotes:
+                sobre = base._sub_envio(lote, len(resumen['sobres']) + 1)
+                sobre.generate_xml_send()
+                if sobre.errores or not sobre.sobre:
+                    resumen['errores'] = sobre.errores or ['No se creó xml']
+                    break
+                sobre.sobre.close()
+                resumen['sobres'].append(sobre.stream_path)
+                for dte in lote:
+                    if guardar_dte:
+                        _escribir_dte(carpeta, dte)
+                    indice.writerow([
+                        claves[dte.NroDTE], dte.NroDTE, dte.TipoDTE,
+                        dte.Folio, dte.MntTotal,
+                        os.path.basename(sobre.stream_path)])
+                resumen['documentos'] += len(lote)
+            if resumen['errores']:
+                break
+            _logger.info("%s documentos emitidos" % resumen['documentos'])
+    return resumen
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    if len(sys.argv) != 3:
+        print("Uso: python -m facturacion_electronica.ingesta "
+              "<archivo.csv|archivo.jsonl> <destino>")
+        sys.exit(2)
+    from facturacion_electronica.util_certificado import (
+        inyectar_caf_en_data,
+        inyectar_certificado_en_data,
+    )
+    with open(os.environ.get('INGESTA_PAYLOAD') or 'payload.json') as f:
+        vals = json.load(f)
+    if os.environ.get('PFX_PATH'):
+        vals = inyectar_certificado_en_data(
+            vals, os.environ['PFX_PATH'], os.environ.get('PFX_PASS'),
+            os.environ.get('RUT_FIRMANTE'))
+    for grupo in vals.get('Documento', []):
+        vals = inyectar_caf_en_data(
+            vals, grupo.get('TipoDTE', 39),
+            caf_path=os.environ.get('CAF_PATH'))
+    resumen = emitir(
+        vals,
+        leer_filas(sys.argv[1],
+                   delimitador=os.environ.get('INGESTA_DELIMITADOR') or ','),
+        sys.argv[2])
+    print("%s documentos, %s sobres -> %s" % (
+        resumen['documentos'], len(resumen['sobres']), sys.argv[2]))
+    if resumen['errores']:
+        print("Errores: %s" % resumen['errores'])
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+"""
+Instrumentación opcional de la emisión: duración y tamaño de cada etapa.
+
+Cada etapa instrumentada (timbrar, DTE.timbrar, DTE.set_barcode,
+Firma.firmar, validar_xml, Envio.generate_xml_send y las llamadas de
+Conexion al SII) abre un span; al cerrarlo se llama a los callbacks
+registrados con un Evento. Sin callbacks registrados un span no mide nada,
+así que el costo cuando está apagado es una comparación.
+
+    metricas = MetricasPrometheus()
+    registrar(metricas)
+    ...
+    texto = metricas.exportar()    # formato de texto de Prometheus
+
+    registrar(LogEstructurado())   # una línea JSON por etapa en el log
+
+También se activa con SII_METRICAS: 'log' registra LogEstructurado y
+'prometheus' registra `metricas` (instancia global de MetricasPrometheus).
+Se pueden combinar separadas por coma.
+
+Los spans propios se abren con `span('etapa', etiqueta=valor)` o con el
+decorador `medido('etapa')`.
+"""
+import collections
+import functools
+import json
+import os
+import threading
+import time
+
+import logging
+_logger = logging.getLogger(__name__)
+
+
+# Límites de los histogramas, en segundos.
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+           0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_callbacks = []
+_callbacks_lock = threading.Lock()
+
+Evento = collections.namedtuple(
+    'Evento', ['etapa', 'segundos', 'bytes', 'ok', 'etiquetas'])
+
+
+def registrar(callback):
+    """Registra `callback(evento)`; se llama al cerrar cada span."""
+    with _callbacks_lock:
+        if callback not in _callbacks:
+            _callbacks.append(callback)
+    return callback
+
+
+def quitar(callback):
+    with _callbacks_lock:
+        if callback in _callbacks:
+            _callbacks.remove(callback)
+
+
+def activo():
+    return bool(_callbacks)
+
+
+def _emitir(evento):
+    for callback in list(_callbacks):
+        try:
+            callback(evento)
+        except Exception:
+            _logger.warning("Error en callback de instrumentación",
+                            exc_info=True)
+
+
+class Span(object):
+    """Mide una etapa. `bytes` y `etiquetas` se pueden completar dentro del
+    bloque (por ejemplo con el tamaño del XML producido)."""
+
+    def __init__(self, etapa, etiquetas):
+        self.etapa = etapa
+        self.etiquetas = etiquetas
+        self.bytes = 0
+        self._inicio = None
+
+    def __enter__(self):
+        self._inicio = time.perf_counter()
+        return self
+
+    def __exit__(self, tipo, valor, traza):
+        _emitir(Evento(
+            self.etapa,
+            time.perf_counter() - self._inicio,
+            self.bytes,
+            tipo is None,
+            self.etiquetas,
+        ))
+        return False
+
+
+class _SpanNulo(object):
+    """Span cuando no hay callbacks: no mide ni emite."""
+    bytes = 0
+    etiquetas = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, tipo, valor, traza):
+        return False
+
+    def __setattr__(self, nombre, valor):
+        pass
+
+
+_NULO = _SpanNulo()
+
+
+def span(etapa, **etiquetas):
+    if not _callbacks:
+        return _NULO
+    return Span(etapa, etiquetas)
+
+
+def largo(valor):
+    """Tamaño en bytes/caracteres de un resultado (0 si no aplica)."""
+    if isinstance(valor, (str, bytes)):
+        return len(valor)
+    return 0
+
+
+def medido(etapa, tamano=None, etiquetas=None):
+    """Decorador: mide cada llamada como `etapa`. `tamano(resultado)` da los
+    bytes y `etiquetas(*args, **kwargs)` etiquetas adicionales."""
+    def decorador(funcion):
+        @functools.wraps(funcion)
+        def envoltura(*args, **kwargs):
+            if not _callbacks:
+                return funcion(*args, **kwargs)
+            with Span(etapa, etiquetas(*args, **kwargs)
+                      if etiquetas else {}) as s:
+                resultado = funcion(*args, **kwargs)
+                if tamano:
+                    s.bytes = tamano(resultado)
+                return resultado
+        return envoltura
+    return decorador
+
+
+def _etiquetas_prometheus(etiquetas):
+    if not etiquetas:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+        for k, v in sorted(etiquetas.items()))
+
+
+class MetricasPrometheus(object):
+    """Callback que acumula por etapa (y etiquetas) un contador de
+    llamadas y errores, un histograma de duración y el total de bytes, y los
+    exporta en el formato de texto de Prometheus."""
+
+    def __init__(self, prefijo='facturacion_electronica', buckets=BUCKETS):
+        self.prefijo = prefijo
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, evento):
+        etiquetas = dict(evento.etiquetas)
+        etiquetas['etapa'] = evento.etapa
+        clave = tuple(sorted(etiquetas.items()))
+        with self._lock:
+            serie = self._series.get(clave)
+            if serie is None:
+                serie = self._series[clave] = {
+                    'etiquetas': etiquetas,
+                    'cuenta': 0,
+                    'errores': 0,
+                    'suma': 0.0,
+                    'bytes': 0,
+                    'buckets': [0] * len(self.buckets),
+                }
+            serie['cuenta'] += 1
+            serie['suma'] += evento.segundos
+            serie['bytes'] += evento.bytes
+            if not evento.ok:
+                serie['errores'] += 1
+            for i, limite in enumerate(self.buckets):
+                if evento.segundos <= limite:
+                    serie['buckets'][i] += 1
+
+    def series(self):
+        with self._lock:
+            return [dict(s, buckets=list(s['buckets']))
+                    for s in self._series.values()]
+
+    def limpiar(self):
+        with self._lock:
+            self._series = {}
+
+    def exportar(self):
+        p = self.prefijo
+        lineas = [
+            '# HELP %s_etapa_segundos Duración de cada etapa de emisión.' % p,
+            '# TYPE %s_etapa_segundos histogram' % p,
+        ]
+        series = self.series()
+        for serie in series:
+            etiquetas = serie['etiquetas']
+            for limite, cuenta in zip(self.buckets, serie['buckets']):
+                lineas.append('%s_etapa_segundos_bucket%s %s' % (
+                    p, _etiquetas_prometheus(dict(etiquetas, le=limite)),
+                    cuenta))
+            lineas.append('%s_etapa_segundos_bucket%s %s' % (
+                p, _etiquetas_prometheus(dict(etiquetas, le='+Inf')),
+                serie['cuenta']))
+            lineas.append('%s_etapa_segundos_sum%s %s' % (
+                p, _etiquetas_prometheus(etiquetas), repr(serie['suma'])))
+            lineas.append('%s_etapa_segundos_count%s %s' % (
+                p, _etiquetas_prometheus(etiquetas), serie['cuenta']))
+        for nombre, campo, ayuda in [
+                ('errores_total', 'errores', 'Etapas que terminaron en error.'),
+                ('bytes_total', 'bytes', 'Bytes producidos o enviados por etapa.')]:
+            lineas.append('# HELP %s_%s %s' % (p, nombre, ayuda))
+            lineas.append('# TYPE %s_%s counter' % (p, nombre))
+            for serie in series:
+                lineas.append('%s_%s%s %s' % (
+                    p, nombre, _etiquetas_prometheus(serie['etiquetas']),
+                    serie[campo]))
+        return '\n'.join(lineas) + '\n'
+
+
+class LogEstructurado(object):
+    """Callback que escribe cada evento como una línea JSON en el log."""
+
+    def __init__(self, logger=None, nivel=logging.INFO):
+        self.logger = logger or _logger
+        self.nivel = nivel
+
+    def __call__(self, evento):
+        registro = {
+            'etapa': evento.etapa,
+            'ms': round(evento.segundos * 1000, 3),
+            'bytes': evento.bytes,
+            'ok': evento.ok,
+        }
+        registro.update(evento.etiquetas)
+        self.logger.log(self.nivel, json.dumps(registro, default=str))
+
+
+metricas = MetricasPrometheus()
+
+
+def _configurar():
+    for destino in (os.environ.get("SII_METRICAS") or '').split(','):
+        destino = destino.strip().lower()
+        if destino == 'log':
+            registrar(LogEstructurado())
+        elif destino == 'prometheus':
+            registrar(metricas)
+        elif destino:
+            _logger.warning("SII_METRICAS desconocido: %s" % destino)
+
+
+_configurar()
@@ -3,19 +3,33 @@ from facturacion_electronica import clase_util as util
 
 
 class LineaImpuesto(object):
-    tax_id = None
-    _base = 0
-    _base_otr_mnda = 0
+    # None: CredEC no informado, se calcula desde tax_id.
+    _defaults = {
+        'tax_id': None,
+        'MontoNoRet': 0,
+        '_activo_fijo': False,
+        '_base': 0,
+        '_base_otr_mnda': 0,
+        '_cantidad': 0,
+        '_credec': None,
+        '_moneda_decimales': 0,
+        '_monto_imp': 0,
+        '_monto_no_reten': 0,
+        '_monto_no_reten_otr_mnda': 0,
+        '_monto_reten': 0,
+        '_monto_reten_otr_mnda': 0,
+        '_vlr_imp_otr_mnda': 0,
+    }
+    __slots__ = tuple(_defaults)
 
     def __init__(self, vals):
+        util.set_defaults(self)
         util.set_from_keys(vals, priorizar=['moneda_decimales'])
         self.tax_id = vals['tax_id']
         self._compute_tax()
 
     @property
     def ActivoFijo(self):
-        if not hasattr(self, '_activo_fijo'):
-            return False
         return self._activo_fijo
 
     @ActivoFijo.setter
@@ -44,8 +58,6 @@ class LineaImpuesto(object):
 
     @property
     def cantidad(self):
-        if not hasattr(self, '_cantidad'):
-            return 0
         return self._cantidad
 
     @cantidad.setter
@@ -54,7 +66,7 @@ class LineaImpuesto(object):
 
     @property
     def CredEC(self):
-        if not hasattr(self, '_credec'):
+        if self._credec is None:
             if self.tax_id.CredEC:
                 return self.MontoImp * (self.tax_id.CredEC / 100.0)
             return 0.0
@@ -66,9 +78,7 @@ class LineaImpuesto(object):
 
     @property
     def moneda_decimales(self):
-        if not hasattr(self, '_moneda_decimales'):
-            return 0
-        self._moneda_decimales
+        return self._moneda_decimales
 
     @moneda_decimales.setter
     def moneda_decimales(self, val):
@@ -76,8 +86,6 @@ class LineaImpuesto(object):
 
     @property
     def MontoImp(self):
-        if not hasattr(self, '_monto_imp'):
-            return 0
         return self._monto_imp
 
     @MontoImp.setter
@@ -90,8 +98,6 @@ class LineaImpuesto(object):
 
     @property
     def MontoNoReten(self):
-        if not hasattr(self, '_monto_no_reten'):
-            return 0
         return self._monto_no_reten
 
     @MontoNoReten.setter
@@ -104,8 +110,6 @@ class LineaImpuesto(object):
 
     @property
     def MontoNoRetenOtrMnda(self):
-        if not hasattr(self, '_monto_no_reten_otr_mnda'):
-            return 0
         return self._monto_no_reten_otr_mnda
 
     @MontoNoRetenOtrMnda.setter
@@ -118,8 +122,6 @@ class LineaImpuesto(object):
 
     @property
     def MontoReten(self):
-        if not hasattr(self, '_monto_reten'):
-            return 0
         return self._monto_reten
 
     @MontoReten.setter
@@ -132,8 +134,6 @@ class LineaImpuesto(object):
 
     @property
     def MontoRetenOtrMnda(self):
-        if not hasattr(self, '_monto_reten_otr_mnda'):
-            return 0
         return self._monto_reten_otr_mnda
 
     @MontoRetenOtrMnda.setter
@@ -146,8 +146,6 @@ class LineaImpuesto(object):
 
     @property
     def VlrImpOtrMnda(self):
-        if not hasattr(self, '_vlr_imp_otr_mnda'):
-            return 0
         return self._vlr_imp_otr_mnda
 
     @VlrImpOtrMnda.setter
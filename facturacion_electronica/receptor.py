@@ -3,14 +3,27 @@ from facturacion_electronica import clase_util as util
 
 
 class Recep(object):
+    # None: campo no informado (el getter entrega su valor por defecto).
+    _defaults = {
+        '_cdg_sii_sucur': False,
+        '_ciudad_recep': None,
+        '_cmna_recep': None,
+        '_contacto': False,
+        '_correo_recep': None,
+        '_dir_recep': None,
+        '_giro_recep': None,
+        '_rzn_soc_recep': "Usuario Anonimo",
+        '_rut_recep': '66666666-6',
+        '_nacionalidad': False,
+    }
+    __slots__ = tuple(_defaults)
 
     def __init__(self, vals={}):
+        util.set_defaults(self)
         util.set_from_keys(self, vals)
 
     @property
     def CdgSIISucur(self):
-        if not hasattr(self, '_cdg_sii_sucur'):
-            return False
         return self._cdg_sii_sucur
 
     @CdgSIISucur.setter
@@ -19,7 +32,7 @@ class Recep(object):
 
     @property
     def CiudadRecep(self):
-        if not hasattr(self, '_ciudad_recep') or not self._ciudad_recep:
+        if not self._ciudad_recep:
             return ''
         return self._ciudad_recep[:20]
 
@@ -29,7 +42,7 @@ class Recep(object):
 
     @property
     def CmnaRecep(self):
-        if not hasattr(self, '_cmna_recep'):
+        if self._cmna_recep is None:
             return False
         return self._cmna_recep[:20]
 
@@ -39,8 +52,6 @@ class Recep(object):
 
     @property
     def Contacto(self):
-        if not hasattr(self, '_contacto'):
-            return False
         return self._contacto
 
     @Contacto.setter
@@ -49,7 +60,7 @@ class Recep(object):
 
     @property
     def CorreoRecep(self):
-        if not hasattr(self, '_correo_recep'):
+        if self._correo_recep is None:
             return False
         return self._correo_recep[:80]
 
@@ -59,7 +70,7 @@ class Recep(object):
 
     @property
     def DirRecep(self):
-        if not hasattr(self, '_dir_recep'):
+        if self._dir_recep is None:
             return False
         return self._dir_recep[:80]
 
@@ -69,7 +80,7 @@ class Recep(object):
 
     @property
     def GiroRecep(self):
-        if not hasattr(self, '_giro_recep'):
+        if self._giro_recep is None:
             return False
         return self._giro_recep[:40]
 
@@ -79,8 +90,6 @@ class Recep(object):
 
     @property
     def RznSocRecep(self):
-        if not hasattr(self, '_rzn_soc_recep'):
-            return "Usuario Anonimo"
         return self._rzn_soc_recep[:100]
 
     @RznSocRecep.setter
@@ -89,8 +98,6 @@ class Recep(object):
 
     @property
     def RUTRecep(self):
-        if not hasattr(self, '_rut_recep'):
-            return '66666666-6'
         return self._rut_recep[:10]
 
     @RUTRecep.setter
@@ -99,8 +106,6 @@ class Recep(object):
 
     @property
     def Nacionalidad(self):
-        if not hasattr(self, '_nacionalidad'):
-            return False
         return self._nacionalidad
 
     @Nacionalidad.setter
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+"""
+Política de reintentos común para las llamadas al SII.
+
+- Backoff exponencial con jitter ("full jitter"): entre 0 y
+  min(SII_REINTENTO_MAXIMO, SII_REINTENTO_BASE * 2**intento) segundos.
+- Presupuesto total por llamada (SII_REINTENTO_DEADLINE segundos) además del
+  número máximo de intentos (SII_REINTENTOS).
+- Clasificación de errores: los de red/timeout y HTTP 5xx/429 se reintentan;
+  los SOAP Fault, errores de esquema/WSDL y errores de programación no.
+- Circuit breaker por endpoint (host): tras SII_CIRCUITO_FALLAS fallas
+  seguidas se abre y las llamadas fallan de inmediato durante
+  SII_CIRCUITO_REPOSO segundos; luego se deja pasar una llamada de prueba.
+"""
+import os
+import random
+import threading
+import time
+from urllib.parse import urlparse
+from facturacion_electronica.clase_util import UserError
+
+import logging
+_logger = logging.getLogger(__name__)
+
+try:
+    from zeep import exceptions as zeep_exceptions
+except ImportError:
+    zeep_exceptions = None
+
+
+_circuitos = {}
+_circuitos_lock = threading.Lock()
+
+
+def _env(nombre, defecto):
+    try:
+        return type(defecto)(os.environ.get(nombre) or defecto)
+    except ValueError:
+        return defecto
+
+
+class CircuitoAbierto(UserError):
+    pass
+
+
+def endpoint_de(url):
+    """Clave del circuito: el host del servicio (maullin, palena, api...)."""
+    return urlparse(url).netloc or url
+
+
+def es_reintentable(error):
+    if isinstance(error, (CircuitoAbierto, UserError, TypeError,
+                          AttributeError, KeyError, NameError)):
+        return False
+    if zeep_exceptions is not None:
+        if isinstance(error, zeep_exceptions.TransportError):
+            return error.status_code in (0, 429) or error.status_code >= 500
+        if isinstance(error, zeep_exceptions.Error):
+            # Fault, ValidationError, XMLSyntaxError, WsdlSyntaxError...
+            return False
+    return True
+
+
+class Circuito(object):
+
+    def __init__(self, endpoint, fallas=None, reposo=None):
+        self.endpoint = endpoint
+        self.fallas = fallas or _env("SII_CIRCUITO_FALLAS", 5)
+        self.reposo = reposo or _env("SII_CIRCUITO_REPOSO", 30.0)
+        self._fallas = 0
+        self._abierto_hasta = 0
+        self._probando = False
+        self._lock = threading.Lock()
+
+    @property
+    def abierto(self):
+        return self._fallas >= self.fallas \
+            and time.monotonic() < self._abierto_hasta
+
+    def permitir(self):
+        with self._lock:
+            if self._fallas < self.fallas:
+                return True
+            if time.monotonic() < self._abierto_hasta or self._probando:
+                return False
+            # Semiabierto: una sola llamada de prueba.
+            self._probando = True
+            return True
+
+    def exito(self):
+        with self._lock:
+            self._fallas = 0
+            self._probando = False
+
+    def falla(self):
+        with self._lock:
+            self._fallas += 1
+            self._probando = False
+            if self._fallas >= self.fallas:
+                self._abierto_hasta = time.monotonic() + self.reposo
+                _logger.warning(
+                    "Circuito abierto para %s por %ss" % (
+                        self.endpoint, self.reposo))
+
+
+def get_circuito(endpoint):
+    with _circuitos_lock:
+        circuito = _circuitos.get(endpoint)
+        if circuito is None:
+            circuito = _circuitos[endpoint] = Circuito(endpoint)
+    return circuito
+
+
+class PoliticaReintentos(object):
+
+    def __init__(self, intentos=None, base=None, maximo=None, deadline=None):
+        self.intentos = intentos or _env("SII_REINTENTOS", 6)
+        self.base = base or _env("SII_REINTENTO_BASE", 0.5)
+        self.maximo = maximo or _env("SII_REINTENTO_MAXIMO", 4.0)
+        self.deadline = deadline or _env("SII_REINTENTO_DEADLINE", 15.0)
+
+    def espera(self, intento):
+        return random.uniform(0, min(self.maximo, self.base * 2 ** intento))
+
+    def ejecutar(self, funcion, url, reintentar_vacio=True):
+        """Ejecuta `funcion()` contra el endpoint de `url`. Una respuesta vacía
+        también se reintenta (el SII a veces responde sin contenido); si se
+        agotan los intentos se retorna esa respuesta vacía o se re-lanza el
+        último error."""
+        circuito = get_circuito(endpoint_de(url))
+        limite = time.monotonic() + self.deadline
+        resultado = False
+        for intento in range(self.intentos):
+            if not circuito.permitir():
+                raise CircuitoAbierto(
+                    "SII no disponible (%s), reintente en %ss" % (
+                        circuito.endpoint, circuito.reposo))
+            try:
+                resultado = funcion()
+            except Exception as e:
+                if not es_reintentable(e):
+                    # El servicio respondió: el error es de la consulta.
+                    circuito.exito()
+                    raise
+                circuito.falla()
+                _logger.info("Reintento %s a %s: %s" % (
+                    intento + 1, circuito.endpoint, str(e)))
+                error = e
+            else:
+                circuito.exito()
+                if resultado or not reintentar_vacio:
+                    return resultado
+                error = None
+            espera = self.espera(intento)
+            if intento + 1 >= self.intentos \
+                    or time.monotonic() + espera > limite:
+                break
+            time.sleep(espera)
+        if error is not None:
+            raise error
+        return resultado
+
+
+politica = PoliticaReintentos()
+
+
+def ejecutar(funcion, url, reintentar_vacio=True):
+    return politica.ejecutar(funcion, url, reintentar_vacio)
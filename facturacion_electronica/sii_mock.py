@@ -0,0 +1,514 @@
+# -*- coding: utf-8 -*-
+"""
+Servidor local que imita los servicios del SII que usa conexion, para
+probar y medir el envío y el tracking sin red, certificado real ni TRACK_ID.
+
+Atiende la API de boletas (boleta.electronica.semilla / token / envio, estado
+de envío y de boleta), DTEUpload y los servicios SOAP CrSeed,
+GetTokenFromSeed, QueryEstUp y QueryEstDte (con su WSDL). Los tokens y track
+ids que entrega son propios: un token desconocido se rechaza igual que en el
+SII, así que también se ejercita la renovación de token.
+
+    with ServidorSII(latencia=0.05, tasa_error=0.1) as sii:
+        data['Emisor']['Modo'] = 'local'
+        resultado = fe.timbrar_y_enviar(data)
+
+Al iniciar, el servidor apunta el Modo 'local' de conexion a su URL. También
+se puede levantar aparte (python -m facturacion_electronica.sii_mock) y
+apuntar los clientes con SII_URL_LOCAL.
+"""
+import collections
+import email
+import itertools
+import json
+import os
+import random
+import re
+import threading
+import time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+from xml.sax.saxutils import escape
+from lxml import etree
+from facturacion_electronica import conexion
+
+import logging
+_logger = logging.getLogger(__name__)
+
+
+API = '/recursos/v1/'
+SOAP_ENV = 'http://schemas.xmlsoap.org/soap/envelope/'
+SII_XMLNS = 'http://www.sii.cl/XMLSchema'
+# Servicio SOAP: (operación, parámetros) en el orden del SII.
+SERVICIOS = {
+    'CrSeed': ('getSeed', []),
+    'GetTokenFromSeed': ('getToken', ['pszXml']),
+    'QueryEstUp': ('getEstUp', [
+        'RutCompania', 'DvCompania', 'TrackId', 'Token']),
+    'QueryEstDte': ('getEstDte', [
+        'RutConsultante', 'DvConsultante', 'RutCompania', 'DvCompania',
+        'RutReceptor', 'DvReceptor', 'TipoDte', 'FolioDte',
+        'FechaEmisionDte', 'MontoDte', 'Token']),
+}
+GLOSAS_DTE = {
+    'DOK': 'Documento Recibido por el SII. Datos Coinciden con los Registrados',
+    'DNK': 'Documento Recibido por el SII pero Datos NO Coinciden con los registrados',
+    'FAU': 'Documento No Recibido por el SII',
+}
+
+WSDL = '''<?xml version="1.0" encoding="UTF-8"?>
+<wsdl:definitions targetNamespace="{ns}" xmlns:impl="{ns}" \
+xmlns:wsdl="http://schemas.xmlsoap.org/wsdl/" \
+xmlns:wsdlsoap="http://schemas.xmlsoap.org/wsdl/soap/" \
+xmlns:xsd="http://www.w3.org/2001/XMLSchema">
+ <wsdl:message name="{op}Request">{partes}</wsdl:message>
+ <wsdl:message name="{op}Response">\
+<wsdl:part name="{op}Return" type="xsd:string"/></wsdl:message>
+ <wsdl:portType name="{servicio}">
+  <wsdl:operation name="{op}">
+   <wsdl:input message="impl:{op}Request"/>
+   <wsdl:output message="impl:{op}Response"/>
+  </wsdl:operation>
+ </wsdl:portType>
+ <wsdl:binding name="{servicio}SoapBinding" type="impl:{servicio}">
+  <wsdlsoap:binding style="rpc" transport="http://schemas.xmlsoap.org/soap/http"/>
+  <wsdl:operation name="{op}">
+   <wsdlsoap:operation soapAction=""/>
+   <wsdl:input><wsdlsoap:body use="literal" namespace="{ns}"/></wsdl:input>
+   <wsdl:output><wsdlsoap:body use="literal" namespace="{ns}"/></wsdl:output>
+  </wsdl:operation>
+ </wsdl:binding>
+ <wsdl:service name="{servicio}Service">
+  <wsdl:port binding="impl:{servicio}SoapBinding" name="{servicio}">
+   <wsdlsoap:address location="{location}"/>
+  </wsdl:port>
+ </wsdl:service>
+</wsdl:definitions>'''
+
+
+def _env(nombre, defecto):
+    try:
+        return type(defecto)(os.environ.get(nombre) or defecto)
+    except ValueError:
+        return defecto
+
+
+def respuesta_sii(hdr, body=None):
+    """XML de respuesta con el formato de los servicios del SII. `hdr` y
+    `body` son dict o listas de pares (tag, valor)."""
+    def _nodos(valores):
+        if isinstance(valores, dict):
+            valores = valores.items()
+        return ''.join('<%s>%s</%s>' % (k, escape(str(v)), k)
+                       for k, v in valores)
+    xml = '<SII:RESPUESTA xmlns:SII="%s">' % SII_XMLNS
+    if body is not None:
+        xml += '<SII:RESP_BODY>%s</SII:RESP_BODY>' % _nodos(body)
+    xml += '<SII:RESP_HDR>%s</SII:RESP_HDR></SII:RESPUESTA>' % _nodos(hdr)
+    return '<?xml version="1.0" encoding="UTF-8"?>' + xml
+
+
+class ServidorSII(object):
+    """Servidor en un hilo. `latencia` (segundos, con `jitter` aleatorio)
+    se aplica a cada petición; `tasa_error` es la fracción de peticiones que
+    responde `codigo_error` (503 por defecto) y fallar(n) fuerza las n
+    siguientes. `estado_envio` y `estado_dte` son los estados que responde
+    el tracking."""
+
+    def __init__(self, host='127.0.0.1', port=None, latencia=None,
+                 jitter=None, tasa_error=None, codigo_error=503,
+                 estado_envio='EPR', estado_dte='DOK', registrar=True):
+        self.host = host
+        self.port = _env("SII_MOCK_PORT", 0) if port is None else port
+        self.latencia = _env("SII_MOCK_LATENCIA", 0.0) \
+            if latencia is None else latencia
+        self.jitter = _env("SII_MOCK_JITTER", 0.0) if jitter is None else jitter
+        self.tasa_error = _env("SII_MOCK_ERRORES", 0.0) \
+            if tasa_error is None else tasa_error
+        self.codigo_error = codigo_error
+        self.estado_envio = estado_envio
+        self.estado_dte = estado_dte
+        self.registrar = registrar
+        self.envios = {}
+        self.peticiones = collections.Counter()
+        self._semillas = set()
+        self._tokens = set()
+        self._fallas = 0
+        self._secuencia = itertools.count(1)
+        self._lock = threading.Lock()
+        self._server = None
+        self._hilo = None
+
+    def __enter__(self):
+        return self.iniciar()
+
+    def __exit__(self, *args):
+        self.detener()
+
+    @property
+    def url(self):
+        return 'http://%s:%s/' % (self.host, self._server.server_port)
+
+    def iniciar(self):
+        handler = type('Handler', (_Handler,), {'sii': self})
+        self._server = ThreadingHTTPServer((self.host, self.port), handler)
+        self._server.daemon_threads = True
+        self._hilo = threading.Thread(
+            target=self._server.serve_forever, daemon=True)
+        self._hilo.start()
+        if self.registrar:
+            conexion.set_url_local(self.url)
+        _logger.info("SII local en %s" % self.url)
+        return self
+
+    def detener(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def fallar(self, n=1):
+        """Las próximas `n` peticiones responden `codigo_error`."""
+        with self._lock:
+            self._fallas += n
+
+    def revocar_tokens(self):
+        """Invalida los tokens entregados, como si hubieran vencido."""
+        with self._lock:
+            self._tokens.clear()
+
+    def _siguiente(self):
+        return next(self._secuencia)
+
+    def _falla(self):
+        with self._lock:
+            if self._fallas:
+                self._fallas -= 1
+                return True
+        return self.tasa_error and random.random() < self.tasa_error
+
+    def _esperar(self):
+        espera = self.latencia
+        if self.jitter:
+            espera += random.uniform(0, self.jitter)
+        if espera > 0:
+            time.sleep(espera)
+
+    def semilla(self):
+        semilla = '%012d' % self._siguiente()
+        with self._lock:
+            self._semillas.add(semilla)
+        return semilla
+
+    def token(self, xml):
+        """Token para una semilla entregada y firmada; False si no."""
+        try:
+            root = etree.fromstring(xml.encode('UTF-8') if isinstance(
+                xml, str) else xml)
+        except etree.XMLSyntaxError:
+            return False
+        semilla = root.findtext('.//Semilla')
+        firmado = root.find(
+            './/{http://www.w3.org/2000/09/xmldsig#}SignatureValue')
+        with self._lock:
+            if semilla not in self._semillas or firmado is None:
+                return False
+            self._semillas.discard(semilla)
+            token = 'TK%010d' % self._siguiente()
+            self._tokens.add(token)
+        return token
+
+    def token_valido(self, token):
+        with self._lock:
+            return token in self._tokens
+
+    def recibir(self, rut_emisor, rut_envia, nombre, archivo):
+        """Registra un envío y retorna su track id."""
+        tipos = collections.Counter(
+            re.findall(rb'<TipoDTE>(\d+)</TipoDTE>', archivo))
+        track_id = str(self._siguiente())
+        with self._lock:
+            self.envios[track_id] = {
+                'rut_emisor': rut_emisor,
+                'rut_envia': rut_envia,
+                'archivo': nombre,
+                'bytes': len(archivo),
+                'documentos': archivo.count(b'<DTE '),
+                'tipos': {int(k): v for k, v in tipos.items()},
+                'fecha': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            }
+        return track_id
+
+
+def _endpoint(ruta):
+    """Nombre del servicio para las estadísticas, sin RUT ni track id."""
+    if ruta.startswith(API):
+        return ruta[len(API):].split('/')[0]
+    return ruta
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    sii = None
+
+    def log_message(self, formato, *args):
+        _logger.debug(formato % args)
+
+    def _responder(self, status, cuerpo, content_type='application/json'):
+        if isinstance(cuerpo, str):
+            cuerpo = cuerpo.encode('UTF-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(cuerpo)))
+        self.end_headers()
+        self.wfile.write(cuerpo)
+
+    def _json(self, valores, status=200):
+        self._responder(status, json.dumps(valores))
+
+    def _xml(self, xml, status=200):
+        self._responder(status, xml, 'text/xml; charset=UTF-8')
+
+    def _cuerpo(self):
+        largo = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(largo) if largo else b''
+
+    def _token(self):
+        cookie = self.headers.get('Cookie') or ''
+        token = re.search(r'TOKEN=([^;\s]+)', cookie)
+        return token and token.group(1)
+
+    def _atender(self, metodo):
+        sii = self.sii
+        ruta = urlparse(self.path).path
+        cuerpo = self._cuerpo() if metodo == 'POST' else b''
+        sii.peticiones[_endpoint(ruta)] += 1
+        sii._esperar()
+        if sii._falla():
+            self._responder(
+                sii.codigo_error, 'Servicio no disponible', 'text/plain')
+            return
+        if ruta.startswith(API):
+            self._api(metodo, ruta[len(API):], cuerpo)
+        elif ruta == '/cgi_dte/UPL/DTEUpload' and metodo == 'POST':
+            self._upload(cuerpo)
+        elif ruta.startswith('/DTEWS/') and ruta.endswith('.jws'):
+            self._soap(metodo, ruta[len('/DTEWS/'):-len('.jws')], cuerpo)
+        else:
+            self._responder(404, 'Not Found', 'text/plain')
+
+    def do_GET(self):
+        self._atender('GET')
+
+    def do_POST(self):
+        self._atender('POST')
+
+    def _api(self, metodo, recurso, cuerpo):
+        sii = self.sii
+        if recurso == 'boleta.electronica.semilla' and metodo == 'GET':
+            self._xml(respuesta_sii(
+                {'ESTADO': '00'}, {'SEMILLA': sii.semilla()}))
+            return
+        if recurso == 'boleta.electronica.token' and metodo == 'POST':
+            token = sii.token(cuerpo)
+            if not token:
+                self._xml(respuesta_sii({
+                    'ESTADO': '-07', 'GLOSA': 'Error de Firma'}))
+                return
+            self._xml(respuesta_sii({'ESTADO': '00'}, {'TOKEN': token}))
+            return
+        if not sii.token_valido(self._token()):
+            self._json({'error': 'NO ESTA AUTENTICADO'}, 401)
+            return
+        if recurso == 'boleta.electronica.envio' and metodo == 'POST':
+            campos, nombre, archivo = self._multipart(cuerpo)
+            rut_emisor = '%s-%s' % (campos.get('rutCompany'),
+                                    campos.get('dvCompany'))
+            rut_envia = '%s-%s' % (campos.get('rutSender'),
+                                   campos.get('dvSender'))
+            track_id = sii.recibir(rut_emisor, rut_envia, nombre, archivo)
+            envio = sii.envios[track_id]
+            self._json({
+                'rut_emisor': rut_emisor,
+                'rut_envia': rut_envia,
+                'trackid': int(track_id),
+                'fecha_recepcion': envio['fecha'],
+                'estado': 'REC',
+                'file': nombre,
+            })
+            return
+        envio = re.match(
+            r'boleta\.electronica\.envio/(\d+)-(\w)-(\d+)$', recurso)
+        if envio and metodo == 'GET':
+            self._estado_envio_api(envio.group(3))
+            return
+        dte = re.match(
+            r'boleta\.electronica/(\d+)-(\w)-(\d+)-(\d+)/estado$', recurso)
+        if dte and metodo == 'GET':
+            codigo = sii.estado_dte
+            self._json({
+                'codigo': codigo,
+                'descripcion': GLOSAS_DTE.get(codigo, codigo),
+            })
+            return
+        self._json({'error': 'recurso no encontrado'}, 404)
+
+    def _estado_envio_api(self, track_id):
+        sii = self.sii
+        envio = sii.envios.get(track_id)
+        if not envio:
+            self._json({'error': 'trackid no encontrado'}, 404)
+            return
+        rechazo = sii.estado_envio in ('RCT', 'RFR', 'RSC', 'RCH')
+        self._json({
+            'rut_emisor': envio['rut_emisor'],
+            'rut_envia': envio['rut_envia'],
+            'trackid': int(track_id),
+            'fecha_recepcion': envio['fecha'],
+            'estado': sii.estado_envio,
+            'estadistica': [{
+                'tipo': tipo,
+                'informados': cantidad,
+                'aceptados': 0 if rechazo else cantidad,
+                'rechazados': cantidad if rechazo else 0,
+                'reparos': 0,
+            } for tipo, cantidad in envio['tipos'].items()],
+            'detalle_rep_rech': [],
+        })
+
+    def _multipart(self, cuerpo):
+        mensaje = email.message_from_bytes(
+            b'Content-Type: ' + self.headers.get(
+                'Content-Type', '').encode() + b'\r\n\r\n' + cuerpo)
+        campos = {}
+        nombre, archivo = '', b''
+        for parte in mensaje.walk():
+            campo = parte.get_param('name', header='content-disposition')
+            if not campo:
+                continue
+            datos = parte.get_payload(decode=True) or b''
+            if campo == 'archivo':
+                nombre = parte.get_filename() or ''
+                archivo = datos
+            else:
+                campos[campo] = datos.decode('ISO-8859-1')
+        return campos, nombre, archivo
+
+    def _upload(self, cuerpo):
+        sii = self.sii
+        campos, nombre, archivo = self._multipart(cuerpo)
+        rut_envia = '%s-%s' % (campos.get('rutSender'), campos.get('dvSender'))
+        rut_emisor = '%s-%s' % (campos.get('rutCompany'),
+                                campos.get('dvCompany'))
+        respuesta = collections.OrderedDict([
+            ('RUTSENDER', rut_envia),
+            ('RUTCOMPANY', rut_emisor),
+            ('FILE', nombre),
+            ('TIMESTAMP', datetime.now().strftime('%Y-%m-%d %H:%M:%S')),
+        ])
+        if not sii.token_valido(self._token()):
+            respuesta['STATUS'] = '5'
+        else:
+            respuesta['STATUS'] = '0'
+            respuesta['TRACKID'] = sii.recibir(
+                rut_emisor, rut_envia, nombre, archivo)
+        self._xml('<?xml version="1.0"?><RECEPCIONDTE>%s</RECEPCIONDTE>' % (
+            ''.join('<%s>%s</%s>' % (k, escape(v), k)
+                    for k, v in respuesta.items())))
+
+    def _soap(self, metodo, servicio, cuerpo):
+        if servicio not in SERVICIOS:
+            self._responder(404, 'Not Found', 'text/plain')
+            return
+        op, parametros = SERVICIOS[servicio]
+        ns = 'http://DefaultNamespace'
+        if metodo == 'GET':
+            location = 'http://%s/DTEWS/%s.jws' % (
+                self.headers.get('Host'), servicio)
+            self._xml(WSDL.format(
+                ns=ns, op=op, servicio=servicio, location=location,
+                partes=''.join(
+                    '<wsdl:part name="%s" type="xsd:string"/>' % p
+                    for p in parametros)))
+            return
+        try:
+            llamada = etree.fromstring(cuerpo).find(
+                '{%s}Body' % SOAP_ENV)[0]
+        except (etree.XMLSyntaxError, TypeError, IndexError):
+            self._responder(400, 'Bad Request', 'text/plain')
+            return
+        args = dict(zip(parametros, [c.text or '' for c in llamada]))
+        retorno = getattr(self, '_' + op)(**args)
+        self._xml(
+            '<?xml version="1.0" encoding="UTF-8"?>'
+            '<soapenv:Envelope xmlns:soapenv="%s"><soapenv:Body>'
+            '<ns1:%sResponse xmlns:ns1="%s"><%sReturn>%s</%sReturn>'
+            '</ns1:%sResponse></soapenv:Body></soapenv:Envelope>' % (
+                SOAP_ENV, op, ns, op, escape(retorno), op, op))
+
+    def _getSeed(self):
+        return respuesta_sii({'ESTADO': '00'}, {'SEMILLA': self.sii.semilla()})
+
+    def _getToken(self, pszXml):
+        token = self.sii.token(pszXml)
+        if not token:
+            return respuesta_sii({'ESTADO': '-07', 'GLOSA': 'Error de Firma'})
+        return respuesta_sii({'ESTADO': '00', 'GLOSA': 'Token Creado'},
+                             {'TOKEN': token})
+
+    def _token_rechazado(self, token):
+        if self.sii.token_valido(token):
+            return False
+        return respuesta_sii({'ESTADO': '001', 'GLOSA': 'TOKEN NO EXISTE'})
+
+    def _getEstUp(self, RutCompania, DvCompania, TrackId, Token):
+        sii = self.sii
+        rechazo = self._token_rechazado(Token)
+        if rechazo:
+            return rechazo
+        envio = sii.envios.get(TrackId)
+        if not envio:
+            return respuesta_sii({
+                'TRACKID': TrackId, 'ESTADO': '-11', 'ERR_CODE': '1',
+                'GLOSA_ERR': 'Envio no encontrado'})
+        rechazado = sii.estado_envio in ('RCT', 'RFR', 'RSC', 'RCH')
+        body = []
+        for tipo, cantidad in envio['tipos'].items():
+            body.extend([
+                ('TIPO_DOCTO', tipo),
+                ('INFORMADOS', cantidad),
+                ('ACEPTADOS', 0 if rechazado else cantidad),
+                ('RECHAZADOS', cantidad if rechazado else 0),
+                ('REPAROS', 0),
+            ])
+        return respuesta_sii(collections.OrderedDict([
+            ('TRACKID', TrackId),
+            ('ESTADO', sii.estado_envio),
+            ('GLOSA', 'Envio Procesado'),
+            ('NUM_ATENCION', self.sii._siguiente()),
+        ]), body)
+
+    def _getEstDte(self, **args):
+        rechazo = self._token_rechazado(args.get('Token'))
+        if rechazo:
+            return rechazo
+        codigo = self.sii.estado_dte
+        return respuesta_sii(collections.OrderedDict([
+            ('ESTADO', codigo),
+            ('GLOSA_ESTADO', GLOSAS_DTE.get(codigo, codigo)),
+            ('ERR_CODE', '0'),
+            ('NUM_ATENCION', self.sii._siguiente()),
+        ]))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    servidor = ServidorSII(
+        port=_env("SII_MOCK_PORT", 8089), registrar=False).iniciar()
+    print("SII local en %s (export SII_URL_LOCAL=%s)" % (
+        servidor.url, servidor.url))
+    try:
+        servidor._hilo.join()
+    except KeyboardInterrupt:
+        servidor.detener()
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+"""
+Cache de tokens SII compartido entre instancias de Conexion.
+
+La clave es (RUTEmisor, Modo, api, rut_firmante) y cada token vive
+SII_TOKEN_TTL segundos (por defecto 3000, bajo la hora de vigencia del SII).
+Backends (env var SII_TOKEN_CACHE):
+- 'memory' (por defecto): por proceso.
+- 'sqlite': archivo SII_TOKEN_CACHE_PATH, compartido entre procesos y
+  ejecuciones de CLI.
+- 'none': sin cache, un token nuevo por Conexion (comportamiento original).
+"""
+import os
+import sqlite3
+import threading
+import time
+from facturacion_electronica.clase_util import UserError
+
+
+DEFAULT_TTL = 3000
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def token_ttl():
+    try:
+        return int(os.environ.get("SII_TOKEN_TTL") or DEFAULT_TTL)
+    except ValueError:
+        return DEFAULT_TTL
+
+
+def default_cache_path():
+    env_path = os.environ.get("SII_TOKEN_CACHE_PATH")
+    if env_path:
+        return env_path
+    base_dir = os.path.dirname(__file__)
+    out_dir = os.path.join(base_dir, "out")
+    os.makedirs(out_dir, exist_ok=True)
+    return os.path.join(out_dir, "token_cache.sqlite3")
+
+
+def get_token_cache(backend=None, path=None):
+    """Retorna (y reutiliza dentro del proceso) el cache configurado."""
+    backend = backend or os.environ.get("SII_TOKEN_CACHE") or 'memory'
+    if backend not in ['memory', 'sqlite', 'none']:
+        raise UserError("SII_TOKEN_CACHE no soportado: %s" % backend)
+    if backend == 'sqlite':
+        path = os.path.abspath(path or default_cache_path())
+    key = (backend, path)
+    with _caches_lock:
+        cache = _caches.get(key)
+        if cache is None:
+            if backend == 'sqlite':
+                cache = SqliteTokenCache(path)
+            elif backend == 'memory':
+                cache = MemoryTokenCache()
+            else:
+                cache = NullTokenCache()
+            _caches[key] = cache
+    return cache
+
+
+def _cache_key(key):
+    return '|'.join(str(k) for k in key)
+
+
+class NullTokenCache(object):
+
+    def get(self, key):
+        return None
+
+    def set(self, key, token, ttl=None):
+        pass
+
+    def invalidate(self, key, token=None):
+        pass
+
+
+class MemoryTokenCache(NullTokenCache):
+
+    def __init__(self):
+        self._tokens = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            val = self._tokens.get(_cache_key(key))
+        if not val or val[1] <= time.time():
+            return None
+        return val[0]
+
+    def set(self, key, token, ttl=None):
+        if not token:
+            return
+        expira = time.time() + (ttl or token_ttl())
+        with self._lock:
+            self._tokens[_cache_key(key)] = (token, expira)
+
+    def invalidate(self, key, token=None):
+        """Elimina el token; si se indica `token`, solo si sigue siendo ese
+        (otro proceso/hilo pudo haberlo renovado ya)."""
+        with self._lock:
+            val = self._tokens.get(_cache_key(key))
+            if val and (token is None or val[0] == token):
+                del self._tokens[_cache_key(key)]
+
+
+class SqliteTokenCache(NullTokenCache):
+
+    def __init__(self, path):
+        self.path = path
+        self._conn = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def conn(self):
+        if self._conn is None or self._pid != os.getpid():
+            conn = sqlite3.connect(
+                self.path,
+                timeout=30,
+                isolation_level=None,
+                check_same_thread=False,
+            )
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS sii_token ("
+                "key TEXT PRIMARY KEY, token TEXT NOT NULL, "
+                "expira REAL NOT NULL)"
+            )
+            self._conn = conn
+            self._pid = os.getpid()
+        return self._conn
+
+    def get(self, key):
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT token FROM sii_token WHERE key = ? AND expira > ?",
+                (_cache_key(key), time.time())).fetchone()
+        return row[0] if row else None
+
+    def set(self, key, token, ttl=None):
+        if not token:
+            return
+        expira = time.time() + (ttl or token_ttl())
+        with self._lock:
+            self.conn.execute(
+                "INSERT INTO sii_token (key, token, expira) VALUES (?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET "
+                "token = excluded.token, expira = excluded.expira",
+                (_cache_key(key), token, expira),
+            )
+
+    def invalidate(self, key, token=None):
+        query = "DELETE FROM sii_token WHERE key = ?"
+        params = (_cache_key(key),)
+        if token is not None:
+            query += " AND token = ?"
+            params += (token,)
+        with self._lock:
+            self.conn.execute(query, params)
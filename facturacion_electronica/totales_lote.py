@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+"""
+Totales de muchos documentos a la vez, con NumPy (dependencia opcional:
+pip install numpy), para precalcular por ejemplo todas las boletas de un día
+de caja sin armar un Documento por cada una.
+
+Recibe columnas por línea de detalle y entrega, por línea, DescuentoMonto y
+MontoItem, y por documento MntExe, MntNeto, MntIVA, ImptoReten, MontoNF y
+MntTotal, con las mismas reglas y redondeos que Documento y LineaDetalle
+(round0 es mitad hacia arriba sobre el valor binario exacto; los descuentos
+y recargos globales en % usan round, mitad al par).
+
+    columnas = columnas_desde_documentos(vals['Documento'][0]['documentos'])
+    totales = calcular(**columnas)
+    totales['MntTotal'][i]      # total del documento i
+
+Cubre: cantidad, precio y % de descuento por línea; IndExe 1 (exento), 2 y 6
+(no facturable, MontoNF); IVA (CodImp 14) o IVA retenido total (CodImp 15)
+con precio con o sin IVA incluido; un impuesto adicional ad valorem por línea
+(CodImp 17, 18, 19, 24, 25, 26, 27, 271) y descuento y recargo global en % a
+los afectos. Impuestos específicos, montos fijos de descuento o recargo,
+globales a exentos y otra moneda no están cubiertos: esos documentos se
+calculan con Documento.
+"""
+from facturacion_electronica.clase_util import UserError
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+ADICIONALES = [15, 17, 18, 19, 24, 25, 26, 27, 271]
+ESPECIFICOS = [28, 35]
+
+
+def round0(valores):
+    """util.round0 vectorizado: mitad alejándose de cero, calculado sobre el
+    valor binario exacto (x - floor(x) es exacto bajo 2**52)."""
+    valores = numpy.asarray(valores, dtype=numpy.float64)
+    absoluto = numpy.abs(valores)
+    entero = numpy.floor(absoluto)
+    entero += (absoluto - entero) >= 0.5
+    return numpy.copysign(entero, valores).astype(numpy.int64)
+
+
+def _columna(valor, largo, dtype, defecto=0):
+    if valor is None:
+        return numpy.full(largo, defecto, dtype=dtype)
+    valor = numpy.asarray(valor, dtype=dtype)
+    if valor.ndim == 0:
+        return numpy.full(largo, valor, dtype=dtype)
+    if len(valor) != largo:
+        raise UserError("Columna de largo %s, se esperaba %s" % (
+            len(valor), largo))
+    return valor
+
+
+def _aplicar_dsc_rcg(monto, dsc, rcg):
+    """Documento._aplicar_dsc_rcg con un descuento y un recargo en % por
+    documento. Con monto negativo, GlobalDescuentoRecargo.get_monto entrega
+    el % tal cual."""
+    monto = monto.astype(numpy.float64)
+    con_gdr = (dsc != 0) | (rcg != 0)
+    positivo = monto > 0
+    d = numpy.where(positivo, numpy.round(monto * (dsc / 100.0)), dsc)
+    r = numpy.where(positivo, numpy.round(monto * (rcg / 100.0)), rcg)
+    aplicado = round0(monto + (r - d))
+    return numpy.where(con_gdr & (monto != 0), aplicado, monto).astype(
+        numpy.int64)
+
+
+def calcular(doc, QtyItem, PrcItem, DescuentoPct=None, IndExe=None,
+             CodImp=None, CodImpAdic=None, TasaImpAdic=None,
+             price_include=True, DscGlobalPct=None, RcgGlobalPct=None,
+             TasaIVA=19, documentos=None):
+    """Totales por documento.
+
+    Columnas por línea (mismo largo): `doc` (índice 0..n-1 del documento),
+    QtyItem, PrcItem, DescuentoPct, IndExe, CodImp (14 o 15), CodImpAdic y
+    TasaImpAdic (0 = sin adicional) y price_include. Columnas por documento:
+    DscGlobalPct y RcgGlobalPct. Las columnas opcionales aceptan un escalar.
+    En cada documento, price_include y la tasa de un impuesto son los de la
+    primera línea que lo lleva, como en Documento."""
+    if numpy is None:
+        raise UserError("Instale numpy para calcular totales por lote")
+    doc = numpy.asarray(doc, dtype=numpy.int64)
+    largo = len(doc)
+    n = int(documentos if documentos is not None else (
+        doc.max() + 1 if largo else 0))
+    qty = numpy.round(_columna(QtyItem, largo, numpy.float64), 4)
+    prc = numpy.round(_columna(PrcItem, largo, numpy.float64), 4)
+    pct = numpy.round(_columna(DescuentoPct, largo, numpy.float64), 4)
+    ind_exe = _columna(IndExe, largo, numpy.int64)
+    cod_imp = _columna(CodImp, largo, numpy.int64, 14)
+    cod_adic = _columna(CodImpAdic, largo, numpy.int64)
+    tasa_adic = _columna(TasaImpAdic, largo, numpy.float64)
+    incluye = _columna(price_include, largo, bool)
+    dsc = _columna(DscGlobalPct, n, numpy.float64)
+    rcg = _columna(RcgGlobalPct, n, numpy.float64)
+    if numpy.isin(cod_adic, ESPECIFICOS).any():
+        raise UserError("Impuestos específicos no soportados por lote")
+    if not numpy.isin(cod_imp[ind_exe == 0], [14, 15]).all():
+        raise UserError("CodImp por lote debe ser 14 o 15")
+
+    # LineaDetalle._compute_price: MontoItem usa el descuento sin redondear.
+    total = qty * prc
+    descuento = numpy.where(pct > 0, total * (pct / 100.0), 0.0)
+    monto_item = round0(total + (0.0 - descuento))
+    descuento = round0(descuento)
+
+    # Documento.impuestos: una LineaImpuesto por (documento, CodImp) que
+    # acumula los MontoItem de sus líneas.
+    afecta = ind_exe == 0
+    exenta = ind_exe == 1
+    adicional = afecta & (cod_adic != 0)
+    lineas = numpy.concatenate([
+        numpy.flatnonzero(afecta | exenta), numpy.flatnonzero(adicional)])
+    codigo = numpy.concatenate([
+        numpy.where(exenta, 0, cod_imp)[afecta | exenta],
+        cod_adic[adicional]])
+    tasa = numpy.concatenate([
+        numpy.where(exenta, 0.0, float(TasaIVA))[afecta | exenta],
+        tasa_adic[adicional]])
+    incluido = numpy.concatenate([
+        numpy.where(exenta, False, incluye)[afecta | exenta],
+        incluye[adicional]])
+    clave = doc[lineas] * 1000 + codigo
+    claves, primera, grupo = numpy.unique(
+        clave, return_index=True, return_inverse=True)
+    suma = numpy.bincount(
+        grupo, weights=monto_item[lineas], minlength=len(claves))
+    doc_g = claves // 1000
+    cod_g = claves % 1000
+    tasa_g = tasa[primera]
+    base = numpy.where(
+        incluido[primera] & (tasa_g != 0), suma / (1 + (tasa_g / 100.0)),
+        suma)
+    monto_imp = numpy.where(
+        tasa_g == 0, round0(base), round0(base * (tasa_g / 100.0)))
+
+    def por_documento(valores, filtro):
+        return numpy.bincount(
+            doc_g[filtro], weights=valores[filtro], minlength=n)
+
+    iva = tasa_g == TasaIVA
+    retencion = cod_g == 15
+    otros = numpy.isin(cod_g, ADICIONALES) & ~retencion
+    mnt_exe = por_documento(monto_imp, tasa_g == 0)
+    mnt_neto = _aplicar_dsc_rcg(
+        round0(por_documento(base, iva)), dsc, rcg)
+    mnt_iva = _aplicar_dsc_rcg(
+        round0(por_documento(monto_imp, iva)), dsc, rcg)
+    impto_reten = _aplicar_dsc_rcg(round0(
+        por_documento(monto_imp, otros) - por_documento(
+            monto_imp, retencion)), dsc, rcg)
+    mnt_exe = mnt_exe.astype(numpy.int64)
+    monto_nf = (numpy.bincount(doc, weights=numpy.where(
+        ind_exe == 2, monto_item, 0), minlength=n) - numpy.bincount(
+        doc, weights=numpy.where(ind_exe == 6, monto_item, 0),
+        minlength=n)).astype(numpy.int64)
+    return {
+        'DescuentoMonto': descuento,
+        'MontoItem': monto_item,
+        'MntExe': mnt_exe,
+        'MntNeto': mnt_neto,
+        'MntIVA': mnt_iva,
+        'ImptoReten': impto_reten,
+        'MontoNF': monto_nf,
+        'MntTotal': mnt_exe + mnt_neto + mnt_iva + impto_reten + monto_nf,
+    }
+
+
+def columnas_desde_documentos(documentos, TasaIVA=19):
+    """Columnas para `calcular` a partir de documentos con el formato de
+    vals['Documento'][i]['documentos']. Lanza UserError si alguno usa algo
+    que el cálculo por lote no cubre."""
+    columnas = {k: [] for k in [
+        'doc', 'QtyItem', 'PrcItem', 'DescuentoPct', 'IndExe', 'CodImp',
+        'CodImpAdic', 'TasaImpAdic', 'price_include']}
+    dsc = []
+    rcg = []
+    for i, documento in enumerate(documentos):
+        globales = {'D': [], 'R': []}
+        for gdr in documento.get('DscRcgGlobal', []):
+            if gdr.get('TpoValor') != '%' or gdr.get('IndExeDR') or \
+                    str(gdr.get('TpoMov'))[:1] not in globales:
+                raise UserError(
+                    "Documento %s: solo descuentos y recargos globales en "
+                    "%% a afectos" % i)
+            globales[str(gdr['TpoMov'])[:1]].append(
+                round(float(gdr.get('ValorDR', 0)), 2))
+        if len(globales['D']) > 1 or len(globales['R']) > 1:
+            raise UserError(
+                "Documento %s: un descuento y un recargo global como "
+                "máximo" % i)
+        dsc.append(sum(globales['D']))
+        rcg.append(sum(globales['R']))
+        detalle = documento.get('Detalle', [])
+        if type(detalle) is dict:
+            detalle = [detalle]
+        for linea in detalle:
+            if linea.get('DescuentoMonto') or linea.get('RecargoPct') or \
+                    linea.get('RecargoMonto') or linea.get('MontoItem'):
+                raise UserError(
+                    "Documento %s: descuentos, recargos o MontoItem fijos "
+                    "no soportados por lote" % i)
+            ind_exe = int(linea.get('IndExe') or 0)
+            if ind_exe not in [0, 1, 2, 6] or (
+                    ind_exe and linea.get('Impuesto')) or (
+                    not ind_exe and not linea.get('Impuesto')):
+                raise UserError(
+                    "Documento %s: cada línea lleva Impuesto o IndExe 1, 2 "
+                    "o 6 sin Impuesto" % i)
+            principal = 14 if ind_exe else None
+            adicional = tasa_adicional = 0
+            incluye = False
+            for n, imp in enumerate(linea.get('Impuesto') or []):
+                cod = imp.get('CodImp') or 14
+                if n == 0:
+                    incluye = bool(imp.get('price_include'))
+                if cod in [14, 15]:
+                    principal = cod
+                elif not adicional:
+                    adicional = cod
+                    tasa_adicional = imp.get('TasaImp', 0)
+                else:
+                    raise UserError(
+                        "Documento %s: más de un impuesto adicional" % i)
+            if principal is None:
+                raise UserError(
+                    "Documento %s: línea afecta sin IVA (CodImp 14 o 15)" % i)
+            columnas['doc'].append(i)
+            columnas['QtyItem'].append(float(linea.get('QtyItem', 0)))
+            columnas['PrcItem'].append(float(linea.get('PrcItem', 0)))
+            columnas['DescuentoPct'].append(
+                float(linea.get('DescuentoPct', 0)))
+            columnas['IndExe'].append(ind_exe)
+            columnas['CodImp'].append(principal)
+            columnas['CodImpAdic'].append(adicional)
+            columnas['TasaImpAdic'].append(tasa_adicional)
+            columnas['price_include'].append(incluye)
+    columnas['DscGlobalPct'] = dsc
+    columnas['RcgGlobalPct'] = rcg
+    columnas['TasaIVA'] = TasaIVA
+    columnas['documentos'] = len(documentos)
+    return columnas
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+import copy
+import unittest
+from unittest import mock
+
+from lxml import etree
+
+from facturacion_electronica.datos_prueba import (
+    certificado_prueba,
+    payload_sintetico,
+)
+from facturacion_electronica.envio import Envio
+from facturacion_electronica.firma import Firma
+
+
+DS = '{http://www.w3.org/2000/09/xmldsig#}'
+
+
+class TestEscritorEnvio(unittest.TestCase):
+    """
+    El sobre armado en streaming (digest de SetDTE incremental) debe quedar
+    firmado igual que el sobre armado en memoria.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.firma = certificado_prueba()
+
+    def _sobre(self, vals, stream):
+        # Mismo TmstFirma / TSTED en ambos sobres para comparar las firmas.
+        with mock.patch('facturacion_electronica.clase_util.time_stamp',
+                        return_value='2025-01-01T10:00:00'):
+            envio = Envio(copy.deepcopy(vals))
+            envio.workers = 0
+            # Solo se incluye el XSD de EnvioBOLETA.
+            envio.firma_electronica.verify = envio.es_boleta
+            envio.stream = stream
+            envio.generate_xml_send()
+        self.assertFalse(envio.errores)
+        if stream:
+            return envio.sobre.archivo.read().decode('ISO-8859-1')
+        return envio.sii_xml_request
+
+    def _firma_sobre(self, xml):
+        # El sobre en memoria no trae declaración XML.
+        raiz = etree.fromstring(
+            xml.encode('ISO-8859-1'),
+            etree.XMLParser(encoding='ISO-8859-1'))
+        firma = raiz.find(DS + 'Signature')
+        return (
+            firma.find('%sSignedInfo/%sReference' % (DS, DS)).get('URI'),
+            firma.find('%sSignedInfo/%sReference/%sDigestValue' % (
+                DS, DS, DS)).text,
+            firma.find(DS + 'SignatureValue').text,
+        )
+
+    def _verificar(self, tipo):
+        # Un solo payload: payload_sintetico genera un CAF nuevo cada vez.
+        vals = payload_sintetico(5, (tipo,), (1, 4), firma=self.firma)
+        en_memoria = self._sobre(vals, False)
+        en_stream = self._sobre(vals, True)
+        firma = self._firma_sobre(en_stream)
+        self.assertEqual(firma[0], '#SetDoc')
+        self.assertEqual(firma, self._firma_sobre(en_memoria))
+        self.assertEqual(
+            Firma(vals['firma_electronica']).verificar_firma_xml(en_stream),
+            (0, ''))
+
+    def test_envio_boleta(self):
+        self._verificar(39)
+
+    def test_envio_dte(self):
+        self._verificar(33)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+import multiprocessing
+import os
+import tempfile
+import unittest
+
+from facturacion_electronica.folios import get_folio_allocator
+
+
+def _reservar_muchos(args):
+    backend, path = args
+    allocator = get_folio_allocator(path, backend)
+    return [allocator.reservar('76387093-6|39', [(1, 100000)])[0]
+            for _ in range(50)]
+
+
+class TestFolioAllocator(unittest.TestCase):
+    """
+    Verifica que los backends de folios no repitan folios entre procesos.
+    """
+
+    def _verificar_backend(self, backend, ext):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'folio_state' + ext)
+            ctx = multiprocessing.get_context('fork')
+            with ctx.Pool(4) as pool:
+                res = pool.map(_reservar_muchos, [(backend, path)] * 4)
+            folios = sum(res, [])
+            self.assertEqual(len(folios), len(set(folios)))
+            self.assertEqual(sorted(folios), list(range(1, 201)))
+
+    @unittest.skipUnless(hasattr(os, 'fork'), "requiere fork")
+    def test_json_sin_folios_repetidos(self):
+        self._verificar_backend('json', '.json')
+
+    @unittest.skipUnless(hasattr(os, 'fork'), "requiere fork")
+    def test_sqlite_sin_folios_repetidos(self):
+        self._verificar_backend('sqlite', '.sqlite3')
+
+    def test_reserva_multi_caf_y_liberacion(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            allocator = get_folio_allocator(
+                os.path.join(tmp, 'folio_state.sqlite3'), 'sqlite')
+            key = '76387093-6|39'
+            rangos = [(1, 3), (10, 12)]
+            self.assertEqual(allocator.reservar(key, rangos, 4), [1, 2, 3, 10])
+            self.assertEqual(allocator.liberar(key, [3, 10], rangos), [])
+            self.assertEqual(allocator.reservar(key, rangos, 2), [3, 10])
+            self.assertEqual(allocator.liberar(key, [10], rangos), [])
+            self.assertEqual(allocator.reservar(key, rangos, 3), [10, 11, 12])
+            with self.assertRaises(Exception):
+                allocator.reservar(key, rangos)
+            self.assertEqual(allocator.liberar(key, [1, 2, 3, 10, 11, 12], rangos), [])
+            self.assertEqual(allocator.reservar(key, rangos, 6), [1, 2, 3, 10, 11, 12])
+
+
+if __name__ == '__main__':
+    unittest.main()
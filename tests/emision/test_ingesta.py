@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+import csv
+import json
+import os
+import tempfile
+import unittest
+
+from lxml import etree
+
+from facturacion_electronica import ingesta
+from facturacion_electronica.datos_prueba import (
+    caf_prueba,
+    certificado_prueba,
+    payload_sintetico,
+)
+
+
+COLUMNAS = ['documento', 'FchEmis', 'NmbItem', 'QtyItem', 'PrcItem',
+            'DescuentoPct', 'IndExe']
+
+
+def filas_prueba(n):
+    """`n` documentos de 1 a 3 líneas; cada tercera línea es exenta."""
+    filas = []
+    for i in range(n):
+        for j in range(i % 3 + 1):
+            filas.append({
+                'documento': 'POS-%03d' % i,
+                'FchEmis': '2025-01-01',
+                'NmbItem': 'Producto %s-%s' % (i, j),
+                'QtyItem': str(j + 1),
+                'PrcItem': '1190',
+                'DescuentoPct': '10' if j == 1 else '',
+                'IndExe': '1' if j == 2 else '',
+            })
+    return filas
+
+
+class TestIngesta(unittest.TestCase):
+    """
+    Emisión desde CSV / JSON Lines: folios del CAF, sobres de a max_dte
+    documentos y DTE firmados en disco.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.firma = certificado_prueba()
+
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.tmp = self._tmp.name
+        self._env = {k: os.environ.get(k)
+                     for k in ['FOLIO_STATE_PATH', 'ENVIO_MAX_DTE']}
+        os.environ['FOLIO_STATE_PATH'] = os.path.join(self.tmp, 'folios.json')
+        os.environ['ENVIO_MAX_DTE'] = '4'
+        self.vals = payload_sintetico(0, firma=self.firma)
+        self.vals['Documento'] = [{
+            'TipoDTE': 39, 'caf_file': [caf_prueba(desde=1, hasta=100)]}]
+
+    def tearDown(self):
+        for k, v in self._env.items():
+            if v is None:
+                os.environ.pop(k, None)
+            else:
+                os.environ[k] = v
+        self._tmp.cleanup()
+
+    def _emitir(self, path, destino):
+        resumen = ingesta.emitir(
+            self.vals, ingesta.leer_filas(path), os.path.join(self.tmp, destino))
+        self.assertEqual(resumen['errores'], [])
+        with open(resumen['indice']) as f:
+            return resumen, list(csv.DictReader(f))
+
+    def test_csv(self):
+        path = os.path.join(self.tmp, 'diario.csv')
+        with open(path, 'w', newline='') as f:
+            escritor = csv.DictWriter(f, COLUMNAS)
+            escritor.writeheader()
+            escritor.writerows(filas_prueba(10))
+        resumen, indice = self._emitir(path, 'csv')
+        self.assertEqual(resumen['documentos'], 10)
+        self.assertEqual(len(resumen['sobres']), 3)
+        self.assertEqual([int(r['Folio']) for r in indice], list(range(1, 11)))
+        self.assertEqual(indice[0]['documento'], 'POS-000')
+        # 1190 + 2 * 1190 - 10 % + 3 * 1190 exento
+        self.assertEqual(indice[2]['MntTotal'], str(1190 + 2142 + 3570))
+        for n, sobre in enumerate(resumen['sobres']):
+            xml = etree.parse(sobre).getroot()
+            self.assertEqual(etree.QName(xml).localname, 'EnvioBOLETA')
+            self.assertEqual(len(xml.findall(
+                './/{http://www.sii.cl/SiiDte}DTE')), 2 if n == 2 else 4)
+        self.assertTrue(os.path.exists(os.path.join(
+            os.path.dirname(resumen['sobres'][0]), 'dte', 'T39F10.xml')))
+
+    def test_jsonl_igual_a_csv(self):
+        path = os.path.join(self.tmp, 'diario.jsonl')
+        with open(path, 'w') as f:
+            for fila in filas_prueba(5):
+                f.write(json.dumps(fila) + '\n')
+        resumen, indice = self._emitir(path, 'jsonl')
+        self.assertEqual(resumen['documentos'], 5)
+        self.assertEqual(
+            [r['MntTotal'] for r in indice],
+            ['1190', '3332', '6902', '1190', '3332'])
+
+
+if __name__ == '__main__':
+    unittest.main()
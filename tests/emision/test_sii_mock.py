@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+import copy
+import os
+import unittest
+from unittest import mock
+
+from facturacion_electronica import facturacion_electronica as fe
+from facturacion_electronica import instrumentacion
+from facturacion_electronica.conexion import Conexion
+from facturacion_electronica.datos_prueba import caf_prueba, certificado_prueba
+from facturacion_electronica.sii_mock import ServidorSII
+
+
+class TestSIILocal(unittest.TestCase):
+    """
+    Envío y tracking de boletas contra el SII local (sii_mock, Modo 'local'):
+    API de boletas, DTEUpload y los servicios SOAP, sin red ni certificado
+    real.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls._wsdl_cache = os.environ.get('SII_WSDL_CACHE_PATH')
+        os.environ['SII_WSDL_CACHE_PATH'] = 'none'
+        cls.sii = ServidorSII().iniciar()
+        documentos = [{
+            "NroDTE": i + 1,
+            "IndServicio": 3,
+            "Encabezado": {
+                "IdDoc": {"Folio": i + 1, "FchEmis": "2025-01-01"},
+                "Receptor": {"RUTRecep": "66666666-6"},
+                "Totales": {"MntTotal": 1190},
+            },
+            "Detalle": [{
+                "NmbItem": "Producto %s" % i,
+                "QtyItem": 1,
+                "PrcItem": 1190,
+                "Impuesto": [{
+                    "CodImp": 14, "price_include": True, "TasaImp": 19.0}],
+            }],
+        } for i in range(3)]
+        cls.data = {
+            "test": False,
+            "api": True,
+            "Emisor": {
+                "RUTEmisor": "76387093-6",
+                "RznSoc": "EMPRESA PRUEBA",
+                "GiroEmis": "GIRO",
+                "DirOrigen": "DIRECCION",
+                "CmnaOrigen": "SANTIAGO",
+                "Modo": "local",
+                "NroResol": 0,
+                "FchResol": "2018-07-18",
+                "ValorIva": 19,
+            },
+            "firma_electronica": {
+                "init_signature": True,
+                "string_password": b"prueba",
+                "string_firma": certificado_prueba("11111111-1", b"prueba"),
+                "rut_firmante": "11111111-1",
+            },
+            "Documento": [{
+                "TipoDTE": 39,
+                "caf_file": [caf_prueba("76387093-6", 39, 1, 100)],
+                "documentos": documentos,
+            }],
+        }
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.sii.detener()
+        if cls._wsdl_cache is None:
+            os.environ.pop('SII_WSDL_CACHE_PATH', None)
+        else:
+            os.environ['SII_WSDL_CACHE_PATH'] = cls._wsdl_cache
+
+    def _vals(self, **kwargs):
+        vals = copy.deepcopy(self.data)
+        vals.update(kwargs)
+        return vals
+
+    def _enviar(self, api):
+        resultado = fe.timbrar_y_enviar(self._vals(api=api))
+        self.assertEqual(resultado.get('errores'), [], resultado)
+        self.assertEqual(resultado['status'], 'Enviado')
+        envio = self.sii.envios[str(resultado['sii_send_ident'])]
+        self.assertEqual(envio['documentos'], 3)
+        self.assertEqual(envio['tipos'], {39: 3})
+        return resultado['sii_send_ident']
+
+    def test_envio_y_tracking_api(self):
+        track_id = self._enviar(api=True)
+        estado = fe.consulta_estado_envio(
+            self._vals(codigo_envio=track_id))
+        self.assertEqual(estado['status'], 'Aceptado')
+        estados = fe.consulta_estado_dte(self._vals())
+        self.assertEqual(sorted(estados), ['T39F1', 'T39F2', 'T39F3'])
+        for estado in estados.values():
+            self.assertEqual(estado['status'], 'Proceso')
+
+    def test_envio_y_tracking_soap(self):
+        track_id = self._enviar(api=False)
+        # Token vencido: se renueva una vez y la consulta sigue.
+        self.sii.revocar_tokens()
+        estado = fe.consulta_estado_envio(
+            self._vals(api=False, codigo_envio=track_id))
+        self.assertEqual(estado['status'], 'Aceptado')
+        estados = fe.consulta_estado_dte(self._vals(api=False))
+        for estado in estados.values():
+            self.assertEqual(estado['status'], 'Proceso')
+
+    def test_consulta_estado_dte_lote(self):
+        self._enviar(api=True)
+        vals = self._vals(
+            Documento=[],
+            consultas=[(39, folio, '2025-01-01', 1190, '66666666-6')
+                       for folio in range(1, 51)],
+            concurrencia=8,
+            por_segundo=0,
+        )
+        antes = self.sii.peticiones.copy()
+        ids = []
+        for id_dte, estado in fe.iter_estado_dte(vals):
+            ids.append(id_dte)
+            self.assertEqual(estado['status'], 'Proceso', estado)
+        self.assertEqual(
+            sorted(ids), sorted('T39F%s' % f for f in range(1, 51)))
+        peticiones = self.sii.peticiones - antes
+        self.assertLessEqual(sum(
+            n for endpoint, n in peticiones.items() if 'token' in endpoint), 1)
+
+    def _vals_lotes(self, cantidad):
+        vals = self._vals(max_dte=2, concurrencia=2)
+        plantilla = vals['Documento'][0]['documentos'][0]
+        documentos = []
+        for folio in range(1, cantidad + 1):
+            documento = copy.deepcopy(plantilla)
+            documento['NroDTE'] = folio
+            documento['Encabezado']['IdDoc']['Folio'] = folio
+            documentos.append(documento)
+        vals['Documento'][0]['documentos'] = documentos
+        return vals
+
+    def test_envio_en_varios_sobres(self):
+        vals = self._vals_lotes(5)
+        # Sin cache de tokens: los sobres deben compartir la conexión.
+        token_cache = os.environ.get('SII_TOKEN_CACHE')
+        os.environ['SII_TOKEN_CACHE'] = 'none'
+        antes = self.sii.peticiones.copy()
+        try:
+            resultado = fe.timbrar_y_enviar(vals)
+        finally:
+            if token_cache is None:
+                os.environ.pop('SII_TOKEN_CACHE', None)
+            else:
+                os.environ['SII_TOKEN_CACHE'] = token_cache
+        self.assertEqual(resultado['errores'], [], resultado)
+        self.assertEqual(resultado['status'], 'Enviado')
+        self.assertEqual(
+            [e['folios'] for e in resultado['envios']], [[1, 2], [3, 4], [5]])
+        track_ids = resultado['sii_send_ident']
+        self.assertEqual(len(set(track_ids)), 3)
+        self.assertEqual(
+            [self.sii.envios[str(t)]['documentos'] for t in track_ids],
+            [2, 2, 1])
+        self.assertEqual(
+            [d['Folio'] for d in resultado['detalles']], [1, 2, 3, 4, 5])
+        peticiones = self.sii.peticiones - antes
+        self.assertEqual(sum(
+            n for endpoint, n in peticiones.items() if 'token' in endpoint), 1)
+
+    def test_envio_en_varios_sobres_estado_combinado(self):
+        send_xml_file = Conexion.send_xml_file
+
+        def rechazar_segundo(conexion, sobre, filename, *args, **kwargs):
+            if os.path.splitext(filename)[0].endswith('_2'):
+                return {'status': 'Rechazado', 'sii_send_ident': ''}
+            return send_xml_file(conexion, sobre, filename, *args, **kwargs)
+
+        with mock.patch.object(Conexion, 'send_xml_file', rechazar_segundo):
+            resultado = fe.timbrar_y_enviar(self._vals_lotes(5))
+        self.assertEqual(resultado['status'], 'Rechazado')
+        self.assertEqual(
+            [e['status'] for e in resultado['envios']],
+            ['Enviado', 'Rechazado', 'Enviado'])
+        self.assertEqual(resultado['errores'], [])
+        self.assertEqual(resultado['sii_send_ident'][1], '')
+        self.assertEqual(len(resultado['detalles']), 5)
+
+    def test_errores_inyectados_se_reintentan(self):
+        track_id = self._enviar(api=False)
+        self.sii.fallar(2)
+        estado = fe.consulta_estado_envio(
+            self._vals(api=False, codigo_envio=track_id))
+        self.assertEqual(estado['status'], 'Aceptado', estado)
+
+    def test_instrumentacion_por_etapa(self):
+        metricas = instrumentacion.registrar(
+            instrumentacion.MetricasPrometheus())
+        try:
+            self._enviar(api=True)
+        finally:
+            instrumentacion.quitar(metricas)
+        series = {s['etiquetas']['etapa']: s for s in metricas.series()}
+        for etapa in ['dte.timbrar', 'dte.set_barcode', 'firma.firmar',
+                      'validar_xml', 'envio.generate_xml_send',
+                      'conexion.envio']:
+            self.assertIn(etapa, series)
+        self.assertEqual(series['dte.timbrar']['cuenta'], 3)
+        self.assertGreater(series['conexion.envio']['bytes'], 0)
+        self.assertIn(
+            'facturacion_electronica_etapa_segundos_count'
+            '{etapa="conexion.envio",servicio="api"}',
+            metricas.exportar())
+
+
+if __name__ == '__main__':
+    unittest.main()
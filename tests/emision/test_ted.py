@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+import copy
+import unittest
+
+from lxml import etree
+
+from facturacion_electronica.caf import Caf
+from facturacion_electronica.datos_prueba import caf_prueba
+from facturacion_electronica.dte import armar_ted
+
+
+def ted_lxml(campos, caf, timestamp):
+    """TED armado con lxml, como lo hacía set_barcode."""
+    ted = etree.Element('TED')
+    dd = etree.SubElement(ted, 'DD')
+    for tag, texto in campos:
+        etree.SubElement(dd, tag.decode()).text = texto
+    dd.append(copy.deepcopy(caf.caf))
+    etree.SubElement(dd, 'TSTED').text = timestamp
+    ddxml = etree.tostring(
+        dd, encoding="ISO-8859-1", xml_declaration=False).replace(b'\n', b'')
+    ted.set("version", "1.0")
+    frmt = etree.SubElement(ted, 'FRMT')
+    frmt.set("algoritmo", "SHA1withRSA")
+    frmt.text = caf.llave.sign(ddxml)
+    return ted
+
+
+class TestTED(unittest.TestCase):
+
+    def setUp(self):
+        self.caf = Caf([caf_prueba()]).get_caf(1, 39)
+
+    def test_igual_a_lxml(self):
+        for rsr, it1 in [
+                ('Cliente', 'Producto'),
+                ('Ñandú & <Cía> "S.A."', "Item 'uno' > dos ]]>"),
+                ('Euro € y emoji \U0001F600', 'Salto\r\nde línea\tcon tab'),
+                ('', 'IIIIIII'),
+                (None, 'x' * 40)]:
+            campos = [
+                (b'RE', '76387093-6'), (b'TD', '39'), (b'F', '1'),
+                (b'FE', '2025-01-01'), (b'RR', '66666666-6'),
+                (b'RSR', rsr), (b'MNT', '1190'), (b'IT1', it1)]
+            ted, nodo = armar_ted(campos, self.caf, '2025-01-01T10:00:00')
+            referencia = ted_lxml(campos, self.caf, '2025-01-01T10:00:00')
+            esperado = etree.tostring(
+                referencia, encoding="ISO-8859-1", xml_declaration=False)
+            self.assertEqual(ted, esperado.replace(b'\n', b''))
+            self.assertEqual(etree.tostring(
+                nodo, encoding="ISO-8859-1", xml_declaration=False), esperado)
+
+    def test_caracteres_invalidos(self):
+        with self.assertRaises(ValueError):
+            armar_ted([(b'RSR', 'nulo \x00')], self.caf, '2025-01-01T10:00:00')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+import copy
+import random
+import unittest
+
+from facturacion_electronica import totales_lote
+from facturacion_electronica.datos_prueba import documentos_sinteticos
+from facturacion_electronica.documento import Documento
+
+
+@unittest.skipIf(totales_lote.numpy is None, "numpy no está instalado")
+class TestTotalesLote(unittest.TestCase):
+    """
+    Diferencial: los totales por lote deben coincidir con los de Documento.
+    """
+
+    CAMPOS = ['MntExe', 'MntNeto', 'MntIVA', 'ImptoReten', 'MontoNF',
+              'MntTotal']
+
+    def _documentos(self, tipo, semilla):
+        azar = random.Random(semilla)
+        documentos = documentos_sinteticos(300, tipo, semilla=semilla)
+        for doc in documentos:
+            incluye = tipo == 39 or azar.random() < 0.5
+            for linea in doc['Detalle']:
+                linea['QtyItem'] = azar.choice(
+                    [linea['QtyItem'], 0.5, 1.25, 3.333])
+                if azar.random() < 0.3:
+                    linea['DescuentoPct'] = azar.choice([2.5, 10, 33.33])
+                for imp in linea.get('Impuesto', []):
+                    imp['price_include'] = incluye
+                if linea.get('Impuesto') and tipo == 33:
+                    sorteo = azar.random()
+                    if sorteo < 0.1:
+                        linea['Impuesto'][0]['CodImp'] = 15
+                    elif sorteo < 0.3:
+                        linea['Impuesto'].append({
+                            'CodImp': azar.choice([27, 271, 17]),
+                            'TasaImp': azar.choice([10, 18, 12]),
+                            'price_include': incluye})
+                elif linea.get('IndExe') and azar.random() < 0.3:
+                    linea['IndExe'] = azar.choice([2, 6])
+            if doc.get('DscRcgGlobal') and azar.random() < 0.5:
+                doc['DscRcgGlobal'].append({
+                    'TpoMov': 'R', 'TpoValor': '%',
+                    'ValorDR': azar.choice([1.5, 7])})
+        return documentos
+
+    def test_igual_a_documento(self):
+        for tipo, semilla in [(39, 1), (33, 2), (33, 3)]:
+            documentos = self._documentos(tipo, semilla)
+            totales = totales_lote.calcular(
+                **totales_lote.columnas_desde_documentos(documentos))
+            for i, vals in enumerate(copy.deepcopy(documentos)):
+                doc = Documento(vals, tipo_dte=tipo)
+                for campo in self.CAMPOS:
+                    self.assertEqual(
+                        totales[campo][i], getattr(doc, campo),
+                        "%s doc %s %s" % (tipo, i, campo))
+
+    def test_round0(self):
+        from facturacion_electronica import clase_util as util
+        valores = [0.5, 1.5, 2.5, -0.5, -2.5, 0.49999999999999994,
+                   1234.4999999999998, 2.675 * 100, -1e15 - 0.5]
+        self.assertEqual(
+            list(totales_lote.round0(valores)),
+            [util.round0(v) for v in valores])
+
+
+if __name__ == '__main__':
+    unittest.main()